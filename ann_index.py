@@ -0,0 +1,134 @@
+"""
+Approximate nearest neighbour search backends for VectorSpace.
+
+Exact search scores a query against every org. The backends here
+instead pick a set of candidate orgs per query, and VectorSpace only
+scores those candidates exactly. Each backend has a single knob that
+trades recall for latency:
+
+    InvertedIndexSearcher: candidates are the orgs sharing one of the
+        query's max_terms highest weighted terms. Using all of a
+        query's terms gives exact results for non-negative queries.
+    ClusterIVFSearcher: candidates are the orgs in the n_probe clusters
+        whose centroids are most similar to the query (an IVF index
+        over the existing clusters).
+
+See VectorSpace.set_search_backend.
+"""
+import numpy as np
+import scipy.sparse as sp
+from vector_space import normalize_rows
+
+
+def _query_terms(query):
+    """Returns (term indices, weights) of the non-zero entries of
+    a single query, given as a 1 x n csr matrix or a 1d array.
+    """
+    if sp.issparse(query):
+        return query.indices, query.data
+    terms = np.flatnonzero(query)
+    return terms, query[terms]
+
+
+class InvertedIndexSearcher:
+    """Selects candidates through an inverted index from terms to
+    the orgs containing them.
+
+    Attributes:
+        max_terms (int): the number of highest weighted query terms
+            whose postings are used. None uses every term.
+        size (int): the number of orgs indexed.
+    """
+
+    name = 'inverted'
+
+    def __init__(self, matrix, max_terms=32):
+        """
+        Args:
+            matrix (scipy sparse matrix): the org embeddings, one row
+                per org.
+            max_terms (int): see class attributes.
+        """
+        self._postings = sp.csc_matrix(matrix)
+        self.max_terms = max_terms
+        self.size = matrix.shape[0]
+
+    def candidates(self, query):
+        """Returns the row indices of the candidate orgs for a
+        single query.
+        """
+        terms, weights = _query_terms(query)
+        if self.max_terms is not None and len(terms) > self.max_terms:
+            top = np.argpartition(-np.abs(weights), self.max_terms - 1)[:self.max_terms]
+            terms = terms[top]
+        return np.unique(self._postings[:, terms].indices)
+
+
+class ClusterIVFSearcher:
+    """Selects candidates from the clusters whose centroids are
+    closest to the query.
+
+    Attributes:
+        n_probe (int): the number of clusters searched per query.
+        size (int): the number of orgs indexed.
+    """
+
+    name = 'ivf'
+
+    def __init__(self, labels, centroids, n_probe=3):
+        """
+        Args:
+            labels (array): the cluster label of every org, see
+                Clusterer.labels.
+            centroids (array): the cluster centroids, see
+                Clusterer.centroids.
+            n_probe (int): see class attributes.
+        """
+        labels = np.asarray(labels)
+        self._centroids = normalize_rows(np.asarray(centroids, dtype=np.float64))
+        order = np.argsort(labels, kind='stable')
+        bounds = np.searchsorted(labels[order], np.arange(len(self._centroids) + 1))
+        self._members = [order[bounds[i]:bounds[i + 1]] for i in range(len(self._centroids))]
+        self.n_probe = n_probe
+        self.size = len(labels)
+
+    def candidates(self, query):
+        """Returns the row indices of the candidate orgs for a
+        single query.
+        """
+        if sp.issparse(query):
+            sims = np.asarray(query @ self._centroids.T).ravel()
+        else:
+            sims = self._centroids @ query
+        n_probe = min(self.n_probe, len(sims))
+        probed = np.argpartition(-sims, n_probe - 1)[:n_probe]
+        return np.concatenate([self._members[i] for i in probed])
+
+
+def make_searcher(name, vs, clusterer=None, **params):
+    """Builds a search backend by name.
+
+    Args:
+        name (str): 'exact', 'inverted' or 'ivf'.
+        vs (VectorSpace): the vector space to search. The inverted
+            backend needs a vector space without n_components.
+        clusterer (Clusterer, optional): required for 'ivf'.
+        params: the backend's knob, max_terms or n_probe.
+
+    Returns:
+        a searcher, or None for exact search.
+    """
+    if name == 'exact':
+        return None
+    if name == 'inverted':
+        if vs.n_components is not None:
+            raise ValueError('The inverted search backend needs the sparse tfidf space.')
+        return InvertedIndexSearcher(vs.get_org_vectors(), **params)
+    if name == 'ivf':
+        if clusterer is None:
+            raise ValueError('The ivf search backend needs a Clusterer.')
+        centroids = clusterer.centroids
+        if vs.n_components is not None:
+            centroids = vs.project(centroids)
+        return ClusterIVFSearcher(clusterer.labels, centroids, **params)
+    raise ValueError('Unknown search backend: {}'.format(name))
@@ -1,26 +1,276 @@
-from fastapi import FastAPI
-from vector_space import VectorSpace
-from org_dataset import OrgDataset
-from org_recommender import OrgRecommender
-from clusterer import Clusterer
-from keyword_finder import KeywordFinder
-from keyword_matcher import KeywordMatcher
-from gcd_utils import get_account_liked_tags
+import time
+_import_start = time.perf_counter()
+import json
+import logging
+import os
+import threading
+from typing import List
+from fastapi import FastAPI, Query
+from pydantic import BaseModel, conint
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+import metrics
+from model_registry import ModelRegistry
+from gcd_utils import get_account_liked_tags, get_account_profile, get_account_profiles
+from org_recommender import batches
+from result_cache import ProfileResultCache, ResultCache, profile_key, \
+    stored_profile_key, tags_key
+import gcd_utils
+from user_profiles import ACTIONS, ProfileStore
+from worker_pools import BoundedExecutor, PoolSaturatedError
+
+# Heavy modules (sklearn, pandas, google-cloud-datastore) are only
+# imported where they are needed, which keeps instance spin-up fast.
+# automation/check_import_time.py checks that this stays true.
+metrics.record_startup_phase('imports', time.perf_counter() - _import_start)
+logger = logging.getLogger(__name__)
+
+MODEL_DIR = os.environ.get('MODEL_DIR', './model')
+IO_POOL_SIZE = int(os.environ.get('IO_POOL_SIZE', '16'))
+CPU_POOL_SIZE = int(os.environ.get('CPU_POOL_SIZE', '4'))
+POOL_QUEUE_SIZE = int(os.environ.get('POOL_QUEUE_SIZE', '64'))
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', '256'))
+MODEL_POLL_INTERVAL = float(os.environ.get('MODEL_POLL_INTERVAL', '0'))
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', '10000'))
+# 'exact', or an approximate backend from ann_index: 'inverted' (knob
+# SEARCH_MAX_TERMS) or 'ivf' (knob SEARCH_N_PROBE).
+SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'exact')
+SEARCH_PARAMS = {
+    'inverted': {'max_terms': int(os.environ.get('SEARCH_MAX_TERMS', '32'))},
+    'ivf': {'n_probe': int(os.environ.get('SEARCH_N_PROBE', '3'))},
+}.get(SEARCH_BACKEND, {})
+# Adds a Server-Timing header with the duration of every stage (see
+# metrics) to each response.
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '0') == '1'
+# Serves /profiler/ and /memory/, which expose stack traces and model
+# internals without authentication. Off unless set to 1.
+DEBUG_ENDPOINTS = os.environ.get('DEBUG_ENDPOINTS', '0') == '1'
+# Keeps user profile vectors up to date from /profile_events/ and
+# persists them in this directory (see user_profiles). Disabled if
+# empty, in which case profiles are fetched from Datastore per request.
+PROFILE_STORE_DIR = os.environ.get('PROFILE_STORE_DIR', '')
+PROFILE_SAVE_INTERVAL = float(os.environ.get('PROFILE_SAVE_INTERVAL', '300'))
+# Stored profiles are re-seeded from Datastore after this many seconds,
+# which bounds how long events posted to other instances go unseen.
+# 0 never re-seeds them and is only correct with a single instance.
+PROFILE_STORE_TTL = float(os.environ.get('PROFILE_STORE_TTL', str(gcd_utils.PROFILE_CACHE_TTL)))
 
 app = FastAPI()
-dataset = OrgDataset.load_instance('./orgs.pkl')
-vs = VectorSpace.load_instance('./test_vs.pkl')
-recommender = OrgRecommender(dataset, vs)
+# Each request reads registry.current() once and uses that snapshot
+# throughout, so a model reload never changes the model mid request.
+# Batch streams are the exception: they read it once per batch, since a
+# long stream would otherwise keep a retired snapshot alive and block
+# reloads.
+registry = ModelRegistry(MODEL_DIR, search_backend=SEARCH_BACKEND,
+    search_params=SEARCH_PARAMS)
+with metrics.startup_phase('model_load'):
+    registry.reload()
+
+# Recommendation results keyed on the model version and the user's
+# liked and disliked orgs (or tags). Cleared on every model swap.
+results = ResultCache(RESULT_CACHE_SIZE)
+registry.add_listener(lambda snapshot: results.clear())
+
+profiles = None
+if PROFILE_STORE_DIR:
+    with metrics.startup_phase('profile_store'):
+        profiles = ProfileStore.load(PROFILE_STORE_DIR, registry.current(),
+            PROFILE_STORE_TTL or None)
+    registry.add_listener(profiles.rebase)
+    if profiles.model_version is None:
+        # Saved for another model version. Requests fall back to
+        # Datastore profiles until the rebase is done.
+        threading.Thread(target=lambda: profiles.rebase(registry.current()),
+            name='profile-rebase', daemon=True).start()
+
+# Datastore calls and scoring are blocking, so they run on bounded
+# thread pools instead of the event loop. When a pool and its queue
+# are full, requests are rejected with a 503 rather than queued.
+io_pool = BoundedExecutor('datastore', IO_POOL_SIZE, POOL_QUEUE_SIZE)
+cpu_pool = BoundedExecutor('scoring', CPU_POOL_SIZE, POOL_QUEUE_SIZE)
+metrics.record_startup_phase('total', time.perf_counter() - _import_start)
+
+@app.exception_handler(PoolSaturatedError)
+async def pool_saturated_handler(request: Request, exc: PoolSaturatedError):
+    return JSONResponse(status_code=503, content={'detail': str(exc)},
+        headers={'Retry-After': '1'})
+
+# The paths of the routes, computed on the first request since the
+# routes are only registered below.
+route_paths = None
+
+def metric_path(request):
+    """Returns the request path for metric labels, or 'other' for
+    paths without a route, so unknown paths do not add labels.
+    """
+    global route_paths
+    if route_paths is None:
+        route_paths = frozenset(route.path for route in app.routes)
+    path = request.url.path
+    return path if path in route_paths else 'other'
+
+@app.middleware('http')
+async def time_request(request: Request, call_next):
+    token = metrics.start_request_timing()
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        elapsed = time.perf_counter() - start
+        timings = metrics.stop_request_timing(token)
+    metrics.REQUEST_SECONDS.observe(metric_path(request), elapsed)
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = metrics.server_timing_header(
+            timings + [('total', elapsed)])
+    return response
+
+@app.on_event('startup')
+def start_model_polling():
+    if MODEL_POLL_INTERVAL > 0:
+        registry.start_polling(MODEL_POLL_INTERVAL)
+
+@app.on_event('startup')
+def start_profile_saving():
+    if profiles is not None and PROFILE_SAVE_INTERVAL > 0:
+        profiles.start_saving(PROFILE_SAVE_INTERVAL)
+
+@app.on_event('startup')
+def warm_datastore_client():
+    """Creates the Datastore client in the background, so the
+    instance can serve before it exists but the first request
+    does not have to wait for it either.
+    """
+    def warm():
+        try:
+            with metrics.startup_phase('datastore_client'):
+                gcd_utils.get_client()
+        except Exception:
+            logger.exception('Creating the Datastore client failed.')
+
+    threading.Thread(target=warm, name='datastore-client', daemon=True).start()
+
+@app.on_event('shutdown')
+def shutdown_pools():
+    registry.stop_polling()
+    metrics.profiler.stop()
+    io_pool.shutdown(wait=False)
+    cpu_pool.shutdown(wait=False)
+    if profiles is not None:
+        profiles.close()
+
+@app.post('/reload_model/')
+async def reload_model():
+    """Loads the model artifact in MODEL_DIR in the background and
+    swaps it in once loaded, if its version differs from the one
+    being served.
+    """
+    registry.reload_async()
+    return {'modelVersion': registry.current().version}
+
+@app.get('/metrics')
+async def get_metrics():
+    """Latency histograms of the endpoints and of every stage, in
+    the Prometheus text format.
+    """
+    return PlainTextResponse(metrics.render_prometheus(),
+        media_type='text/plain; version=0.0.4')
+
+def debug_endpoints_disabled():
+    return JSONResponse(status_code=404, content={'detail': 'DEBUG_ENDPOINTS is not set.'})
+
+@app.get('/memory/')
+async def get_memory():
+    """Estimated bytes held by each component of the served vector
+    space, see VectorSpace.memory_report.
+    """
+    if not DEBUG_ENDPOINTS:
+        return debug_endpoints_disabled()
+    return registry.current().vs.memory_report()
 
-c = Clusterer(dataset, vs, 20)
-kw_finder = KeywordFinder(dataset, vs)
-matcher = KeywordMatcher(c, kw_finder, vs.data_centroid)
+@app.post('/profiler/')
+async def toggle_profiler(enabled: bool,
+        interval: float = Query(0.01, ge=metrics.MIN_PROFILER_INTERVAL)):
+    """Starts or stops the sampling profiler. Starting it discards
+    the stacks of the previous run.
+    """
+    if not DEBUG_ENDPOINTS:
+        return debug_endpoints_disabled()
+    if enabled:
+        metrics.profiler.start(interval)
+    else:
+        metrics.profiler.stop()
+    return {'running': metrics.profiler.running, 'samples': metrics.profiler.samples}
+
+@app.get('/profiler/')
+async def get_profile(limit: int = 200):
+    """Returns the stacks sampled by the profiler in the folded
+    format read by flame graph tools, most frequent first.
+    """
+    if not DEBUG_ENDPOINTS:
+        return debug_endpoints_disabled()
+    return PlainTextResponse(metrics.profiler.folded(limit))
+
+def init_recommend(snapshot, keywords, num_orgs):
+    orgids = snapshot.recommender.keyword_recommend(snapshot.matcher, keywords, num_orgs)
+    results.put(tags_key(keywords, snapshot.version), orgids, num_orgs)
+    return orgids
+
+def recommend_profiles(snapshot, profiles, num_orgs):
+    """Recommends orgs for several profiles and caches the
+    results. Results of users without known liked orgs are random
+    and are not cached.
+    """
+    recs = snapshot.recommender.recommend_for_profiles(profiles, num_orgs)
+    for profile, orgids in zip(profiles, recs):
+        if len(snapshot.dataset.get_indices_by_id(profile.liked_orgs)) > 0:
+            results.put(profile_key(profile, snapshot.version), orgids, num_orgs)
+    return recs
+
+def recommend_stored(snapshot, user_id, revision, num_orgs):
+    """Recommends orgs from the stored profile of a user and
+    caches the result, see recommend_profiles. Returns None if the
+    store cannot serve the profile for snapshot.
+    """
+    entry = profiles.query(user_id, snapshot.version)
+    if entry is None:
+        return None
+    query, excluded = entry
+    orgids = snapshot.recommender.recommend_for_queries([query], [excluded], num_orgs)[0]
+    if query is not None:
+        results.put(stored_profile_key(user_id, revision, snapshot.version), orgids, num_orgs)
+    return orgids
+
+async def stored_recommendations(snapshot, user_id, num_orgs):
+    """Recommendations for a user from the profile store. Users
+    are seeded from Datastore the first time they are seen and when
+    their stored profile expires. Falls back to the Datastore profile
+    while the store is busy or on another model version.
+    """
+    revision = profiles.revision(user_id, snapshot.version)
+    if revision is None:
+        # Seeds from a fresh profile rather than one cached for up to
+        # PROFILE_CACHE_TTL, so the staleness bound stays the TTL.
+        gcd_utils.invalidate_account_profile(user_id)
+        profile = await io_pool.run(get_account_profile, user_id)
+        await cpu_pool.run(profiles.seed, user_id, profile)
+        revision = profiles.revision(user_id, snapshot.version)
+        if revision is None:
+            return (await cpu_pool.run(recommend_profiles, snapshot, [profile], num_orgs))[0]
+    orgids = results.get(stored_profile_key(user_id, revision, snapshot.version), num_orgs)
+    if orgids is None:
+        orgids = await cpu_pool.run(recommend_stored, snapshot, user_id, revision, num_orgs)
+    if orgids is None:
+        profile = await io_pool.run(get_account_profile, user_id)
+        orgids = (await cpu_pool.run(recommend_profiles, snapshot, [profile], num_orgs))[0]
+    return orgids
 
 @app.get('/get_init_recs/')
-async def get_init_recs(userId: str, numOrgs: int):
-    keywords = get_account_liked_tags(userId)
-    centroid = matcher.get_kw_centroid(keywords)
-    orgids = recommender.centroid_recommend(centroid, numOrgs)
+async def get_init_recs(userId: str, numOrgs: int = Query(..., ge=1)):
+    snapshot = registry.current()
+    keywords = await io_pool.run(get_account_liked_tags, userId)
+    orgids = results.get(tags_key(keywords, snapshot.version), numOrgs)
+    if orgids is None:
+        orgids = await cpu_pool.run(init_recommend, snapshot, keywords, numOrgs)
     return_arr = []
     for id in orgids:
         entry = {'orgId': id}
@@ -32,13 +282,91 @@ http://127.0.0.1:8000/get_recommendations/?userId=334614c0-7f55-11ea-b1bc-2f9730
 """
 
 @app.get('/get_recommendations/')
-async def get_recommendations(userId: str, numOrgs: int):
-    random_id = dataset.get_random_org_ids(1)
-    orgids = recommender.recommend_orgs(userId, numOrgs)
+async def get_recommendations(userId: str, numOrgs: int = Query(..., ge=1)):
+    snapshot = registry.current()
+    random_id = snapshot.dataset.get_random_org_ids(1)
+    if profiles is not None:
+        orgids = await stored_recommendations(snapshot, userId, numOrgs)
+    else:
+        profile = await io_pool.run(get_account_profile, userId)
+        orgids = results.get(profile_key(profile, snapshot.version), numOrgs)
+        if orgids is None:
+            orgids = (await cpu_pool.run(recommend_profiles, snapshot, [profile], numOrgs))[0]
     return_arr = [{'orgId': random_id[0]}]
     for id in orgids:
         entry = {'orgId': id}
         return_arr.append(entry)
     return return_arr
 
+class BatchRecommendationRequest(BaseModel):
+    userIds: List[str]
+    numOrgs: conint(ge=1)
+
+def recommend_batch(user_ids, profiles, num_orgs):
+    """Recommends orgs for one batch of a batch stream with the
+    snapshot served at the time, see OrgRecommender.recommend_batch.
+    """
+    snapshot = registry.current()
+    return snapshot.recommender.recommend_batch(user_ids, profiles, num_orgs,
+        ProfileResultCache(results, snapshot.version))
+
+async def stream_batch_recommendations(user_ids, num_orgs):
+    for batch in batches(user_ids, BATCH_SIZE):
+        profiles = await io_pool.run(get_account_profiles, batch)
+        recs = await cpu_pool.run(recommend_batch, batch, profiles, num_orgs)
+        lines = []
+        for user_id, orgids in recs:
+            if orgids is not None:
+                entry = {'userId': user_id, 'orgIds': list(orgids)}
+            else:
+                entry = {'userId': user_id, 'error': 'unknown user'}
+            lines.append(json.dumps(entry) + '\n')
+        yield ''.join(lines)
+
+"""Streams recommendations for many users, one json object per
+line, e.g. for the nightly email job. Users are fetched and scored
+in batches of BATCH_SIZE. Each batch is scored with the model served
+at the time, so a model reload can take effect mid stream. Unlike
+/get_recommendations/, no random org is added to the results.
+
+Example body: {"userIds": ["334614c0-7f55-11ea-b1bc-2f9730f51173"], "numOrgs": 5}
+"""
+
+@app.post('/get_recommendations/batch/')
+async def get_batch_recommendations(body: BatchRecommendationRequest):
+    return StreamingResponse(
+        stream_batch_recommendations(body.userIds, body.numOrgs),
+        media_type='application/x-ndjson')
+
+class ProfileEvent(BaseModel):
+    userId: str
+    orgId: str
+    action: str
+
+"""Records that a user liked, disliked or removed an org, so the
+stored profile vector is updated in place instead of recomputed on
+the next request. Only available when PROFILE_STORE_DIR is set.
+action is one of 'like', 'dislike' and 'remove'.
+
+Example body: {"userId": "334614c0-7f55-11ea-b1bc-2f9730f51173", "orgId": "42", "action": "like"}
+"""
+
+@app.post('/profile_events/')
+async def post_profile_event(event: ProfileEvent):
+    if profiles is None:
+        return JSONResponse(status_code=404, content={'detail': 'PROFILE_STORE_DIR is not set.'})
+    if event.action not in ACTIONS:
+        return JSONResponse(status_code=400, content={
+            'detail': 'action must be one of {}.'.format(', '.join(ACTIONS))})
+    gcd_utils.invalidate_account_profile(event.userId)
+    applied = await cpu_pool.run(profiles.apply, event.userId, event.orgId, event.action)
+    if not applied:
+        # The Datastore profile may or may not include the event
+        # yet. Events are assignments, so applying it again is safe.
+        profile = await io_pool.run(get_account_profile, event.userId)
+        await cpu_pool.run(profiles.seed, event.userId, profile)
+        await cpu_pool.run(profiles.apply, event.userId, event.orgId, event.action)
+    return {'userId': event.userId, 'revision': profiles.revision(event.userId,
+        profiles.model_version)}
+
 #test_id = '2bd2e4a0-85ce-11ea-9f05-e3bd91f1b63a'
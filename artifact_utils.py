@@ -0,0 +1,162 @@
+"""
+Helpers for reading and writing model artifacts.
+
+An artifact is a directory holding one .npy file per array and a
+'manifest.json' file describing its contents. Arrays are always saved
+and loaded with allow_pickle=False, so loading an artifact never
+executes code, and numeric arrays can be memory-mapped so that several
+worker processes share the same pages. Strings are stored as a single
+utf-8 byte blob plus an array of offsets, and can be loaded either
+decoded or as a StringColumn that decodes them on access.
+"""
+import json
+import os
+import numpy as np
+
+ARTIFACT_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+
+
+def read_manifest(directory):
+    """Reads the manifest of the artifact in directory.
+
+    Args:
+        directory (str): the artifact directory.
+
+    Returns:
+        the manifest as a dictionary.
+
+    Raises:
+        ValueError: if the artifact was written with a different
+            artifact format version.
+    """
+    with open(os.path.join(directory, MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != ARTIFACT_VERSION:
+        raise ValueError('Artifact in {} has format version {}, expected {}.'
+            .format(directory, manifest.get('version'), ARTIFACT_VERSION))
+    return manifest
+
+
+def update_manifest(directory, section, values):
+    """Writes values under section in the manifest of the
+    artifact in directory, creating the directory and the
+    manifest if they do not exist yet.
+
+    Args:
+        directory (str): the artifact directory.
+        section (str): the manifest key to write to.
+        values (dict): json serializable values.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, MANIFEST_NAME)
+    if os.path.exists(path):
+        manifest = read_manifest(directory)
+    else:
+        manifest = {'version': ARTIFACT_VERSION}
+    manifest[section] = values
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def save_array(directory, name, array):
+    """Saves a numeric numpy array as directory/name.npy."""
+    np.save(os.path.join(directory, name + '.npy'),
+        np.ascontiguousarray(array), allow_pickle=False)
+
+
+def load_array(directory, name, mmap=True):
+    """Loads the array saved as directory/name.npy.
+
+    Args:
+        directory (str): the artifact directory.
+        name (str): the name the array was saved under.
+        mmap (bool): if True, the array is memory-mapped read only
+            instead of being read into memory.
+
+    Returns:
+        a numpy array.
+    """
+    return np.load(os.path.join(directory, name + '.npy'),
+        mmap_mode='r' if mmap else None, allow_pickle=False)
+
+
+def save_strings(directory, name, strings):
+    """Saves a sequence of strings as a utf-8 byte blob
+    (name.blob.npy) and an array of offsets (name.offsets.npy).
+    """
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    save_array(directory, name + '.blob', blob)
+    save_array(directory, name + '.offsets', offsets)
+
+
+def load_strings(directory, name, mmap=True):
+    """Loads strings saved with save_strings.
+
+    Returns:
+        a numpy object array of python strings.
+    """
+    blob = load_array(directory, name + '.blob', mmap).tobytes()
+    offsets = load_array(directory, name + '.offsets', mmap)
+    strings = np.empty(len(offsets) - 1, dtype=object)
+    for i in range(len(strings)):
+        strings[i] = blob[offsets[i]:offsets[i + 1]].decode('utf-8')
+    return strings
+
+
+def load_string_column(directory, name, mmap=True):
+    """Loads strings saved with save_strings without decoding
+    them, see StringColumn.
+    """
+    return StringColumn(load_array(directory, name + '.blob', mmap),
+        load_array(directory, name + '.offsets', mmap))
+
+
+class StringColumn:
+    """A read only sequence of strings stored as a utf-8 byte blob
+    plus offsets, decoded on access. When the arrays are
+    memory-mapped, worker processes share their pages and strings
+    that are never read cost no memory.
+
+    Indexing with an integer returns a str. Indexing with a slice,
+    an array of indices or a boolean mask returns a numpy object
+    array of the decoded strings, like indexing a numpy array does.
+
+    Attributes:
+        blob (numpy array): the uint8 bytes of all strings.
+        offsets (numpy array): the start of every string in blob,
+            followed by the length of blob.
+    """
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            row = range(len(self))[key]
+            return self._decode(row)
+        rows = np.arange(len(self))[key]
+        strings = np.empty(len(rows), dtype=object)
+        for i, row in enumerate(rows):
+            strings[i] = self._decode(row)
+        return strings
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self._decode(row)
+
+    def __array__(self, dtype=None, copy=None):
+        strings = self[:]
+        return strings if dtype is None else strings.astype(dtype)
+
+    def _decode(self, row):
+        return self.blob[self.offsets[row]:self.offsets[row + 1]].tobytes().decode('utf-8')
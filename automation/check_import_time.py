@@ -0,0 +1,83 @@
+"""
+Checks that importing the API stays fast: heavy modules must not be
+imported at startup, and the import phase must fit in a time budget.
+
+Runs `import api` in a fresh interpreter with -X importtime, prints
+the slowest top level imports and the startup phases recorded in
+metrics, and exits with status 1 if a check fails.
+
+Example:
+
+    python automation/check_import_time.py --model model --budget 1.5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+# Modules that are only needed for building models or talking to
+# Datastore, and are imported lazily by the serving code.
+FORBIDDEN_MODULES = ('sklearn', 'pandas', 'google.cloud')
+
+CODE = ('import json, sys; import api, metrics; '
+    'print(json.dumps({"phases": metrics.startup_report(), "modules": sorted(sys.modules)}))')
+
+
+def parse_importtime(stderr, depth=1):
+    """Returns (cumulative microseconds, module) tuples of the
+    imports in the -X importtime output that are nested at most depth
+    levels deep, e.g. the modules api imports directly for depth 1.
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Nested imports are indented by two spaces per level.
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        if level <= depth:
+            imports.append((int(cumulative), name.strip()))
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--model', default='model', help='the model artifact to load')
+    parser.add_argument('--budget', type=float, default=1.5,
+        help='the maximum seconds of the imports phase')
+    parser.add_argument('--top', type=int, default=10, help='the number of imports to print')
+    args = parser.parse_args()
+
+    env = dict(os.environ, MODEL_DIR=os.path.abspath(args.model))
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', CODE], cwd=ROOT, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if out.returncode != 0:
+        print(out.stderr, file=sys.stderr)
+        sys.exit(out.returncode)
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+
+    print('Slowest imports:')
+    for micros, name in sorted(parse_importtime(out.stderr), reverse=True)[:args.top]:
+        print('  {:>8.3f}s  {}'.format(micros / 1e6, name))
+    print('Startup phases:')
+    phases = dict(result['phases'])
+    for name, seconds in result['phases']:
+        print('  {:>8.3f}s  {}'.format(seconds, name))
+
+    failures = []
+    for forbidden in FORBIDDEN_MODULES:
+        if any(m == forbidden or m.startswith(forbidden + '.') for m in result['modules']):
+            failures.append('{} is imported at startup'.format(forbidden))
+    # -X importtime itself slows imports down a little.
+    if phases.get('imports', 0.0) > args.budget:
+        failures.append('the imports took {:.3f}s, the budget is {:.3f}s'.format(
+            phases['imports'], args.budget))
+    for failure in failures:
+        print('FAILED: ' + failure, file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
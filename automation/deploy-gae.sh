@@ -1 +1,3 @@
-gcloud --project aggieorgs-backend-270016 app deploy app.yaml
\ No newline at end of file
+python build_model.py --output model && \
+python automation/check_import_time.py --model model && \
+gcloud --project aggieorgs-backend-270016 app deploy app.yaml
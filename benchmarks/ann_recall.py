@@ -0,0 +1,102 @@
+"""
+Reports recall@k and latency of the approximate search backends in
+ann_index against exact search.
+
+Queries are the stored embeddings of randomly chosen orgs and
+centroids of random groups of orgs, which resemble user profiles. The
+org a query was built from is excluded, like the liked orgs in
+OrgRecommender.
+
+Example:
+
+    python benchmarks/ann_recall.py --model ./model --k 10
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from ann_index import make_searcher
+from model_registry import ModelSnapshot
+
+KNOBS = {
+    'inverted': ('max_terms', [4, 8, 16, 32, 64, None]),
+    'ivf': ('n_probe', [1, 2, 3, 5, 8]),
+}
+
+
+def make_queries(vs, n_queries, group_size, rng):
+    """Returns (queries, excluded rows) for the benchmark."""
+    active = np.flatnonzero(vs.data.active)
+    single = rng.choice(active, n_queries // 2)
+    groups = [rng.choice(active, group_size, replace=False)
+        for _ in range(n_queries - len(single))]
+    queries = [vs.get_org_vectors([row]) for row in single]
+    queries += [vs.get_org_vectors(group).mean(axis=0) for group in groups]
+    excluded = [[row] for row in single] + [list(group) for group in groups]
+    return queries, excluded
+
+
+def run_queries(vs, queries, excluded, k):
+    results = []
+    latencies = []
+    for query, rows in zip(queries, excluded):
+        start = time.perf_counter()
+        indices, _ = vs.get_nearest_indices(query, k, exclude=rows)
+        latencies.append(time.perf_counter() - start)
+        results.append(indices[0])
+    return results, np.array(latencies)
+
+
+def summarize(results, truth, latencies, k):
+    recalls = [len(np.intersect1d(r, t)) / max(len(t), 1) for r, t in zip(results, truth)]
+    return {
+        'recall_at_k': float(np.mean(recalls)),
+        'p50_ms': float(np.percentile(latencies, 50) * 1000),
+        'p99_ms': float(np.percentile(latencies, 99) * 1000),
+        'k': k,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--model', default='./model', help='model artifact directory')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--group-size', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='optional json file for the results')
+    args = parser.parse_args()
+
+    snapshot = ModelSnapshot.load(args.model)
+    vs = snapshot.vs
+    rng = np.random.RandomState(args.seed)
+    queries, excluded = make_queries(vs, args.queries, args.group_size, rng)
+
+    truth, latencies = run_queries(vs, queries, excluded, args.k)
+    report = [dict(summarize(truth, truth, latencies, args.k), backend='exact')]
+    for backend, (knob, values) in KNOBS.items():
+        for value in values:
+            vs.set_search_backend(make_searcher(backend, vs, snapshot.clusterer, **{knob: value}))
+            results, latencies = run_queries(vs, queries, excluded, args.k)
+            report.append(dict(summarize(results, truth, latencies, args.k),
+                backend=backend, **{knob: value}))
+    vs.set_search_backend(None)
+
+    print('{:<10} {:<16} {:>10} {:>9} {:>9}'.format('backend', 'knob', 'recall@k', 'p50 ms', 'p99 ms'))
+    for row in report:
+        knob = ', '.join('{}={}'.format(name, row[name])
+            for name in ('max_terms', 'n_probe') if name in row)
+        print('{:<10} {:<16} {:>10.3f} {:>9.3f} {:>9.3f}'.format(
+            row['backend'], knob, row['recall_at_k'], row['p50_ms'], row['p99_ms']))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Compares the clustering algorithms of Clusterer: fit time, peak
+memory traced during the fit, and cluster quality.
+
+Quality is reported as the mean cosine similarity of each org to its
+cluster centroid (cohesion), the cosine silhouette score, and the
+agreement of each algorithm's labels with the spectral baseline
+(adjusted Rand index and normalized mutual information).
+
+Example:
+
+    python benchmarks/cluster_quality.py --dataset ./orgs.pkl --clusters 20
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+from sklearn.metrics import adjusted_rand_score, normalized_mutual_info_score, silhouette_score
+from sklearn.preprocessing import normalize
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from clusterer import Clusterer
+from org_dataset import OrgDataset
+from vector_space import VectorSpace
+
+
+def fit(dataset, vs, algorithm, n_clusters, seed):
+    """Returns (clusterer, seconds, peak traced MiB) of one fit."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    c = Clusterer(dataset, vs, n_clusters, random_state=seed, algorithm=algorithm)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return c, seconds, peak / 2 ** 20
+
+
+def cohesion(vecs, c):
+    centroids = normalize(np.asarray(c.centroids))
+    sims = np.asarray(vecs.multiply(centroids[c.labels]).sum(axis=1)).ravel()
+    return float(sims.mean())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--dataset', default=None,
+        help='pickled OrgDataset, defaults to fetching from Datastore')
+    parser.add_argument('--clusters', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='optional json file for the results')
+    args = parser.parse_args()
+
+    if args.dataset is not None:
+        dataset = OrgDataset.load_instance(args.dataset)
+    else:
+        from gcd_utils import get_org_dataset
+        dataset = get_org_dataset()
+    vs = VectorSpace(dataset)
+    vecs = normalize(vs.get_org_vectors())
+
+    report = []
+    baseline = None
+    for algorithm in Clusterer.ALGORITHMS:
+        c, seconds, peak = fit(dataset, vs, algorithm, args.clusters, args.seed)
+        if baseline is None:
+            baseline = c.labels
+        report.append({
+            'algorithm': algorithm,
+            'fit_s': seconds,
+            'peak_mib': peak,
+            'cohesion': cohesion(vecs, c),
+            'silhouette': float(silhouette_score(vecs, c.labels, metric='cosine',
+                random_state=args.seed)),
+            'ari_vs_spectral': float(adjusted_rand_score(baseline, c.labels)),
+            'nmi_vs_spectral': float(normalized_mutual_info_score(baseline, c.labels)),
+            'orgs': len(dataset),
+            'clusters': args.clusters,
+        })
+
+    print('{:<10} {:>8} {:>9} {:>9} {:>10} {:>6} {:>6}'.format(
+        'algorithm', 'fit s', 'peak MiB', 'cohesion', 'silhouette', 'ARI', 'NMI'))
+    for row in report:
+        print('{:<10} {:>8.2f} {:>9.1f} {:>9.3f} {:>10.3f} {:>6.3f} {:>6.3f}'.format(
+            row['algorithm'], row['fit_s'], row['peak_mib'], row['cohesion'],
+            row['silhouette'], row['ari_vs_spectral'], row['nmi_vs_spectral']))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,340 @@
+"""
+Benchmarks the recommendation hot paths and stores the results as
+JSON, so runs on different commits can be compared.
+
+Every benchmark reports p50/p99/mean latency, throughput and the peak
+RSS of the process so far. Each scale runs in its own process, so the
+peak RSS of one scale does not leak into the next. Scales above 1
+grow the bundled orgs.pkl synthetically: every org is copied with a
+new id and part of its description replaced by words drawn from the
+rest of the corpus. User profiles live in a fake_datastore client.
+
+Example, running the 1x, 10x and 100x scales and comparing with the
+results of an earlier commit:
+
+    python benchmarks/run_benchmarks.py --scales 1,10,100
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/abc1234.json
+"""
+import argparse
+import inspect
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+import build_model
+import gcd_utils
+from clusterer import Clusterer
+from fake_datastore import FakeDatastoreClient
+from keyword_finder import KeywordFinder
+from keyword_matcher import KeywordMatcher
+from org_dataset import OrgDataset
+from org_recommender import OrgRecommender
+from top_lists import TopLists
+from vector_space import VectorSpace
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def peak_rss_mib():
+    """Returns the peak resident set size of this process. On Linux
+    this is VmHWM: ru_maxrss survives fork and exec there, so a child
+    started by a large benchmark process would report the parent's
+    peak, while VmHWM is reset by exec.
+    """
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2 ** 10
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+
+def summarize(times, items=1):
+    """Returns the latency statistics of a list of run times in
+    seconds. items is the number of operations per run.
+    """
+    times = np.asarray(times)
+    return {
+        'runs': len(times),
+        'p50_ms': float(np.percentile(times, 50) * 1000),
+        'p99_ms': float(np.percentile(times, 99) * 1000),
+        'mean_ms': float(times.mean() * 1000),
+        'throughput_per_s': float(items * len(times) / max(times.sum(), 1e-12)),
+        'peak_rss_mib': peak_rss_mib(),
+    }
+
+
+def measure(fn, repeat, warmup=1, items=1):
+    """Times repeat calls of fn() after warmup untimed calls. fn
+    receives the index of the call.
+    """
+    for i in range(warmup):
+        fn(i)
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn(i)
+        times.append(time.perf_counter() - start)
+    return summarize(times, items)
+
+
+def scale_dataset(dataset, factor, rng, replaced=0.3):
+    """Returns a dataset with factor times the orgs of dataset.
+    The original orgs come first, followed by factor - 1 perturbed
+    copies of each, in which a replaced fraction of the words is
+    swapped for words drawn from the whole corpus.
+    """
+    if factor == 1:
+        return dataset
+    words = np.array(' '.join(dataset.purposes).split(), dtype=object)
+    ids, names, purposes = list(dataset.ids), list(dataset.names), list(dataset.purposes)
+    for copy in range(1, factor):
+        for org_id, name, purpose in zip(dataset.ids, dataset.names, dataset.purposes):
+            tokens = np.array(purpose.split(), dtype=object)
+            swap = rng.random_sample(len(tokens)) < replaced
+            tokens[swap] = words[rng.randint(0, len(words), swap.sum())]
+            ids.append('{}-{}'.format(org_id, copy))
+            names.append(name)
+            purposes.append(' '.join(tokens))
+    scaled = OrgDataset()
+    scaled.add_columns(ids, names, purposes)
+    return scaled
+
+
+def setup_datastore(dataset, n_users, rng):
+    """Installs a fake Datastore client holding n_users accounts
+    with random liked and disliked orgs. Returns the user ids.
+    """
+    fake = FakeDatastoreClient()
+    user_ids = ['user-{}'.format(i) for i in range(n_users)]
+    for user_id in user_ids:
+        liked = dataset.get_random_org_ids(rng.randint(1, 11))
+        disliked = dataset.get_random_org_ids(rng.randint(0, 4))
+        fake.put('account', {'userId': user_id, 'userInterestOrgsId': list(liked),
+            'userDislikeOrgsId': list(disliked), 'userInterestTags': []})
+    gcd_utils.set_client(fake)
+    return user_ids
+
+
+def cold_start(model_dir, repeat):
+    """Times importing api, which loads the model artifact, in a
+    fresh interpreter.
+    """
+    code = ('import os, resource, sys, time; start = time.perf_counter(); import api; '
+        'print(time.perf_counter() - start)\n{}\nprint(peak_rss_mib())'.format(
+            inspect.getsource(peak_rss_mib)))
+    env = dict(os.environ, MODEL_DIR=model_dir)
+    times, peaks = [], []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env,
+            check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        seconds, peak = out.split()[-2:]
+        times.append(float(seconds))
+        peaks.append(float(peak))
+    result = summarize(times)
+    result['peak_rss_mib'] = max(peaks)
+    return result
+
+
+def run_scale(args, factor):
+    """Runs every benchmark on the dataset grown by factor and
+    returns {benchmark name: statistics}.
+    """
+    rng = np.random.RandomState(args.seed)
+    dataset = scale_dataset(OrgDataset.load_instance(args.dataset), factor, rng)
+    repeat = args.repeat
+    results = {'orgs': len(dataset)}
+
+    start = time.perf_counter()
+    if args.vs is not None and factor == 1:
+        vs = VectorSpace.load_instance(args.vs)
+        dataset = vs.data
+    else:
+        vs = VectorSpace(dataset)
+    results['vector_space_fit'] = summarize([time.perf_counter() - start])
+
+    for algorithm in Clusterer.ALGORITHMS:
+        if algorithm == 'spectral' and len(dataset) > args.max_spectral_orgs:
+            results['clusterer_init_spectral'] = {'skipped': 'more than {} orgs'.format(
+                args.max_spectral_orgs)}
+            continue
+        times = []
+        for _ in range(args.cluster_repeat):
+            start = time.perf_counter()
+            c = Clusterer(dataset, vs, args.clusters, random_state=args.seed, algorithm=algorithm)
+            times.append(time.perf_counter() - start)
+        results['clusterer_init_' + algorithm] = summarize(times)
+    matcher = KeywordMatcher(c, KeywordFinder(dataset, vs), vs.data_centroid)
+    start = time.perf_counter()
+    top_lists = TopLists.build(vs, np.vstack([c.centroids,
+        np.asarray(vs.data_centroid).reshape(1, -1)]))
+    results['top_lists_build'] = summarize([time.perf_counter() - start])
+    recommender = OrgRecommender(dataset, vs, top_lists)
+
+    descriptions = dataset.get_org_descriptions(rng.randint(0, len(dataset), repeat + 1))
+    results['transform_single'] = measure(lambda i: vs.transform([descriptions[i]]), repeat)
+    batch = list(dataset.get_org_descriptions(rng.randint(0, len(dataset), args.batch_size)))
+    results['transform_batch'] = measure(lambda i: vs.transform(batch),
+        max(repeat // 10, 3), items=len(batch))
+
+    queries = vs.get_org_vectors(rng.randint(0, len(dataset), repeat + 1))
+    results['get_nearest_orgs'] = measure(lambda i: vs.get_nearest_orgs(queries[i], 10), repeat)
+
+    user_ids = setup_datastore(dataset, args.users, rng)
+
+    def recommend(i):
+        gcd_utils.clear_profile_cache()
+        recommender.recommend_orgs(user_ids[i % len(user_ids)], 10)
+
+    results['recommend_orgs'] = measure(recommend, repeat)
+    results['recommend_orgs_cached'] = measure(
+        lambda i: recommender.recommend_orgs(user_ids[i % len(user_ids)], 10), repeat,
+        warmup=len(user_ids))
+
+    keywords = list(matcher.keyword_index)
+    keyword_sets = [list(rng.choice(keywords, rng.randint(1, 4))) for _ in range(repeat + 1)]
+    results['get_kw_centroid'] = measure(lambda i: matcher.get_kw_centroid(keyword_sets[i]),
+        repeat)
+    centroids = [matcher.get_kw_centroid(kws) for kws in keyword_sets]
+    results['centroid_recommend'] = measure(
+        lambda i: recommender.centroid_recommend(centroids[i], 10), repeat)
+    results['keyword_recommend'] = measure(
+        lambda i: recommender.keyword_recommend(matcher, keyword_sets[i], 10), repeat)
+
+    if args.cold_start_repeat > 0:
+        with tempfile.TemporaryDirectory() as tmp:
+            model_dir = os.path.join(tmp, 'model')
+            build_model.write_artifact(model_dir, vs, c, matcher, {'benchmark_scale': factor})
+            results['api_cold_start'] = cold_start(model_dir, args.cold_start_repeat)
+
+    results['vector_space_bytes'] = vs.memory_report()['total']
+    vs.compact()
+    results['vector_space_compact_bytes'] = vs.memory_report()['total']
+    results['get_nearest_orgs_compact'] = measure(
+        lambda i: vs.get_nearest_orgs(queries[i], 10), repeat)
+    return results
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=ROOT, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty.strip() else '')
+
+
+def compare(current, previous):
+    """Prints the p50 latency of every benchmark in current
+    relative to previous.
+    """
+    print('\ncompared with {}:'.format(previous['commit']))
+    for scale, results in sorted(current['scales'].items(), key=lambda item: int(item[0])):
+        old = previous['scales'].get(scale, {})
+        for name, stats in results.items():
+            if not isinstance(stats, dict) or 'p50_ms' not in stats:
+                continue
+            if 'p50_ms' not in old.get(name, {}):
+                continue
+            ratio = stats['p50_ms'] / max(old[name]['p50_ms'], 1e-9)
+            print('{:>4}x {:<28} {:>9.3f} ms -> {:>9.3f} ms  ({:.2f}x)'.format(
+                scale, name, old[name]['p50_ms'], stats['p50_ms'], ratio))
+
+
+def print_results(report):
+    print('{:>5} {:<28} {:>10} {:>10} {:>12} {:>9}'.format(
+        'scale', 'benchmark', 'p50 ms', 'p99 ms', 'ops/s', 'RSS MiB'))
+    for scale, results in sorted(report['scales'].items(), key=lambda item: int(item[0])):
+        for name, stats in results.items():
+            if name.endswith('_bytes'):
+                print('{:>4}x {:<28} {:>10.1f} MiB'.format(scale, name, stats / 2 ** 20))
+                continue
+            if not isinstance(stats, dict):
+                continue
+            if 'skipped' in stats:
+                print('{:>4}x {:<28} skipped, {}'.format(scale, name, stats['skipped']))
+                continue
+            print('{:>4}x {:<28} {:>10.3f} {:>10.3f} {:>12.1f} {:>9.1f}'.format(
+                scale, name, stats['p50_ms'], stats['p99_ms'],
+                stats['throughput_per_s'], stats['peak_rss_mib']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--dataset', default=os.path.join(ROOT, 'orgs.pkl'),
+        help='pickled OrgDataset to benchmark with')
+    parser.add_argument('--vs', default=None,
+        help='pickled VectorSpace to use at scale 1 instead of fitting one,'
+            ' e.g. test_vs.pkl')
+    parser.add_argument('--scales', default='1,10',
+        help='comma separated dataset scale factors')
+    parser.add_argument('--repeat', type=int, default=200,
+        help='timed runs per latency benchmark')
+    parser.add_argument('--cluster-repeat', type=int, default=1,
+        help='timed runs of Clusterer.__init__')
+    parser.add_argument('--cold-start-repeat', type=int, default=3,
+        help='timed api imports, 0 skips the cold start benchmark')
+    parser.add_argument('--batch-size', type=int, default=100,
+        help='descriptions per transform_batch run')
+    parser.add_argument('--users', type=int, default=200,
+        help='accounts in the fake Datastore')
+    parser.add_argument('--clusters', type=int, default=20)
+    parser.add_argument('--max-spectral-orgs', type=int, default=20000,
+        help='skip spectral clustering above this many orgs, its memory is quadratic')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None,
+        help='json file for the results, defaults to benchmarks/results/<commit>.json')
+    parser.add_argument('--compare', default=None,
+        help='results json of an earlier run to compare with')
+    parser.add_argument('--single-scale', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single_scale is not None:
+        json.dump(run_scale(args, args.single_scale), sys.stdout)
+        return
+
+    report = {
+        'commit': git_commit(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'args': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        'scales': {},
+    }
+    # Every scale runs in a child process so peak RSS is per scale.
+    child_args = list(sys.argv[1:])
+    for factor in [int(s) for s in args.scales.split(',')]:
+        out = subprocess.run([sys.executable, os.path.abspath(__file__)] + child_args
+            + ['--single-scale', str(factor)], check=True, stdout=subprocess.PIPE,
+            universal_newlines=True).stdout
+        report['scales'][str(factor)] = json.loads(out.strip().splitlines()[-1])
+
+    print_results(report)
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, '{}.json'.format(report['commit']))
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('\nresults written to {}'.format(output))
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
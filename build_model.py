@@ -0,0 +1,217 @@
+"""
+Offline build step for the org recommender model.
+
+Fits the vector space, clusters the orgs, computes the cluster
+centroids and keywords, ranks the top orgs of every centroid (see
+top_lists.py), and writes everything to a single model artifact (see artifact_utils). The API only loads the artifact, so
+none of this work happens at process startup and every replica
+serves the same clusters.
+
+Example, building from Datastore:
+
+    python build_model.py --output ./model
+
+Example, building from a pickled OrgDataset:
+
+    python build_model.py --dataset ./orgs.pkl --output ./model
+
+Example, applying the day's new, changed and removed orgs to an
+existing artifact without refitting:
+
+    python build_model.py --update --output ./model
+"""
+import argparse
+import os
+import shutil
+import time
+import uuid
+import numpy as np
+import artifact_utils
+import fast_tfidf
+from org_dataset import OrgDataset
+from vector_space import VectorSpace
+from clusterer import Clusterer
+from keyword_finder import KeywordFinder
+from keyword_matcher import KeywordMatcher
+from top_lists import TopLists, TOP_LIST_SIZE
+
+PARITY_SAMPLE = 5000
+
+
+def build_model(dataset, output, n_clusters=20, words_per_cluster=5, random_state=0,
+        n_components=None, algorithm='spectral', top_list_size=TOP_LIST_SIZE, compact=False):
+    """Builds a model artifact from dataset and writes it to
+    output. See write_artifact.
+
+    Args:
+        dataset (OrgDataset): the orgs to build the model from.
+        output (str): the artifact directory to write.
+        n_clusters (int): the number of clusters to generate.
+        words_per_cluster (int): the number of keywords used to
+            label each cluster.
+        random_state (int): seed for the clustering algorithm.
+        n_components (int, optional): the number of dimensions of
+            the reduced search space, see VectorSpace. None searches
+            the tfidf space.
+        algorithm (str): the clustering algorithm, 'spectral' or
+            'kmeans', see Clusterer.
+        top_list_size (int): the number of orgs ranked for every
+            cluster centroid and for the data centroid.
+        compact (bool): whether to store the vector space in the
+            compact float32 format, see VectorSpace.compact. The
+            model is still fit in float64.
+
+    Returns:
+        the model version string recorded in the manifest.
+    """
+    vs = VectorSpace(dataset, n_components=n_components)
+    if vs._fast is not None:
+        # The corpus was embedded with the fast transform; make sure it
+        # matches the vectorizer before the artifact is written.
+        sample = np.random.RandomState(random_state).permutation(len(dataset))[:PARITY_SAMPLE]
+        fast_tfidf.check_parity(vs.vectorizer, dataset.get_org_descriptions(sample))
+    c = Clusterer(dataset, vs, n_clusters, random_state=random_state, algorithm=algorithm)
+    kw_finder = KeywordFinder(dataset, vs)
+    matcher = KeywordMatcher(c, kw_finder, vs.data_centroid, words_per_cluster)
+    if compact:
+        vs.compact()
+    return write_artifact(output, vs, c, matcher, {
+        'random_state': random_state,
+        'words_per_cluster': words_per_cluster,
+    }, top_list_size)
+
+
+def update_model(dataset, output, n_clusters=20, words_per_cluster=5, random_state=0,
+        n_components=None, algorithm='spectral', top_list_size=TOP_LIST_SIZE, compact=False):
+    """Updates the model artifact in output to match dataset
+    without refitting, see VectorSpace.sync_orgs. New orgs are
+    embedded with the existing vocabulary and assigned to the
+    existing clusters (see Clusterer.label_new_orgs). If the
+    changes since the last full build cross the
+    VectorSpace.needs_refit thresholds, a full build is done
+    instead, keeping the artifact's n_components, clustering
+    algorithm and compact format. If no org changed and the top
+    lists already have top_list_size entries, the artifact is left
+    as is, so serving instances do not reload an identical model.
+
+    Args:
+        See build_model. n_components, algorithm and compact only
+        apply when no artifact exists yet.
+
+    Returns:
+        a tuple (model version, whether a full build was done). The
+        version is the existing one if the artifact was left as is.
+    """
+    if not os.path.isdir(output):
+        return build_model(dataset, output, n_clusters, words_per_cluster, random_state,
+            n_components, algorithm, top_list_size, compact), True
+    manifest = artifact_utils.read_manifest(output)
+    vs = VectorSpace.load_artifact(output, mmap=False)
+    added, removed, updated = vs.sync_orgs(dataset)
+    if (added, removed, updated) == (0, 0, 0) and \
+            manifest.get('top_lists', {}).get('k') == top_list_size:
+        return manifest['build']['model_version'], False
+    if vs.needs_refit():
+        return build_model(dataset.compact(), output, n_clusters, words_per_cluster,
+            random_state, vs.n_components, manifest['clusters'].get('algorithm', 'spectral'),
+            top_list_size, vs.compacted), True
+    c = Clusterer.load_artifact(output, vs.data, vs, mmap=False)
+    c.label_new_orgs()
+    matcher = KeywordMatcher.load_artifact(output, c, vs.data_centroid, mmap=False)
+    build_info = dict(manifest['build'])
+    build_info['incremental_update'] = {'added': added, 'removed': removed, 'updated': updated}
+    return write_artifact(output, vs, c, matcher, build_info, top_list_size), False
+
+
+def write_artifact(output, vs, clusterer, matcher, build_info, top_list_size=TOP_LIST_SIZE):
+    """Writes a model artifact to output. The artifact is written
+    to a temporary directory first and moved into place once
+    complete, so a reader never sees a partially written artifact.
+
+    Args:
+        output (str): the artifact directory to write.
+        vs (VectorSpace): the vector space, including its dataset.
+        clusterer (Clusterer): the clusters of the orgs in vs.
+        matcher (KeywordMatcher): the keywords of the clusters.
+        build_info (dict): extra values for the 'build' section
+            of the manifest.
+        top_list_size (int): the length of the top lists ranked
+            for the cluster centroids and the data centroid.
+
+    Returns:
+        the model version string recorded in the manifest.
+    """
+    tmp_output = output.rstrip(os.sep) + '.tmp'
+    if os.path.exists(tmp_output):
+        shutil.rmtree(tmp_output)
+    vs.save_artifact(tmp_output)
+    clusterer.save_artifact(tmp_output)
+    matcher.save_artifact(tmp_output)
+    centroids = np.vstack([clusterer.centroids, np.asarray(vs.data_centroid).reshape(1, -1)])
+    TopLists.build(vs, centroids, top_list_size).save_artifact(tmp_output)
+    model_version = '{}-{}'.format(time.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:8])
+    build_info = dict(build_info, model_version=model_version, built_at=time.time())
+    artifact_utils.update_manifest(tmp_output, 'build', build_info)
+    old_output = output.rstrip(os.sep) + '.old'
+    if os.path.exists(output):
+        if os.path.exists(old_output):
+            shutil.rmtree(old_output)
+        os.rename(output, old_output)
+    os.rename(tmp_output, output)
+    if os.path.exists(old_output):
+        shutil.rmtree(old_output)
+    return model_version
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the org recommender model artifact.')
+    parser.add_argument('--output', default='./model',
+        help='directory to write the artifact to')
+    parser.add_argument('--dataset', default=None,
+        help='pickled OrgDataset to build from, defaults to fetching from Datastore')
+    parser.add_argument('--checkpoint', default=None,
+        help='file to checkpoint the Datastore fetch to, a failed fetch resumes from it')
+    parser.add_argument('--clusters', type=int, default=20,
+        help='number of clusters')
+    parser.add_argument('--words-per-cluster', type=int, default=5,
+        help='number of keywords labeling each cluster')
+    parser.add_argument('--random-state', type=int, default=0,
+        help='clustering seed')
+    parser.add_argument('--components', type=int, default=None,
+        help='search a TruncatedSVD (LSA) space of this many dimensions'
+            ' instead of the tfidf space')
+    parser.add_argument('--algorithm', choices=Clusterer.ALGORITHMS, default='spectral',
+        help='clustering algorithm, kmeans scales to large corpora')
+    parser.add_argument('--top-list-size', type=int, default=TOP_LIST_SIZE,
+        help='number of orgs precomputed for every cluster, larger lists let more'
+            ' initial recommendation requests skip scoring every org')
+    parser.add_argument('--compact', action='store_true',
+        help='store the tfidf matrix as float32 and drop training only state,'
+            ' which roughly halves the memory of each serving worker')
+    parser.add_argument('--update', action='store_true',
+        help='update the existing artifact in --output instead of rebuilding it,'
+            ' unless the orgs changed enough to need a refit')
+    args = parser.parse_args()
+
+    if args.dataset is not None:
+        dataset = OrgDataset.load_instance(args.dataset)
+    else:
+        from gcd_utils import get_org_dataset
+        dataset = get_org_dataset(checkpoint=args.checkpoint)
+    start = time.time()
+    if args.update:
+        model_version, rebuilt = update_model(dataset, args.output, args.clusters,
+            args.words_per_cluster, args.random_state, args.components, args.algorithm,
+            args.top_list_size, args.compact)
+    else:
+        model_version = build_model(dataset, args.output, args.clusters,
+            args.words_per_cluster, args.random_state, args.components, args.algorithm,
+            args.top_list_size, args.compact)
+        rebuilt = True
+    print('{} model {} with {} orgs in {} ({:.1f}s)'.format(
+        'Built' if rebuilt else 'Updated', model_version, dataset.active_count(),
+        args.output, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
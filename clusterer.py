@@ -1,16 +1,33 @@
-from sklearn.cluster import SpectralClustering
+from vector_space import normalize_rows
+import artifact_utils
+import scipy.sparse as sp
 import numpy as np
 
 
 class Clusterer:
     """This class encapsulates functionality of clustering
-    organizations. The clustering algorithm this class uses
-    is Spectral Clustering.
+    organizations. Two clustering algorithms are available:
+
+        'spectral': Spectral Clustering with an RBF affinity. It
+            builds a dense org x org affinity matrix, so it only
+            suits small corpora.
+        'kmeans': spherical k-means, i.e. MiniBatchKMeans on the L2
+            normalized org vectors. Memory grows linearly with the
+            number of orgs, and new orgs can be folded in with
+            partial_fit. The centroids are the means of the
+            normalized vectors, and new orgs go to the nearest one
+            by Euclidean distance, the rule the fit uses.
 
     Attributes:
+        algorithm (str): 'spectral' or 'kmeans'.
         cluster_count (int): The number of clusters generated.
             This will be equal to the value passed for 'n_clusters'
             in __init__.
+        labels (array): a numpy array of integers holding the
+            cluster label of each org, indexed by row.
+        centroids (array): a dense (cluster_count x vocabulary size)
+            numpy array. Row i is the centroid of cluster i. The
+            centroids are computed once, when clustering finishes.
         _dataset (OrgDataset): an OrgDataset instance holding
             the organizations you wish to cluster.
         _vs (VectorSpace): a VectorSpace instance. This instance
@@ -18,18 +35,112 @@ class Clusterer:
             instance.
     """
 
-    def __init__(self, org_dataset, org_vectorspace, n_clusters=10):
+    ALGORITHMS = ('spectral', 'kmeans')
+    KMEANS_BATCH_SIZE = 1024
+
+    def __init__(self, org_dataset, org_vectorspace, n_clusters=10, random_state=None,
+            algorithm='spectral'):
         """Initializes instance. Note that clustering is performed
         in this function.
+
+        Args:
+            random_state (int, optional): seed passed to the
+                clustering algorithm. Set it to get the same clusters
+                on every run.
+            algorithm (str): the clustering algorithm, see the class
+                documentation.
         """
+        if algorithm not in self.ALGORITHMS:
+            raise ValueError('Unknown clustering algorithm: {}'.format(algorithm))
         self._dataset = org_dataset
         self._vs = org_vectorspace
         self.cluster_count = n_clusters
-        org_descs = self._dataset.get_org_descriptions()
-        vecs = self._vs.transform(org_descs)
-        labels = SpectralClustering(n_clusters=n_clusters).fit_predict(vecs)
-        self.df = self._dataset.dataframe
-        self.df['clusters'] = labels
+        self.algorithm = algorithm
+        from sklearn.cluster import SpectralClustering, MiniBatchKMeans
+        vecs = self._vs.get_org_vectors()
+        if algorithm == 'kmeans':
+            vecs = normalize_rows(vecs)
+            labels = MiniBatchKMeans(n_clusters=n_clusters, batch_size=self.KMEANS_BATCH_SIZE,
+                n_init=3, random_state=random_state).fit_predict(vecs)
+        else:
+            labels = SpectralClustering(n_clusters=n_clusters,
+                random_state=random_state).fit_predict(vecs)
+        self.labels = labels
+        self.centroids = self._compute_centroids(vecs)
+
+    def _compute_centroids(self, vecs):
+        """Computes the centroid of every cluster with a single
+        sparse matrix product.
+
+        Args:
+            vecs (scipy csr matrix): the embeddings of the clustered
+                orgs, one row per org in the same order as labels.
+
+        Returns:
+            a dense numpy array with one centroid per row.
+        """
+        counts = np.bincount(self.labels, minlength=self.cluster_count)
+        weights = 1.0 / np.maximum(counts, 1)[self.labels]
+        membership = sp.csr_matrix((weights, (self.labels, np.arange(len(self.labels)))),
+            shape=(self.cluster_count, len(self.labels)))
+        return np.asarray((membership @ vecs).todense())
+
+    def label_new_orgs(self):
+        """Assigns the orgs added to the vector space since
+        clustering (see VectorSpace.add_orgs) to the cluster whose
+        centroid is most similar to them. With the 'kmeans'
+        algorithm the centroids are updated as well, see
+        partial_fit. Otherwise they are left as they are until the
+        next full clustering.
+        """
+        start = len(self.labels)
+        if start >= len(self._dataset):
+            return
+        new_vecs = self._vs.get_org_vectors(np.arange(start, len(self._dataset)))
+        if self.algorithm == 'kmeans':
+            self.partial_fit(new_vecs)
+            return
+        self.labels = np.concatenate([self.labels, self._nearest_clusters(new_vecs)])
+
+    def partial_fit(self, vecs):
+        """Folds new orgs into the clusters with a mini-batch
+        k-means step: each org is appended to labels with the
+        cluster whose centroid is most similar, and every centroid
+        becomes the mean of its old and new members. The cost only
+        depends on the number of new orgs.
+
+        Args:
+            vecs (scipy csr matrix): the embeddings of the orgs that
+                follow the already labeled rows, in row order.
+
+        Returns:
+            the labels of the new orgs.
+        """
+        vecs = normalize_rows(vecs)
+        new_labels = self._nearest_clusters(vecs)
+        counts = np.bincount(self.labels, minlength=self.cluster_count)
+        new_counts = np.bincount(new_labels, minlength=self.cluster_count)
+        membership = sp.csr_matrix((np.ones(len(new_labels)),
+            (new_labels, np.arange(len(new_labels)))),
+            shape=(self.cluster_count, len(new_labels)))
+        sums = self.centroids * counts[:, np.newaxis] + np.asarray((membership @ vecs).todense())
+        self.centroids = sums / np.maximum(counts + new_counts, 1)[:, np.newaxis]
+        self.labels = np.concatenate([self.labels, new_labels])
+        return new_labels
+
+    def _nearest_clusters(self, vecs):
+        """Returns the label of the cluster closest to each row of
+        vecs: by Euclidean distance to the centroids with 'kmeans',
+        like MiniBatchKMeans assigns them, in which case the rows
+        must be L2 normalized, and by cosine similarity otherwise.
+        """
+        if self.algorithm == 'kmeans':
+            # argmin |v - c|^2 = argmax 2 v.c - |c|^2 when |v| is 1.
+            scores = 2 * np.asarray(vecs @ self.centroids.T) \
+                - np.einsum('ij,ij->i', self.centroids, self.centroids)
+        else:
+            scores = np.asarray(vecs @ normalize_rows(self.centroids).T)
+        return scores.argmax(axis=1)
 
     def get_cluster_centroid(self, cluster_num):
         """Gets the centroid of the cluster with the
@@ -40,9 +151,44 @@ class Clusterer:
                 you wish to fetch the centroid of.
 
         Returns:
-            a numpy array containing the cluster centroid.
+            a 1d numpy array containing the cluster centroid.
+        """
+        return self.centroids[cluster_num]
+
+    def save_artifact(self, directory):
+        """Saves the cluster labels and centroids to the model
+        artifact in directory.
+
+        Args:
+            directory (str): the artifact directory.
+        """
+        artifact_utils.update_manifest(directory, 'clusters',
+            {'cluster_count': self.cluster_count, 'algorithm': self.algorithm})
+        artifact_utils.save_array(directory, 'cluster_labels', self.labels)
+        artifact_utils.save_array(directory, 'cluster_centroids', self.centroids)
+
+    @staticmethod
+    def load_artifact(directory, org_dataset, org_vectorspace, mmap=True):
+        """Loads a Clusterer from the model artifact in directory.
+        No clustering is performed.
+
+        Args:
+            directory (str): the artifact directory.
+            org_dataset (OrgDataset): the dataset stored in the same
+                artifact.
+            org_vectorspace (VectorSpace): the vector space stored in
+                the same artifact.
+            mmap (bool): whether the arrays should be memory-mapped.
+
+        Returns:
+            the Clusterer stored in the artifact.
         """
-        df = self.df[self.df['clusters']==cluster_num]
-        descs = df['orgPurpose'].to_numpy()
-        vecs = self._vs.transform(descs)
-        return np.mean(vecs, axis=0)
+        params = artifact_utils.read_manifest(directory)['clusters']
+        c = Clusterer.__new__(Clusterer)
+        c._dataset = org_dataset
+        c._vs = org_vectorspace
+        c.cluster_count = params['cluster_count']
+        c.algorithm = params.get('algorithm', 'spectral')
+        c.labels = artifact_utils.load_array(directory, 'cluster_labels', mmap)
+        c.centroids = artifact_utils.load_array(directory, 'cluster_centroids', mmap)
+        return c
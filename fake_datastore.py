@@ -0,0 +1,106 @@
+"""
+An in-memory stand-in for google.cloud.datastore.Client.
+
+It implements the subset of the client interface used by gcd_utils,
+so tests, benchmarks and offline tools can run without credentials:
+
+    import gcd_utils
+    from fake_datastore import FakeDatastoreClient
+
+    fake = FakeDatastoreClient()
+    fake.put('account', {'userId': 'u1', 'userInterestOrgsId': [],
+        'userDislikeOrgsId': [], 'userInterestTags': []})
+    gcd_utils.set_client(fake)
+"""
+import operator
+
+_OPERATORS = {
+    '=': operator.eq,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+class FakeDatastoreClient:
+    """Stores entities as dictionaries grouped by kind.
+
+    Attributes:
+        entities (dict): maps each kind to a list of entities.
+        query_count (int): the number of queries fetched so far.
+            Useful to check how many backend calls a code path
+            makes.
+    """
+
+    def __init__(self):
+        self.entities = {}
+        self.query_count = 0
+
+    def put(self, kind, entity):
+        """Stores entity (a dict) under kind."""
+        self.entities.setdefault(kind, []).append(dict(entity))
+
+    def put_multi(self, kind, entities):
+        """Stores every entity in entities under kind."""
+        for entity in entities:
+            self.put(kind, entity)
+
+    def query(self, kind):
+        return FakeQuery(self, kind)
+
+
+class FakeQuery:
+
+    def __init__(self, client, kind):
+        self._client = client
+        self.kind = kind
+        self.filters = []
+
+    def add_filter(self, property_name, op, value):
+        self.filters.append((property_name, _OPERATORS[op], value))
+        return self
+
+    def fetch(self, limit=None, offset=0, start_cursor=None):
+        """Runs the query. Like the real client, the result can be
+        iterated directly or page by page through its pages
+        attribute, and next_page_token is the cursor to pass as
+        start_cursor to continue after the fetched entities.
+        """
+        self._client.query_count += 1
+        results = []
+        for entity in self._client.entities.get(self.kind, []):
+            if all(name in entity and op(entity[name], value)
+                    for name, op, value in self.filters):
+                results.append(dict(entity))
+        if start_cursor is not None:
+            offset += int(start_cursor)
+        end = None if limit is None else offset + limit
+        return FakeIterator(results[offset:end], offset, len(results))
+
+
+class FakeIterator:
+    """The result of FakeQuery.fetch. Cursors are entity offsets
+    encoded as strings.
+
+    Attributes:
+        next_page_token (str or None): the cursor after the last
+            entity of the fetch, once its page was read. None if no
+            entities follow.
+    """
+
+    def __init__(self, entities, offset, total):
+        self._entities = entities
+        self._end = offset + len(entities)
+        self._total = total
+        self.next_page_token = None
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+    @property
+    def pages(self):
+        if self._end < self._total:
+            self.next_page_token = str(self._end)
+        yield list(self._entities)
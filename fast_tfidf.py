@@ -0,0 +1,200 @@
+"""
+A specialized tfidf transform for fitted TfidfVectorizers.
+
+sklearn's TfidfVectorizer.transform runs a generic analyzer pipeline
+per document and builds the count matrix before weighting it.
+FastTfidfTransformer supports the configuration VectorSpace uses, i.e.
+word unigrams with the default preprocessing. It tokenizes with one
+precompiled regex, looks the tokens up in a dictionary that already
+excludes the stop words, and builds the weighted csr matrix for a
+whole batch at once. Large batches, such as the corpus of a full
+refit, are split across processes.
+
+The output is identical to the vectorizer's. check_parity compares the
+two on a set of documents, and build_model.py runs it on every build.
+"""
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy.sparse as sp
+
+PARALLEL_MIN_DOCS = 50000
+# sklearn's default token pattern. Word boundaries are implied around a
+# greedy run of word characters, so the shorter pattern finds the same
+# tokens and is faster to match.
+DEFAULT_TOKEN_PATTERN = r'(?u)\b\w\w+\b'
+FAST_TOKEN_PATTERN = r'\w\w+'
+
+
+class FastTfidfTransformer:
+    """Transforms documents into the tfidf space of a fitted
+    vectorizer. Build instances with from_vectorizer.
+
+    Attributes:
+        vocabulary (dict): maps each term to its feature index. Stop
+            words are left out, so they are never counted. The
+            vectorizer's dictionary is shared when it holds no stop
+            words.
+        idf (numpy array): the idf weight of every feature.
+        lowercase (bool): whether documents are lowercased first.
+        norm (str or None): 'l2', 'l1' or None, the row
+            normalization.
+        sublinear_tf (bool): whether term counts are replaced by
+            1 + log(count).
+    """
+
+    def __init__(self, vocabulary, idf, token_pattern, lowercase=True, stop_words=None,
+            norm='l2', sublinear_tf=False):
+        stop_words = set(stop_words or ())
+        self.vocabulary = vocabulary
+        if any(term in stop_words for term in vocabulary):
+            self.vocabulary = {term: i for term, i in vocabulary.items()
+                if term not in stop_words}
+        self.idf = np.asarray(idf, dtype=np.float64)
+        self.token_pattern = token_pattern
+        self.lowercase = lowercase
+        self.norm = norm
+        self.sublinear_tf = sublinear_tf
+        self._findall = _compile(token_pattern)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_findall']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._findall = _compile(self.token_pattern)
+
+    @staticmethod
+    def from_vectorizer(vectorizer):
+        """Builds a transformer equivalent to a fitted
+        TfidfVectorizer.
+
+        Returns:
+            a FastTfidfTransformer, or None if the vectorizer uses
+            options it does not support (anything but word unigrams
+            with the default preprocessing and tokenization).
+        """
+        params = vectorizer.get_params()
+        supported = (params['analyzer'] == 'word'
+            and tuple(params['ngram_range']) == (1, 1)
+            and params['input'] == 'content'
+            and params['preprocessor'] is None
+            and params['tokenizer'] is None
+            and params['strip_accents'] is None
+            and not params['binary']
+            and params['use_idf']
+            and params['norm'] in ('l1', 'l2', None)
+            and np.dtype(params['dtype']) == np.float64
+            and hasattr(vectorizer, 'idf_'))
+        if not supported:
+            return None
+        return FastTfidfTransformer(vectorizer.vocabulary_, vectorizer.idf_,
+            params['token_pattern'], params['lowercase'], vectorizer.get_stop_words(),
+            params['norm'], params['sublinear_tf'])
+
+    def transform(self, documents, n_jobs=None):
+        """Transforms documents into tfidf vectors.
+
+        Args:
+            documents (iterable): strings, one per document.
+            n_jobs (int, optional): the number of processes. By
+                default, batches of at least PARALLEL_MIN_DOCS
+                documents use every cpu and smaller ones run in the
+                calling process.
+
+        Returns:
+            a scipy csr matrix with one row per document.
+        """
+        documents = list(documents)
+        if n_jobs is None:
+            n_jobs = (os.cpu_count() or 1) if len(documents) >= PARALLEL_MIN_DOCS else 1
+        n_jobs = min(n_jobs, len(documents))
+        if n_jobs <= 1:
+            return self._transform(documents)
+        bounds = np.linspace(0, len(documents), n_jobs * 4 + 1).astype(int)
+        chunks = [documents[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                initargs=(self,)) as executor:
+            return sp.vstack(list(executor.map(_transform_in_worker, chunks)), format='csr')
+
+    def _transform(self, documents):
+        findall = self._findall
+        lookup = self.vocabulary.get
+        indices = []
+        indptr = [0]
+        for doc in documents:
+            if self.lowercase:
+                doc = doc.lower()
+            indices.extend([i for i in map(lookup, findall(doc)) if i is not None])
+            indptr.append(len(indices))
+        matrix = sp.csr_matrix((np.ones(len(indices)), np.array(indices, dtype=np.int32),
+            np.array(indptr, dtype=np.int32)), shape=(len(documents), len(self.idf)))
+        # Sums the counts of repeated terms and sorts the indices.
+        matrix.sum_duplicates()
+        if self.sublinear_tf:
+            np.log(matrix.data, matrix.data)
+            matrix.data += 1
+        matrix.data *= self.idf[matrix.indices]
+        if self.norm == 'l2':
+            # Imported here, vector_space imports this module.
+            from vector_space import normalize_rows
+            matrix = normalize_rows(matrix)
+        elif self.norm == 'l1':
+            sums = np.asarray(abs(matrix).sum(axis=1)).ravel()
+            sums[sums == 0] = 1
+            matrix.data /= np.repeat(sums, np.diff(matrix.indptr))
+        return matrix
+
+
+def _compile(token_pattern):
+    if token_pattern == DEFAULT_TOKEN_PATTERN:
+        token_pattern = FAST_TOKEN_PATTERN
+    return re.compile(token_pattern).findall
+
+
+_worker_transformer = None
+
+
+def _init_worker(transformer):
+    global _worker_transformer
+    _worker_transformer = transformer
+
+
+def _transform_in_worker(documents):
+    return _worker_transformer._transform(documents)
+
+
+def check_parity(vectorizer, documents, transformer=None):
+    """Checks that a FastTfidfTransformer gives exactly the same
+    output as vectorizer.transform.
+
+    Args:
+        vectorizer (TfidfVectorizer): a fitted vectorizer.
+        documents (iterable): the documents to compare on.
+        transformer (FastTfidfTransformer, optional): the
+            transformer to check. Built from vectorizer if not
+            provided.
+
+    Raises:
+        ValueError: if the outputs differ, or the vectorizer is
+            not supported.
+    """
+    if transformer is None:
+        transformer = FastTfidfTransformer.from_vectorizer(vectorizer)
+    if transformer is None:
+        raise ValueError('The vectorizer uses options FastTfidfTransformer does not support.')
+    documents = list(documents)
+    expected = vectorizer.transform(documents).tocsr()
+    actual = transformer.transform(documents, n_jobs=1)
+    expected.sort_indices()
+    if not (np.array_equal(expected.indptr, actual.indptr)
+            and np.array_equal(expected.indices, actual.indices)
+            and np.allclose(expected.data, actual.data, rtol=1e-12, atol=0)):
+        rows = np.flatnonzero((expected != actual).getnnz(axis=1)
+            if expected.shape == actual.shape else [])
+        raise ValueError('FastTfidfTransformer output differs from the vectorizer for'
+            ' {} of {} documents, e.g. document {}.'.format(len(rows), len(documents),
+            rows[0] if len(rows) > 0 else '?'))
@@ -1,26 +1,350 @@
-from google.cloud import datastore
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+import json
+import os
+import queue
+import threading
+from cachetools import TTLCache
+import metrics
 from org import Org
 from org_dataset import OrgDataset
 
-client = datastore.Client()
+# Created by get_client on first use, so importing this module needs
+# neither the google-cloud-datastore package nor credentials.
+client = None
+_client_lock = threading.Lock()
 
-def get_org_dataset():
+AccountProfile = namedtuple('AccountProfile', ['liked_orgs', 'disliked_orgs', 'tags'])
+AccountProfile.__doc__ = """The recommendation relevant fields of an account.
+
+Attributes:
+    liked_orgs (list): ids of the orgs the user is interested in.
+    disliked_orgs (list): ids of the orgs the user is NOT
+        interested in.
+    tags (list): the tags the user is interested in.
+"""
+
+PROFILE_CACHE_SIZE = 10000
+PROFILE_CACHE_TTL = 60
+PROFILE_BATCH_WORKERS = 8
+ORG_PAGE_SIZE = 500
+ORG_PREFETCH_PAGES = 2
+
+_profile_cache = TTLCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL)
+_profile_cache_lock = threading.Lock()
+_inflight_profiles = {}
+
+def set_client(new_client):
+    """Replaces the Datastore client used by this module, e.g.
+    with a fake_datastore.FakeDatastoreClient in tests. The
+    profile cache is cleared since it may hold data fetched with
+    the previous client.
+
+    Args:
+        new_client: an object with the same query interface as
+            google.cloud.datastore.Client.
+    """
+    global client
+    client = new_client
+    clear_profile_cache()
+
+def get_client():
+    """Returns the Datastore client, creating a
+    google.cloud.datastore.Client on first use unless one was set
+    with set_client.
+    """
+    global client
+    if client is None:
+        with _client_lock:
+            if client is None:
+                from google.cloud import datastore
+                client = datastore.Client()
+    return client
+
+def configure_profile_cache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL):
+    """Replaces the profile cache with an empty cache of the
+    given size.
+
+    Args:
+        maxsize (int): the maximum number of cached profiles. The
+            least recently used profile is evicted first.
+        ttl (float): the number of seconds a profile stays cached.
+    """
+    global _profile_cache
+    with _profile_cache_lock:
+        _profile_cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+def invalidate_account_profile(account_id):
+    """Drops the cached profile of a user, so that the next
+    lookup fetches it from Datastore. Call this after updating
+    the user's account.
+
+    Args:
+        account_id (str): The id of the user.
+    """
+    with _profile_cache_lock:
+        _profile_cache.pop(account_id, None)
+
+def clear_profile_cache():
+    """Drops every cached profile."""
+    with _profile_cache_lock:
+        _profile_cache.clear()
+
+@metrics.timed('datastore_orgs')
+def get_org_dataset(page_size=ORG_PAGE_SIZE, checkpoint=None):
     """Fetches organizational data from google cloud
     datastore and creates an OrgDataset instance containing
-    the data fetched.
+    the data fetched. Orgs are fetched page by page (see
+    iter_org_columns), so only a few pages of entities are held
+    in memory at a time.
+
+    Args:
+        page_size (int): the number of orgs per query.
+        checkpoint (str, optional): a file the fetched pages are
+            appended to. If the file exists, e.g. after a failed
+            run, its pages are reused and fetching resumes after the
+            last of them. The file is removed once all orgs are
+            fetched.
 
     Returns:
         An OrgDataset instance containg the data fetched.
     """
-    query = client.query(kind='organization')
-    results = list(query.fetch())
-    orgs = []
-    for result in results:
-        orgs.append(Org(result['orgId'], result['orgName'], result['orgPurpose']))
+    ids, names, purposes = [], [], []
+    cursor, finished = None, False
+    if checkpoint is not None and os.path.exists(checkpoint):
+        cursor, finished = _read_org_checkpoint(checkpoint, ids, names, purposes)
+    if not finished:
+        log = open(checkpoint, 'a') if checkpoint is not None else None
+        try:
+            for page_ids, page_names, page_purposes, cursor in iter_org_columns(page_size,
+                    cursor):
+                ids += page_ids
+                names += page_names
+                purposes += page_purposes
+                if log is not None:
+                    log.write(json.dumps({'cursor': cursor, 'ids': page_ids,
+                        'names': page_names, 'purposes': page_purposes}) + '\n')
+                    log.flush()
+        finally:
+            if log is not None:
+                log.close()
     od = OrgDataset()
-    od.add_orgs(orgs)
+    od.add_columns(ids, names, purposes)
+    if checkpoint is not None:
+        os.remove(checkpoint)
     return od
 
+def _read_org_checkpoint(checkpoint, ids, names, purposes):
+    """Appends the orgs stored in a get_org_dataset checkpoint to
+    the supplied column lists. A partially written last page is
+    truncated from the file.
+
+    Returns:
+        a tuple (cursor to resume from, whether all pages were
+        fetched).
+    """
+    cursor, pages, valid_bytes = None, 0, 0
+    with open(checkpoint, 'rb') as f:
+        for line in f:
+            try:
+                page = json.loads(line.decode('utf-8'))
+            except ValueError:
+                break
+            ids += page['ids']
+            names += page['names']
+            purposes += page['purposes']
+            cursor = page['cursor']
+            pages += 1
+            valid_bytes += len(line)
+    with open(checkpoint, 'r+b') as f:
+        f.truncate(valid_bytes)
+    return cursor, pages > 0 and cursor is None
+
+def iter_org_pages(page_size=ORG_PAGE_SIZE, start_cursor=None):
+    """Fetches the organization entities one page at a time,
+    following query cursors.
+
+    Args:
+        page_size (int): the number of entities per query.
+        start_cursor (str, optional): the cursor to start after.
+
+    Yields:
+        (entities, cursor) tuples, where cursor is the cursor after
+        the page, or None after the last page.
+    """
+    cursor = start_cursor
+    while True:
+        query = get_client().query(kind='organization')
+        iterator = query.fetch(limit=page_size, start_cursor=cursor)
+        page = list(next(iterator.pages, []))
+        cursor = iterator.next_page_token
+        if isinstance(cursor, bytes):
+            cursor = cursor.decode('ascii')
+        if len(page) > 0:
+            yield page, cursor
+        if cursor is None or len(page) == 0:
+            return
+
+def iter_org_columns(page_size=ORG_PAGE_SIZE, start_cursor=None, prefetch=ORG_PREFETCH_PAGES):
+    """Fetches the orgs page by page as columns. A background
+    thread fetches up to prefetch pages ahead, so network time
+    overlaps with the caller's processing while memory stays
+    bounded.
+
+    Args:
+        page_size (int): the number of orgs per query.
+        start_cursor (str, optional): the cursor to start after.
+        prefetch (int): the number of pages fetched ahead.
+
+    Yields:
+        (ids, names, purposes, cursor) tuples, one per page. The
+        columns are lists, normalized like Org does, and cursor is
+        as in iter_org_pages.
+    """
+    for entities, cursor in _prefetch(iter_org_pages(page_size, start_cursor), prefetch):
+        orgs = [Org(e['orgId'], e['orgName'], e['orgPurpose']) for e in entities]
+        yield ([org.org_id for org in orgs], [org.org_name for org in orgs],
+            [org.org_purpose for org in orgs], cursor)
+
+def _prefetch(iterable, depth):
+    """Iterates iterable in a background thread, at most depth
+    items ahead of the consumer. Exceptions are re-raised in the
+    consumer.
+    """
+    items = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as e:
+            put((end, e))
+            return
+        put((end, None))
+
+    thread = threading.Thread(target=produce, name='datastore-prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+
+@metrics.timed('datastore_profile')
+def _fetch_account_profile(account_id):
+    """Runs the Datastore query for a single account,
+    bypassing the cache.
+    """
+    query = get_client().query(kind='account')
+    query.add_filter('userId', '=', account_id)
+    results = list(query.fetch())
+    if len(results) != 1:
+        raise ValueError('More or less than 1 user returned.'
+            ' Something went wrong.')
+    account = results[0]
+    return AccountProfile(account.get('userInterestOrgsId', []),
+        account.get('userDislikeOrgsId', []), account.get('userInterestTags', []))
+
+def get_account_profile(account_id):
+    """Fetches the liked orgs, disliked orgs and tags of a
+    user with a single Datastore query. Profiles are cached for
+    PROFILE_CACHE_TTL seconds, and concurrent lookups of the same
+    uncached user share one query, so a user costs at most one
+    backend call per cache window.
+
+    Args:
+        account_id (str): The id of the user to
+            fetch the profile of.
+
+    Returns:
+        An AccountProfile.
+
+    Raises:
+        ValueError: if no account, or more than one, has the id.
+    """
+    with _profile_cache_lock:
+        profile = _profile_cache.get(account_id)
+        if profile is not None:
+            return profile
+        future = _inflight_profiles.get(account_id)
+        fetching = future is None
+        if fetching:
+            future = Future()
+            _inflight_profiles[account_id] = future
+    if not fetching:
+        return future.result()
+    try:
+        profile = _fetch_account_profile(account_id)
+    except BaseException as e:
+        with _profile_cache_lock:
+            del _inflight_profiles[account_id]
+        future.set_exception(e)
+        raise
+    with _profile_cache_lock:
+        _profile_cache[account_id] = profile
+        del _inflight_profiles[account_id]
+    future.set_result(profile)
+    return profile
+
+def get_account_profiles(account_ids):
+    """Fetches the profiles of several users. Cached profiles
+    are returned directly and the remaining users are fetched
+    concurrently, using up to PROFILE_BATCH_WORKERS queries at
+    a time. There is one query per user because accounts are
+    looked up by their userId property rather than by key, so
+    get_multi does not apply, and the pinned google-cloud-datastore
+    release has no IN filter to match several users at once.
+
+    Args:
+        account_ids (list): the ids of the users.
+
+    Returns:
+        A dictionary mapping user id to AccountProfile. Users
+        that do not have exactly one account are left out.
+    """
+    profiles = {}
+    missing = []
+    with _profile_cache_lock:
+        for account_id in dict.fromkeys(account_ids):
+            profile = _profile_cache.get(account_id)
+            if profile is not None:
+                profiles[account_id] = profile
+            else:
+                missing.append(account_id)
+    if len(missing) == 0:
+        return profiles
+
+    def fetch(account_id):
+        try:
+            return get_account_profile(account_id)
+        except ValueError:
+            return None
+
+    workers = min(PROFILE_BATCH_WORKERS, len(missing))
+    with metrics.stage('datastore_profile_batch'), \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        for account_id, profile in zip(missing, executor.map(fetch, missing)):
+            if profile is not None:
+                profiles[account_id] = profile
+    return profiles
+
 def get_account_liked_orgs(account_id):
     """Fetches the ids of the orgs that the user
     is interested in.
@@ -34,13 +358,7 @@ def get_account_liked_orgs(account_id):
         id of an organization the user is interested
         in.
     """
-    query = client.query(kind='account')
-    query.add_filter('userId', '=', account_id)
-    results = list(query.fetch())
-    if len(results) != 1:
-        raise ValueError('More or less than 1 user returned.'
-            ' Something went wrong.')
-    return results[0]['userInterestOrgsId']
+    return get_account_profile(account_id).liked_orgs
 
 def get_account_disliked_orgs(account_id):
     """Fetches the ids of the orgs that the user
@@ -55,13 +373,7 @@ def get_account_disliked_orgs(account_id):
         id of an organization the user is not interested
         in.
     """
-    query = client.query(kind='account')
-    query.add_filter('userId', '=', account_id)
-    results = list(query.fetch())
-    if len(results) != 1:
-        raise ValueError('More or less than 1 user returned.'
-            ' Something went wrong.')
-    return results[0]['userDislikeOrgsId']
+    return get_account_profile(account_id).disliked_orgs
 
 def get_account_liked_tags(account_id):
     """Fetches the tags that the user
@@ -75,10 +387,4 @@ def get_account_liked_tags(account_id):
         A python list of strings. Each entry is a
         tag that the user is interested in
     """
-    query = client.query(kind='account')
-    query.add_filter('userId', '=', account_id)
-    results = list(query.fetch())
-    if len(results) != 1:
-        raise ValueError('More or less than 1 user returned.'
-            ' Something went wrong.')
-    return results[0]['userInterestTags']
+    return get_account_profile(account_id).tags
@@ -1,21 +1,62 @@
-import pandas as pd
+import scipy.sparse as sp
+import numpy as np
 
 class KeywordFinder:
+    """Finds the highest weighted vocabulary terms of tfidf
+    vectors, e.g. cluster centroids.
+
+    Attributes:
+        dataset (OrgDataset): the orgs vs was fit on.
+        vs (VectorSpace): the vector space whose vocabulary is used.
+        vocab (numpy array): the vocabulary terms ordered by their
+            feature index, so vocab[i] is the term of column i.
+    """
 
     def __init__(self, org_dataset, org_vectorspace):
         self.dataset = org_dataset
         self.vs = org_vectorspace
-        vocab = self.vs.get_vocabulary().keys()
-        vocab_ind = self.vs.get_vocabulary().values()
-        self.vocab_df = pd.DataFrame(vocab_ind, columns=['vocab_ind'])
-        self.vocab_df['vocab'] = vocab
-        self.vocab_df = self.vocab_df.sort_values(['vocab_ind'], ignore_index=True)
+        vocabulary = self.vs.get_vocabulary()
+        self.vocab = np.empty(len(vocabulary), dtype=object)
+        self.vocab[np.fromiter(vocabulary.values(), dtype=np.intp, count=len(vocabulary))] = \
+            list(vocabulary.keys())
 
     def top_n_keywords(self, vector, n=5):
-        df = self.vocab_df
-        try:
-            df['vec'] = vector
-        except ValueError:
-            df['vec'] = vector.reshape(self.vocab_df.shape[0], 1)
-        df = df.sort_values(['vec'], ascending=False, ignore_index=True)
-        return df.iloc[0:n]['vocab'].to_numpy().tolist()
+        """Returns the n terms with the highest weight in vector.
+
+        Args:
+            vector (array or scipy sparse matrix): a single tfidf
+                vector.
+            n (int): the number of terms.
+
+        Returns:
+            a list of strings ordered from highest to lowest weight.
+        """
+        return self.top_n_keywords_batch(vector, n)[0]
+
+    def top_n_keywords_batch(self, vectors, n=5):
+        """Returns the n highest weighted terms of each of the
+        supplied vectors. Only the top n columns of each row are
+        sorted, not the whole vocabulary.
+
+        Args:
+            vectors (array or scipy sparse matrix): one tfidf vector
+                per row. A 1d array is treated as a single vector.
+            n (int): the number of terms per vector.
+
+        Returns:
+            a list with one list of strings per row, each ordered
+            from highest to lowest weight. Ties are broken by
+            feature index.
+        """
+        if sp.issparse(vectors):
+            vectors = vectors.toarray()
+        weights = np.atleast_2d(np.asarray(vectors, dtype=np.float64))
+        n = min(n, weights.shape[1])
+        if n <= 0:
+            return [[] for _ in range(weights.shape[0])]
+        top = np.argpartition(-weights, n - 1, axis=1)[:, :n]
+        top.sort(axis=1)
+        top_weights = np.take_along_axis(weights, top, axis=1)
+        order = np.argsort(-top_weights, axis=1, kind='stable')
+        top = np.take_along_axis(top, order, axis=1)
+        return self.vocab[top].tolist()
@@ -1,27 +1,95 @@
-import pandas as pd
+import artifact_utils
+import metrics
 import numpy as np
 
 class KeywordMatcher:
+    """Maps keywords to clusters of organizations. Each cluster
+    is labeled with the top keywords of its centroid, and the
+    labels are stored in a dictionary so a set of keywords can be
+    turned into a centroid without touching the org data.
+
+    Attributes:
+        default_centroid (array): the centroid returned when none
+            of the keywords match a cluster.
+        clusterer (Clusterer): the Clusterer whose clusters are
+            labeled.
+        keyword_index (dict): maps each keyword to a list of the
+            ids of the clusters it labels.
+    """
 
     def __init__(self, clusterer, keyword_finder, default_centroid, words_per_cluster=5):
         self.default_centroid = default_centroid
         self.clusterer = clusterer
-        cluster_count = self.clusterer.cluster_count
-        self.df = pd.DataFrame(columns=['keyword', 'cluster_id'])
-        for i in range(cluster_count):
-            centroid = self.clusterer.get_cluster_centroid(i)
-            keywords = keyword_finder.top_n_keywords(centroid, words_per_cluster)
+        self.keyword_index = {}
+        labels = keyword_finder.top_n_keywords_batch(self.clusterer.centroids,
+            words_per_cluster)
+        for i, keywords in enumerate(labels):
             for word in keywords:
-                row = pd.DataFrame(data=[[word, i]], columns=['keyword', 'cluster_id'])
-                self.df = pd.concat([self.df, row])
+                self.keyword_index.setdefault(word, []).append(i)
 
-    def get_kw_centroid(self, keywords):
+    def get_kw_clusters(self, keywords):
+        """Returns the ids of the clusters labeled by the supplied
+        keywords, once per matching keyword, see get_kw_centroid.
+        """
         ids = []
         for keyword in keywords:
-            ids += list(self.df[self.df['keyword'] == keyword]['cluster_id'])
+            ids += self.keyword_index.get(keyword, [])
+        return ids
+
+    @metrics.timed('keyword_centroid')
+    def get_kw_centroid(self, keywords):
+        """Averages the centroids of the clusters labeled by the
+        supplied keywords. A cluster labeled by several of the
+        keywords is counted once per keyword.
+
+        Args:
+            keywords (list): a list of strings.
+
+        Returns:
+            a numpy array containing the centroid, or
+            default_centroid if no keyword matches a cluster.
+        """
+        ids = self.get_kw_clusters(keywords)
         if len(ids) == 0:
             return self.default_centroid
-        centroid = []
-        for id in ids:
-            centroid.append(self.clusterer.get_cluster_centroid(id))
-        return np.mean(centroid, axis=0)
+        return self.clusterer.centroids[ids].mean(axis=0)
+
+    def save_artifact(self, directory):
+        """Saves the keyword index to the model artifact in
+        directory. Each (keyword, cluster id) pair is stored as
+        one entry of two parallel arrays.
+
+        Args:
+            directory (str): the artifact directory.
+        """
+        pairs = [(word, i) for word, ids in self.keyword_index.items() for i in ids]
+        artifact_utils.update_manifest(directory, 'keywords', {'count': len(pairs)})
+        artifact_utils.save_strings(directory, 'keywords', [word for word, _ in pairs])
+        artifact_utils.save_array(directory, 'keyword_clusters',
+            np.array([i for _, i in pairs], dtype=np.int64))
+
+    @staticmethod
+    def load_artifact(directory, clusterer, default_centroid, mmap=True):
+        """Loads a KeywordMatcher from the model artifact in
+        directory. No keywords are recomputed.
+
+        Args:
+            directory (str): the artifact directory.
+            clusterer (Clusterer): the clusterer stored in the same
+                artifact.
+            default_centroid (array): see class attributes.
+            mmap (bool): whether the arrays should be memory-mapped.
+
+        Returns:
+            the KeywordMatcher stored in the artifact.
+        """
+        artifact_utils.read_manifest(directory)
+        words = artifact_utils.load_strings(directory, 'keywords', mmap)
+        cluster_ids = artifact_utils.load_array(directory, 'keyword_clusters', mmap)
+        matcher = KeywordMatcher.__new__(KeywordMatcher)
+        matcher.default_centroid = default_centroid
+        matcher.clusterer = clusterer
+        matcher.keyword_index = {}
+        for word, i in zip(words, cluster_ids):
+            matcher.keyword_index.setdefault(word, []).append(int(i))
+        return matcher
@@ -0,0 +1,296 @@
+"""
+Lightweight latency instrumentation for the recommendation stages.
+
+Code paths are wrapped in stage(name) blocks, or decorated with
+timed(name). Each stage's duration is recorded in the STAGE_SECONDS
+histogram, and also in the timings of the current request if one was
+started with start_request_timing. The request timings live in a
+context variable. BoundedExecutor copies the caller's context into
+its worker threads, so stages run on the pools count towards the
+request that submitted them.
+
+render_prometheus() returns every histogram in the Prometheus text
+format, along with the durations of the process's startup phases
+recorded with startup_phase. SamplingProfiler collects stack samples
+of all threads and can be started and stopped at runtime.
+
+Example:
+
+    with metrics.stage('similarity'):
+        sims = queries @ matrix.T
+"""
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+_startup_phases = []
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    """A thread safe histogram with one series per label value.
+
+    Attributes:
+        name (str): the metric name.
+        help (str): the description shown in the metrics output.
+        label (str): the name of the label distinguishing series.
+        buckets (tuple): the upper bounds of the buckets, in
+            seconds, in increasing order.
+    """
+
+    def __init__(self, name, help, label, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, label_value, value):
+        """Records value for the series of label_value."""
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self):
+        """Returns {label value: (cumulative bucket counts, sum,
+        count)}.
+        """
+        with self._lock:
+            items = [(key, list(counts), total, count)
+                for key, (counts, total, count) in self._series.items()]
+        result = {}
+        for key, counts, total, count in items:
+            cumulative = []
+            running = 0
+            for c in counts:
+                running += c
+                cumulative.append(running)
+            result[key] = (cumulative, total, count)
+        return result
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} histogram'.format(self.name)]
+        for key, (cumulative, total, count) in sorted(self.snapshot().items()):
+            label = '{}="{}"'.format(self.label, _escape(key))
+            for bound, c in zip(self.buckets, cumulative):
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(self.name, label, bound, c))
+            lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(self.name, label, count))
+            lines.append('{}_sum{{{}}} {}'.format(self.name, label, total))
+            lines.append('{}_count{{{}}} {}'.format(self.name, label, count))
+        return '\n'.join(lines)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+STAGE_SECONDS = Histogram('recommender_stage_seconds',
+    'Time spent in each stage of serving recommendations.', 'stage')
+REQUEST_SECONDS = Histogram('recommender_request_seconds',
+    'Time spent handling each API endpoint.', 'path')
+
+
+def record_stage(name, seconds):
+    """Records that stage name took seconds, see stage."""
+    STAGE_SECONDS.observe(name, seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Times the enclosed block as stage name."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """Decorator timing every call of the function as stage name."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_request_timing():
+    """Starts collecting the stage timings of the current request,
+    i.e. of the current context and the contexts copied from it.
+
+    Returns:
+        a token for stop_request_timing.
+    """
+    return _request_timings.set([])
+
+
+def stop_request_timing(token):
+    """Stops collecting request timings.
+
+    Returns:
+        a list of (stage, total seconds) tuples in order of first
+        occurrence. Stages run several times are summed.
+    """
+    timings = _request_timings.get() or []
+    _request_timings.reset(token)
+    totals = {}
+    for name, seconds in list(timings):
+        totals[name] = totals.get(name, 0.0) + seconds
+    return list(totals.items())
+
+
+def server_timing_header(timings):
+    """Formats (stage, seconds) tuples as a Server-Timing header
+    value, with durations in milliseconds.
+    """
+    return ', '.join('{};dur={:.3f}'.format(name, seconds * 1000) for name, seconds in timings)
+
+
+def record_startup_phase(name, seconds):
+    """Records that startup phase name took seconds."""
+    _startup_phases.append((name, seconds))
+    logger.info('Startup phase %s took %.3fs', name, seconds)
+
+
+@contextlib.contextmanager
+def startup_phase(name):
+    """Times the enclosed block as startup phase name."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_startup_phase(name, time.perf_counter() - start)
+
+
+def startup_report():
+    """Returns the recorded startup phases as a list of (phase,
+    seconds) tuples, in the order they ran.
+    """
+    return list(_startup_phases)
+
+
+def render_prometheus():
+    """Returns every histogram, and the startup phase durations
+    as a gauge, in the Prometheus text format.
+    """
+    lines = [h.render() for h in _registry]
+    if _startup_phases:
+        lines += ['# HELP recommender_startup_seconds Duration of each startup phase.',
+            '# TYPE recommender_startup_seconds gauge']
+        lines += ['recommender_startup_seconds{{phase="{}"}} {}'.format(_escape(name), seconds)
+            for name, seconds in _startup_phases]
+    return '\n'.join(lines) + '\n'
+
+
+# The shortest interval SamplingProfiler samples at. Shorter ones would
+# keep the GIL from the request threads.
+MIN_PROFILER_INTERVAL = 0.001
+
+
+class SamplingProfiler:
+    """Samples the stacks of every thread at a fixed interval from
+    a background thread. Samples are aggregated as folded stacks,
+    one 'frame;frame;frame count' line per distinct stack, which
+    flame graph tools read directly.
+
+    Attributes:
+        interval (float): seconds between samples.
+        samples (int): the number of samples taken since the last
+            start.
+    """
+
+    def __init__(self):
+        self.interval = 0.01
+        self.samples = 0
+        self._stacks = Counter()
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, interval=0.01):
+        """Clears the collected stacks and starts sampling. Does
+        nothing if the profiler is already running. Intervals
+        below MIN_PROFILER_INTERVAL are raised to it.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.interval = max(interval, MIN_PROFILER_INTERVAL)
+            self.samples = 0
+            self._stacks = Counter()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler',
+                daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stops sampling. The collected stacks are kept."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+
+    def folded(self, limit=None):
+        """Returns the collected stacks in the folded format, most
+        frequent first.
+
+        Args:
+            limit (int, optional): the number of stacks to return.
+        """
+        with self._lock:
+            stacks = self._stacks.most_common(limit)
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in stacks)
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, frame in frames.items():
+                    if thread_id != own:
+                        self._stacks[_fold(frame)] += 1
+                self.samples += 1
+
+
+def _fold(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+profiler = SamplingProfiler()
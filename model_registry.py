@@ -0,0 +1,232 @@
+"""
+Hot swappable model snapshots.
+
+A ModelSnapshot bundles every object the API needs to serve one build
+of the model. A ModelRegistry holds the snapshot currently being
+served and can load a newer build in a background thread. Requests
+read the current snapshot once and use it until they finish, so a swap
+never changes the model under an in-flight request; the old snapshot
+is freed once its last request completes.
+"""
+import gc
+import logging
+import threading
+import time
+import weakref
+import artifact_utils
+from ann_index import make_searcher
+from org_dataset import OrgDataset
+from vector_space import VectorSpace
+from org_recommender import OrgRecommender
+from clusterer import Clusterer
+from keyword_matcher import KeywordMatcher
+from top_lists import TopLists
+
+logger = logging.getLogger(__name__)
+
+# How often ModelSnapshot.load retries when the artifact is replaced
+# while it is read, and the seconds between attempts.
+LOAD_ATTEMPTS = 3
+LOAD_RETRY_DELAY = 0.5
+
+
+class ModelSnapshot:
+    """One build of the model.
+
+    Attributes:
+        version (str): the model version recorded in the artifact
+            manifest by build_model.py.
+        dataset (OrgDataset): the orgs of the build.
+        vs (VectorSpace): the vector space of the build.
+        recommender (OrgRecommender): a recommender using dataset,
+            vs and the artifact's precomputed top lists.
+        clusterer (Clusterer): the clusters of the build.
+        matcher (KeywordMatcher): the cluster keywords of the build.
+    """
+
+    def __init__(self, version, dataset, vs, clusterer, matcher, top_lists=None):
+        self.version = version
+        self.dataset = dataset
+        self.vs = vs
+        self.recommender = OrgRecommender(dataset, vs, top_lists)
+        self.clusterer = clusterer
+        self.matcher = matcher
+
+    @staticmethod
+    def load(directory, mmap=True, search_backend='exact', search_params=None):
+        """Loads the snapshot stored in the model artifact in
+        directory.
+
+        build_model.write_artifact may replace the artifact while it
+        is read, which could mix arrays of two builds. The manifest
+        version is read again once everything is loaded, and the load
+        is retried if it changed or files disappeared meanwhile.
+
+        Args:
+            directory (str): the artifact directory.
+            mmap (bool): whether the arrays should be memory-mapped.
+            search_backend (str): 'exact', 'inverted' or 'ivf', see
+                ann_index.make_searcher.
+            search_params (dict, optional): the search backend's
+                recall/latency knob, e.g. {'n_probe': 3}.
+
+        Raises:
+            RuntimeError: if the artifact kept changing for
+                LOAD_ATTEMPTS attempts.
+        """
+        for attempt in range(LOAD_ATTEMPTS):
+            try:
+                snapshot = ModelSnapshot._load(directory, mmap, search_backend, search_params)
+                if read_model_version(directory) == snapshot.version:
+                    return snapshot
+            except FileNotFoundError:
+                if attempt == LOAD_ATTEMPTS - 1:
+                    raise
+            logger.warning('The model artifact in %s changed while loading, retrying.',
+                directory)
+            time.sleep(LOAD_RETRY_DELAY)
+        raise RuntimeError('The model artifact in {} changed during {} load attempts.'
+            .format(directory, LOAD_ATTEMPTS))
+
+    @staticmethod
+    def _load(directory, mmap, search_backend, search_params):
+        version = read_model_version(directory)
+        dataset = OrgDataset.load_artifact(directory, mmap)
+        vs = VectorSpace.load_artifact(directory, dataset, mmap)
+        c = Clusterer.load_artifact(directory, dataset, vs, mmap)
+        vs.set_search_backend(make_searcher(search_backend, vs, c, **(search_params or {})))
+        matcher = KeywordMatcher.load_artifact(directory, c, vs.data_centroid, mmap)
+        top_lists = TopLists.load_artifact(directory, mmap)
+        return ModelSnapshot(version, dataset, vs, c, matcher, top_lists)
+
+
+def read_model_version(directory):
+    """Returns the model version of the artifact in directory."""
+    return artifact_utils.read_manifest(directory)['build']['model_version']
+
+
+class ModelRegistry:
+    """Serves the current ModelSnapshot and swaps in new ones.
+
+    At most two snapshots are held at a time: a reload is refused
+    while the snapshot retired by the previous reload is still used
+    by an in-flight request.
+
+    Attributes:
+        directory (str): the model artifact directory snapshots are
+            loaded from.
+        retired_timeout (float): how long a reload waits for the
+            previously retired snapshot to be released.
+        search_backend (str): passed to ModelSnapshot.load.
+        search_params (dict): passed to ModelSnapshot.load.
+    """
+
+    def __init__(self, directory, retired_timeout=30.0, search_backend='exact',
+            search_params=None):
+        self.directory = directory
+        self.retired_timeout = retired_timeout
+        self.search_backend = search_backend
+        self.search_params = search_params
+        self._snapshot = None
+        self._retired = None
+        self._load_lock = threading.Lock()
+        self._listeners = []
+        self._poller = None
+        self._stop_polling = threading.Event()
+
+    def current(self):
+        """Returns the snapshot to serve a request with. Callers
+        should read it once per request and keep using it.
+        """
+        return self._snapshot
+
+    def add_listener(self, listener):
+        """Registers listener(snapshot) to be called after every
+        swap, e.g. to drop caches tied to the old model.
+        """
+        self._listeners.append(listener)
+
+    def reload(self, force=False):
+        """Loads the artifact in directory and swaps it in, unless
+        it holds the version already being served.
+
+        Args:
+            force (bool): swap even if the version is unchanged.
+
+        Returns:
+            True if a new snapshot was swapped in. False if the
+            version is unchanged, another reload is in progress, or
+            the previously retired snapshot is still in use.
+        """
+        if not self._load_lock.acquire(blocking=False):
+            return False
+        try:
+            current = self._snapshot
+            if current is not None and not force \
+                    and read_model_version(self.directory) == current.version:
+                return False
+            if not self._wait_for_retired():
+                logger.warning('Skipping model reload, the previous snapshot is still in use.')
+                return False
+            start = time.time()
+            snapshot = ModelSnapshot.load(self.directory,
+                search_backend=self.search_backend, search_params=self.search_params)
+            self._snapshot = snapshot
+            if current is not None:
+                self._retired = weakref.ref(current)
+            del current
+            logger.info('Loaded model %s in %.2fs', snapshot.version, time.time() - start)
+            for listener in self._listeners:
+                listener(snapshot)
+            return True
+        finally:
+            self._load_lock.release()
+
+    def reload_async(self, force=False):
+        """Runs reload in a background thread.
+
+        Returns:
+            the started thread.
+        """
+        thread = threading.Thread(target=self._reload_logged, args=(force,),
+            name='model-reload', daemon=True)
+        thread.start()
+        return thread
+
+    def start_polling(self, interval):
+        """Starts a background thread that checks the artifact's
+        model version every interval seconds and reloads it when it
+        changes.
+        """
+        if self._poller is not None:
+            return
+        self._stop_polling.clear()
+
+        def poll():
+            while not self._stop_polling.wait(interval):
+                self._reload_logged(False)
+
+        self._poller = threading.Thread(target=poll, name='model-poller', daemon=True)
+        self._poller.start()
+
+    def stop_polling(self):
+        self._stop_polling.set()
+        self._poller = None
+
+    def _reload_logged(self, force):
+        try:
+            self.reload(force)
+        except Exception:
+            logger.exception('Model reload from %s failed.', self.directory)
+
+    def _wait_for_retired(self):
+        deadline = time.time() + self.retired_timeout
+        while self._retired is not None and self._retired() is not None:
+            gc.collect()
+            if self._retired() is None:
+                break
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.1)
+        self._retired = None
+        return True
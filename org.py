@@ -11,6 +11,8 @@ class Org:
             is that some orgs have not purposes listed.
     """
 
+    __slots__ = ('org_id', 'org_name', 'org_purpose')
+
     def __init__(self, org_id, org_name, org_purpose):
         """Initializes an Org instance.
         """
@@ -1,30 +1,89 @@
-import pandas as pd
 from org import Org
+import artifact_utils
 import pickle
 import numpy as np
 
 class OrgDataset:
     """This class contains functionality to create
     a local database of organizations. The database is
-    a pandas dataframe under the hood.
+    a set of numpy arrays under the hood, one per org
+    attribute, along with a dictionary mapping org ids
+    to row indices so lookups by id take constant time.
 
     Attributes:
         attributes (list): a list of strings. Each entry
-            is a column label for the dataframe.
-        dataframe (DataFrame): the dataframe containing
-            all of the organization data. You shouldn't have
-            to directly interact with this. Accessing the dataframe
-            should be done using the functions of this class.
+            is a column label for the database.
+        ids (array): a numpy array of strings containing
+            the id of each organization.
+        names (array): a numpy array of strings containing
+            the name of each organization. Datasets loaded with
+            load_artifact hold an artifact_utils.StringColumn
+            instead, which decodes names on access.
+        purposes (array): a numpy array of strings containing
+            the description of each organization, or a
+            StringColumn like names. You shouldn't
+            have to directly interact with the arrays. Accessing
+            the data should be done using the functions of this
+            class.
+        active (array): a numpy array of booleans, False for
+            the rows of orgs that were removed. Removed orgs keep
+            their row so that row indices stay valid, but they are
+            no longer found by id or returned as random orgs.
+        retired_indices (array): the row indices of removed orgs.
+        _index (dict): maps each active org id to its row index.
     """
 
     def __init__(self):
-        """Initializes an OrgDataset object with an
-        empty dataframe to store data. The dataframe
-        has the same columns as the values returned by
-        'attribute_labels' function found in 'Org' class.
+        """Initializes an OrgDataset object with empty
+        columns to store data. The columns match the values
+        returned by 'attribute_labels' function found in
+        'Org' class.
         """
         self.attributes = Org.attribute_labels()
-        self.dataframe = pd.DataFrame(columns=self.attributes)
+        self.ids = np.empty(0, dtype=object)
+        self.names = np.empty(0, dtype=object)
+        self.purposes = np.empty(0, dtype=object)
+        self.active = np.empty(0, dtype=bool)
+        self.retired_indices = np.empty(0, dtype=np.intp)
+        self._index = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_index']
+        return state
+
+    def __setstate__(self, state):
+        """Restores a pickled instance. Instances pickled
+        before the dataset was array backed store a single
+        'dataframe' attribute, which is converted here.
+        """
+        if 'dataframe' in state:
+            df = state.pop('dataframe')
+            state['ids'] = df['orgId'].to_numpy(dtype=object)
+            state['names'] = df['orgName'].to_numpy(dtype=object)
+            state['purposes'] = df['orgPurpose'].to_numpy(dtype=object)
+        if 'active' not in state:
+            state['active'] = np.ones(len(state['ids']), dtype=bool)
+        self.__dict__.update(state)
+        self._build_index()
+
+    def _build_index(self):
+        """Rebuilds the org id to row index dictionary and the
+        retired row indices. If an id appears more than once, its
+        first active row is used.
+        """
+        self._index = {}
+        for row, org_id in enumerate(self.ids):
+            if self.active[row]:
+                self._index.setdefault(org_id, row)
+        self.retired_indices = np.flatnonzero(~self.active)
+
+    def active_count(self):
+        """Returns the number of orgs that were not removed."""
+        return len(self.ids) - len(self.retired_indices)
 
     def add_orgs(self, orgs):
         """Adds a list of 'Org' objects to the database.
@@ -32,31 +91,113 @@ class OrgDataset:
         Args:
             orgs (list): a list of Org objects
         """
-        data = []
-        for org in orgs:
-            data.append(org.data())
-        new_orgs = pd.DataFrame(data=data, columns=self.attributes)
-        self.dataframe = pd.concat([self.dataframe, new_orgs])
+        self.add_columns([org.org_id for org in orgs], [org.org_name for org in orgs],
+            [org.org_purpose for org in orgs])
+
+    def add_columns(self, ids, names, purposes):
+        """Adds orgs to the database given as parallel columns
+        rather than 'Org' objects. The purposes are stored as is,
+        they should already start with the org name.
+
+        Args:
+            ids (list): the org ids.
+            names (list): the org names.
+            purposes (list): the org descriptions.
+        """
+        start = len(self.ids)
+        new_ids = np.array(list(ids), dtype=object)
+        self.ids = np.concatenate([self.ids, new_ids])
+        self.names = np.concatenate([self.names, np.array(list(names), dtype=object)])
+        self.purposes = np.concatenate([self.purposes, np.array(list(purposes), dtype=object)])
+        self.active = np.concatenate([self.active, np.ones(len(new_ids), dtype=bool)])
+        for row, org_id in enumerate(new_ids, start):
+            self._index.setdefault(org_id, row)
+
+    def remove_orgs(self, ids):
+        """Removes the orgs with the supplied ids. Their rows
+        are retired rather than deleted, see the active attribute.
+        Ids that are not in the dataset are ignored.
+
+        Args:
+            ids (list): a list (or np array) of strings
+                where each entry is an organization id.
+
+        Returns:
+            a numpy array of integers containing the row indices
+            that were retired.
+        """
+        rows = self.get_indices_by_id(ids)
+        if len(rows) == 0:
+            return rows
+        self.active = self.active.copy()
+        self.active[rows] = False
+        for org_id in self.ids[rows]:
+            self._index.pop(org_id, None)
+        self.retired_indices = np.union1d(self.retired_indices, rows)
+        return rows
+
+    def compact(self):
+        """Returns a new OrgDataset holding only the active
+        orgs, with consecutive row indices.
+        """
+        od = OrgDataset()
+        rows = np.flatnonzero(self.active)
+        od.ids = self.ids[rows]
+        od.names = self.names[rows]
+        od.purposes = self.purposes[rows]
+        od.active = np.ones(len(rows), dtype=bool)
+        od._build_index()
+        return od
+
+    @property
+    def dataframe(self):
+        """A pandas dataframe containing all of the
+        organization data. See 'to_dataframe'.
+        """
+        return self.to_dataframe()
+
+    def to_dataframe(self, indices=None):
+        """Exports the database as a pandas dataframe. The
+        dataframe is a copy, modifying it does not modify
+        the dataset.
+
+        Args:
+            indices (list): an optional list of integers
+                representing which rows should be exported.
+                If no value is provided, all rows are exported.
+
+        Returns:
+            a dataframe with the columns listed in the
+            attributes attribute, indexed by row index.
+        """
+        if indices is None:
+            indices = np.arange(len(self.ids))
+        indices = np.asarray(indices, dtype=np.intp)
+        import pandas as pd
+        return pd.DataFrame(data=self.get_orgs_by_indices(indices),
+            columns=self.attributes, index=indices)
 
     def get_orgs_by_indices(self, indices):
-        """Returns the rows of the dataframe with
+        """Returns the rows of the database with
         indices equal to the supplied indices.
 
         Args:
             indices (list): A python list of integers.
 
         Returns:
-            A subset of the dataframe containing all
-            organizations stored. All fields of the
-            dataframe are returned.
+            A 2d numpy array with one row per index. The
+            columns are in the same order as the attributes
+            attribute: id, name and description.
         """
-        return self.dataframe.iloc[indices]
+        indices = np.asarray(indices, dtype=np.intp)
+        return np.stack([self.ids[indices], self.names[indices],
+            self.purposes[indices]], axis=1)
 
     def get_org_descriptions(self, indices=None):
         """
         Args:
             indices (list): an optional list of integers
-                representing which rows of the orgs dataframe
+                representing which rows of the database
                 should have descriptions returned. If no value is
                 provided, all org descriptions are returned.
 
@@ -66,10 +207,8 @@ class OrgDataset:
             the 'Org' name concatenated with the 'Org' purpose.
         """
         if indices is not None:
-            df = self.get_orgs_by_indices(indices)
-        else:
-            df = self.dataframe
-        return df['orgPurpose'].to_numpy()
+            return self.purposes[np.asarray(indices, dtype=np.intp)]
+        return self.purposes
 
     def get_random_org_ids(self, num):
         """Fetches random org descriptions from the
@@ -83,34 +222,78 @@ class OrgDataset:
             a numpy array of strings containing the random
             org ids.
         """
-        indices = np.random.randint(0, self.dataframe.shape[0], num)
-        return self.get_orgs_by_indices(indices)['orgId'].to_numpy()
+        if len(self.retired_indices) == 0:
+            indices = np.random.randint(0, len(self.ids), num)
+        else:
+            indices = np.random.choice(np.flatnonzero(self.active), num)
+        return self.ids[indices]
+
+    def get_org_ids(self, indices=None):
+        """
+        Args:
+            indices (list): an optional list of integers
+                representing which rows of the database
+                should have ids returned. If no value is provided,
+                all org ids are returned.
+
+        Returns:
+            a numpy array of strings containing the org ids, in
+            the same order as indices.
+        """
+        if indices is not None:
+            return self.ids[np.asarray(indices, dtype=np.intp)]
+        return self.ids
+
+    def get_indices_by_id(self, ids):
+        """Gets the row indices of the orgs with the supplied
+        ids. Ids that are not in the dataset are ignored, and ids
+        listed more than once only count once, so a profile that
+        lists an org twice does not weigh it twice.
+
+        Args:
+            ids (list): a list (or np array) of strings
+                where each entry is an organization id.
+
+        Returns:
+            a numpy array of integers containing the row indices
+            of the matching orgs, in the order of the first
+            occurrence of each id.
+        """
+        index = self._index
+        rows = [index[org_id] for org_id in dict.fromkeys(ids) if org_id in index]
+        return np.array(rows, dtype=np.intp)
+
+    def get_row(self, org_id):
+        """Returns the row index of the active org with id
+        org_id, or None if there is no such org.
+        """
+        return self._index.get(org_id)
 
     def get_orgs_by_id(self, ids, only_desc=False):
-        """Gets the rows of the database dataframe with
-        orgId equal to the supplied values.
+        """Gets the rows of the database with orgId
+        equal to the supplied values.
 
         Args:
             ids (list): a list (or np array) of strings
                 where each entry is an organization id.
             only_desc (bool, optional): defaults to False.
-                if set to True, rather than dataframe rows
-                being returned, only a list containing each
+                if set to True, rather than full rows
+                being returned, only an array containing each
                 organization's description will be returned.
 
         Returns:
             One of the following depending on the value for
             only_desc:
-                False: a dataframe containing the orgs with ids
-                    equal to ids.
+                False: a 2d array containing the orgs with ids
+                    equal to ids. See 'get_orgs_by_indices'.
                 True: an array containing only the organizations'
                     description strings.
         """
-        df = self.dataframe.loc[self.dataframe['orgId'].isin(ids)]
+        indices = self.get_indices_by_id(ids)
         if only_desc:
-            return df['orgPurpose'].to_numpy()
+            return self.get_org_descriptions(indices)
         else:
-            return df
+            return self.get_orgs_by_indices(indices)
 
     def save_instance(self, destination):
         """Saves OrgDataset instance to a pickle file
@@ -126,3 +309,45 @@ class OrgDataset:
     def load_instance(location):
         with open(location, 'rb') as f:
             return pickle.load(f)
+
+    def save_artifact(self, directory):
+        """Saves the org columns to the model artifact in
+        directory. See artifact_utils for the format.
+
+        Args:
+            directory (str): the artifact directory. It is
+                created if it does not exist.
+        """
+        artifact_utils.update_manifest(directory, 'orgs', {'count': len(self),
+            'retired': len(self.retired_indices)})
+        artifact_utils.save_strings(directory, 'org_ids', self.ids)
+        artifact_utils.save_array(directory, 'org_active', self.active)
+        artifact_utils.save_strings(directory, 'org_names', self.names)
+        artifact_utils.save_strings(directory, 'org_purposes', self.purposes)
+
+    @staticmethod
+    def load_artifact(directory, mmap=True):
+        """Loads an OrgDataset from the model artifact in
+        directory. No pickle data is read.
+
+        Args:
+            directory (str): the artifact directory.
+            mmap (bool): whether the arrays should be memory-mapped
+                while they are read.
+
+        Returns:
+            the OrgDataset stored in the artifact.
+        """
+        params = artifact_utils.read_manifest(directory)['orgs']
+        od = OrgDataset()
+        od.ids = artifact_utils.load_strings(directory, 'org_ids', mmap)
+        # Serving never reads names and descriptions, so they stay
+        # encoded, and shared between workers when memory-mapped.
+        od.names = artifact_utils.load_string_column(directory, 'org_names', mmap)
+        od.purposes = artifact_utils.load_string_column(directory, 'org_purposes', mmap)
+        if 'retired' in params:
+            od.active = np.array(artifact_utils.load_array(directory, 'org_active', mmap))
+        else:
+            od.active = np.ones(len(od.ids), dtype=bool)
+        od._build_index()
+        return od
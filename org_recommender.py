@@ -1,6 +1,25 @@
-from gcd_utils import get_account_liked_orgs, get_account_disliked_orgs
+from gcd_utils import get_account_profile, get_account_profiles
+import metrics
+import scipy.sparse as sp
 import numpy as np
 
+BATCH_SIZE = 256
+
+
+def batches(items, batch_size):
+    """Splits items into lists of at most batch_size entries,
+    keeping their order.
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
 class OrgRecommender:
     """This class encapsulates the functionality required
     to recommend new organizations to a given user, based
@@ -14,15 +33,20 @@ class OrgRecommender:
         vs (VectorSpace): an already initialized VectorSpace
             instance. This instance must be initialized with the
             same OrgDataset contained in dataset attr.
+        top_lists (TopLists or None): the precomputed top orgs of
+            every cluster centroid, followed by those of
+            vs.data_centroid, see top_lists.py. Used by
+            keyword_recommend if set.
     """
 
-    def __init__(self, org_dataset, org_vector_space):
+    def __init__(self, org_dataset, org_vector_space, top_lists=None):
         """Initializes an OrgRecommender with the given
         arguments. See class attribute documentation above
         for more info.
         """
         self.dataset = org_dataset
         self.vs = org_vector_space
+        self.top_lists = top_lists
 
     def recommend_orgs(self, user_id, num_orgs):
         """Uses vs attribute to provide recommended orgs
@@ -44,36 +68,213 @@ class OrgRecommender:
             A list of organization ids. These are the ids of the
             recommended orgs for the user.
         """
-        liked_orgs = get_account_liked_orgs(user_id)
-        disliked_orgs = get_account_disliked_orgs(user_id)
-        if len(liked_orgs) == 0:
-            return self.dataset.get_random_org_ids(num_orgs)
-        org_descs = self.dataset.get_orgs_by_id(liked_orgs, only_desc=True)
-        num_to_drop = len(org_descs)
-        org_vecs = self.vs.transform(org_descs)
-        centroid = np.mean(org_vecs, axis=0)
-        if len(disliked_orgs) >= 1:
-            disliked_org_descs = self.dataset.get_orgs_by_id(disliked_orgs, only_desc=True)
-            num_to_drop += len(disliked_orgs)
-            disliked_org_vecs = self.vs.transform(disliked_org_descs)
-            dis_centroid = np.mean(disliked_org_vecs, axis=0)
-            centroid -= dis_centroid
-            num_to_fetch = num_orgs + num_to_drop
-            df = self.vs.get_nearest_orgs(centroid, num_to_fetch)
-            df = df.loc[~df['orgId'].isin(liked_orgs)]
-            return_arr = df.loc[~df['orgId'].isin(disliked_orgs)]['orgId'].to_numpy()
-            if len(return_arr) >= num_orgs:
-                return return_arr[0:num_orgs]
+        return self.recommend_for_profile(get_account_profile(user_id), num_orgs)
+
+    def recommend_for_profile(self, profile, num_orgs):
+        """Recommends orgs for an already fetched user profile.
+        This is the part of recommend_orgs that does not talk to
+        Datastore, so it can be run separately from the fetch.
+
+        Args:
+            profile (AccountProfile): the user's profile, see
+                gcd_utils.get_account_profile.
+            num_orgs (int): the number of new orgs to
+                recommend.
+
+        Returns:
+            A list of organization ids. See recommend_orgs.
+        """
+        return self.recommend_for_profiles([profile], num_orgs)[0]
+
+    def recommend_for_profiles(self, profiles, num_orgs):
+        """Recommends orgs for several already fetched user
+        profiles at once. The centroids of all users are built as
+        one matrix, from the org embeddings the vector space searches
+        (see VectorSpace.get_search_vectors), and scored against
+        every org with a single matrix product.
+
+        Args:
+            profiles (list): a list of AccountProfile objects.
+            num_orgs (int): the number of new orgs to
+                recommend to each user.
+
+        Returns:
+            A list with one array of organization ids per profile,
+            in the same order as profiles. Users without any known
+            liked orgs get random orgs, like in recommend_orgs.
+        """
+        results = [None] * len(profiles)
+        rows, cols, weights = [], [], []
+        scored = []
+        for i, profile in enumerate(profiles):
+            liked_rows = self.dataset.get_indices_by_id(profile.liked_orgs)
+            if len(liked_rows) == 0:
+                results[i] = self.dataset.get_random_org_ids(num_orgs)
+                continue
+            # Like user_profiles.ProfileStore.seed, an org both liked
+            # and disliked only counts as liked.
+            disliked_rows = np.setdiff1d(
+                self.dataset.get_indices_by_id(profile.disliked_orgs), liked_rows)
+            row = len(scored)
+            scored.append(i)
+            # Row weights that turn a matrix product with the org
+            # embeddings into mean(liked) - mean(disliked).
+            org_rows = np.concatenate([liked_rows, disliked_rows])
+            rows.append(np.full(len(org_rows), row))
+            cols.append(org_rows)
+            weights.append(np.concatenate([
+                np.full(len(liked_rows), 1.0 / len(liked_rows)),
+                np.full(len(disliked_rows), -1.0 / max(len(disliked_rows), 1))]))
+        if len(scored) == 0:
+            return results
+        with metrics.stage('profile_centroids'):
+            shape = (len(scored), len(self.dataset))
+            rows = np.concatenate(rows)
+            cols = np.concatenate(cols)
+            weights = sp.csr_matrix((np.concatenate(weights), (rows, cols)), shape=shape)
+            excluded = sp.csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)),
+                shape=shape)
+            centroids = self.vs.weighted_search_vectors(weights)
+        self._recommend_centroids(centroids, excluded, scored, results, num_orgs)
+        return results
+
+    def recommend_for_queries(self, queries, excluded, num_orgs):
+        """Recommends orgs for precomputed query vectors, e.g. the
+        profiles kept by user_profiles.ProfileStore, without looking
+        at the orgs behind them.
+
+        Args:
+            queries (list): one query per user, a vector of the
+                space the vector space searches (see
+                VectorSpace.get_search_vectors), or None for users
+                without any known liked orgs.
+            excluded (list): one array per user of the org row
+                indices that must not be recommended to them.
+            num_orgs (int): the number of new orgs to
+                recommend to each user.
+
+        Returns:
+            A list with one array of organization ids per query, in
+            the same order as queries. Users without a query get
+            random orgs, like in recommend_orgs.
+        """
+        results = [None] * len(queries)
+        scored = []
+        for i, query in enumerate(queries):
+            if query is None:
+                results[i] = self.dataset.get_random_org_ids(num_orgs)
             else:
-                return return_arr
-        else:
-            num_to_fetch = num_orgs + num_to_drop
-            df = self.vs.get_nearest_orgs(centroid, num_to_fetch)
-            return_arr = df.loc[~df['orgId'].isin(disliked_orgs)]['orgId'].to_numpy()
-            if len(return_arr) >= num_orgs:
-                return return_arr[0:num_orgs]
+                scored.append(i)
+        if len(scored) == 0:
+            return results
+        with metrics.stage('profile_centroids'):
+            if self.vs.n_components is None:
+                centroids = sp.vstack([queries[i] for i in scored], format='csr')
             else:
-                return return_arr
+                centroids = np.vstack([np.ravel(queries[i]) for i in scored])
+            rows = np.concatenate([np.full(len(excluded[i]), row)
+                for row, i in enumerate(scored)]).astype(np.intp)
+            cols = np.concatenate([excluded[i] for i in scored]).astype(np.intp)
+            excluded = sp.csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)),
+                shape=(len(scored), len(self.dataset)))
+        self._recommend_centroids(centroids, excluded, scored, results, num_orgs)
+        return results
+
+    def _recommend_centroids(self, centroids, excluded, scored, results, num_orgs):
+        indices, _ = self.vs.get_nearest_indices(centroids, num_orgs, exclude=excluded)
+        with metrics.stage('org_ids'):
+            for row, i in enumerate(scored):
+                org_rows = indices[row]
+                results[i] = self.dataset.get_org_ids(org_rows[org_rows >= 0])
+
+    def recommend_many(self, user_ids, num_orgs, batch_size=BATCH_SIZE, cache=None):
+        """Recommends orgs for many users. Users are processed in
+        batches: the profiles of a batch are fetched with
+        gcd_utils.get_account_profiles and scored together, see
+        recommend_batch. Results are yielded as soon as their batch
+        is done, so memory use is bounded by batch_size.
+
+        Args:
+            user_ids (iterable): the ids of the users.
+            num_orgs (int): the number of new orgs to
+                recommend to each user.
+            batch_size (int): the number of users per batch.
+            cache (optional): see recommend_batch.
+
+        Yields:
+            (user_id, org_ids) tuples in the same order as user_ids.
+            org_ids is None for users without exactly one account.
+        """
+        for batch in batches(user_ids, batch_size):
+            yield from self.recommend_batch(batch, get_account_profiles(batch), num_orgs, cache)
+
+    def recommend_batch(self, user_ids, profiles, num_orgs, cache=None):
+        """Recommends orgs for one batch of users whose profiles
+        were already fetched. Users whose result is in cache are
+        not scored, the others are scored together with
+        recommend_for_profiles.
+
+        Args:
+            user_ids (list): the ids of the users.
+            profiles (dict): maps user id to AccountProfile, see
+                gcd_utils.get_account_profiles. Users left out get
+                no recommendations.
+            num_orgs (int): the number of new orgs to
+                recommend to each user.
+            cache (optional): an object with get(profile, num_orgs)
+                and put(profile, org_ids, num_orgs) methods, e.g. a
+                result_cache.ProfileResultCache. Results of users
+                without known liked orgs are random and not cached.
+
+        Returns:
+            a list of (user_id, org_ids) tuples in the same order as
+            user_ids. org_ids is None for users not in profiles.
+        """
+        recs = {}
+        misses = []
+        for user_id in dict.fromkeys(user_ids):
+            if user_id not in profiles:
+                continue
+            cached = None if cache is None else cache.get(profiles[user_id], num_orgs)
+            if cached is None:
+                misses.append(user_id)
+            else:
+                recs[user_id] = cached
+        if len(misses) > 0:
+            computed = self.recommend_for_profiles([profiles[u] for u in misses], num_orgs)
+            for user_id, org_ids in zip(misses, computed):
+                recs[user_id] = org_ids
+                profile = profiles[user_id]
+                if cache is not None and \
+                        len(self.dataset.get_indices_by_id(profile.liked_orgs)) > 0:
+                    cache.put(profile, org_ids, num_orgs)
+        return [(user_id, recs.get(user_id)) for user_id in user_ids]
+
+    def keyword_recommend(self, matcher, keywords, num_orgs):
+        """Recommends the orgs closest to the keyword centroid of
+        matcher, see KeywordMatcher.get_kw_centroid. The
+        precomputed top_lists of the matching clusters are merged
+        when they are known to hold the answer, otherwise every org
+        is scored with centroid_recommend.
+
+        Args:
+            matcher (KeywordMatcher): the keyword labels of the
+                clusters top_lists was built from.
+            keywords (list): a list of strings.
+            num_orgs (int): the number of orgs to fetch.
+
+        Returns:
+            a list of strings, each entry is an org id.
+        """
+        if self.top_lists is not None:
+            list_ids = matcher.get_kw_clusters(keywords)
+            if len(list_ids) == 0:
+                # The last list is the one of data_centroid.
+                list_ids = [len(self.top_lists.indices) - 1]
+            indices = self.top_lists.merge(list_ids, num_orgs)
+            if indices is not None:
+                return self.dataset.get_org_ids(indices)
+        return self.centroid_recommend(matcher.get_kw_centroid(keywords), num_orgs)
 
     def centroid_recommend(self, centroid, num_orgs):
         """Provides organization recommendations based off
@@ -90,5 +291,5 @@ class OrgRecommender:
         Returns:
             a list of strings, each entry is an org id.
         """
-        df = self.vs.get_nearest_orgs(centroid, num_orgs)
-        return df['orgId'].to_numpy()
+        indices, _ = self.vs.get_nearest_indices(centroid, num_orgs)
+        return self.dataset.get_org_ids(indices[0])
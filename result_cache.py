@@ -0,0 +1,111 @@
+"""
+A bounded LRU cache of recommendation results.
+
+Recommendations only depend on the model and on the liked and disliked
+orgs of a user, or on the tags for initial recommendations, so equal
+inputs can share a result. Keys include the model version, and the API
+also clears the cache whenever a new snapshot is swapped in.
+
+A result computed for n orgs also serves every request for k <= n
+orgs, since the top k orgs are a prefix of the top n.
+"""
+import hashlib
+import threading
+from cachetools import LRUCache
+
+RESULT_CACHE_SIZE = 10000
+
+
+def _digest(parts):
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(str(part).encode('utf-8'))
+        h.update(b'\x1f')
+    return h.hexdigest()
+
+
+def profile_key(profile, model_version):
+    """Returns the cache key of the recommendations for profile.
+    The order of the liked and disliked orgs does not matter.
+
+    Args:
+        profile (AccountProfile): the user's profile.
+        model_version (str): the version of the snapshot used.
+    """
+    parts = sorted(profile.liked_orgs) + ['\x1e'] + sorted(profile.disliked_orgs)
+    return ('profile', model_version, _digest(parts))
+
+
+def stored_profile_key(user_id, revision, model_version):
+    """Returns the cache key of the recommendations for revision
+    revision of a profile kept by user_profiles.ProfileStore.
+    """
+    return ('stored', model_version, user_id, revision)
+
+
+def tags_key(tags, model_version):
+    """Returns the cache key of the initial recommendations for a
+    list of tags. The order of the tags does not matter.
+    """
+    return ('tags', model_version, _digest(sorted(tags)))
+
+
+class ResultCache:
+    """A thread safe LRU cache of org id lists.
+
+    Attributes:
+        maxsize (int): the maximum number of cached results.
+        hits (int): the number of lookups served from the cache.
+        misses (int): the number of lookups that were not.
+    """
+
+    def __init__(self, maxsize=RESULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    def get(self, key, num_orgs):
+        """Returns the first num_orgs org ids cached under key, or
+        None if no result for at least num_orgs orgs is cached.
+        """
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None or entry[1] < num_orgs:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return entry[0][:num_orgs]
+
+    def put(self, key, org_ids, num_orgs):
+        """Caches org_ids, the result of a request for num_orgs
+        orgs, under key. A cached result for more orgs is kept.
+        """
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None or entry[1] < num_orgs:
+                self._cache[key] = (list(org_ids), num_orgs)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class ProfileResultCache:
+    """The results of one model version in a ResultCache, looked up
+    by profile, see profile_key and OrgRecommender.recommend_batch.
+    """
+
+    def __init__(self, cache, model_version):
+        self.cache = cache
+        self.model_version = model_version
+
+    def get(self, profile, num_orgs):
+        return self.cache.get(profile_key(profile, self.model_version), num_orgs)
+
+    def put(self, profile, org_ids, num_orgs):
+        self.cache.put(profile_key(profile, self.model_version), org_ids, num_orgs)
@@ -0,0 +1,39 @@
+import os
+import pytest
+from sklearn.feature_extraction.text import TfidfVectorizer
+import fast_tfidf
+from org_dataset import OrgDataset
+from vector_space import VectorSpace
+
+CORPUS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'orgs.pkl')
+EDGE_CASES = [
+    '',
+    '   ',
+    'Café Français naïve Ünïcödé 東京 大学 Straße',
+    'Room 101 2020 a1 b2 3d 42',
+    'snake_case __init__ _ __ foo_bar_baz',
+    'x y z',
+    'the and of',
+    'club club CLUB Club',
+]
+
+
+@pytest.fixture(scope='module')
+def dataset():
+    return OrgDataset.load_instance(CORPUS)
+
+
+@pytest.fixture(scope='module')
+def documents(dataset):
+    return list(dataset.get_org_descriptions()) + EDGE_CASES
+
+
+def test_parity_with_vector_space_vectorizer(dataset, documents):
+    vs = VectorSpace(dataset)
+    fast_tfidf.check_parity(vs.vectorizer, documents)
+
+
+@pytest.mark.parametrize('params', [{'norm': 'l1'}, {'norm': None}, {'sublinear_tf': True}])
+def test_parity_with_vectorizer_options(documents, params):
+    vectorizer = TfidfVectorizer(**params).fit(documents)
+    fast_tfidf.check_parity(vectorizer, documents)
@@ -0,0 +1,213 @@
+import os
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from gcd_utils import AccountProfile
+from org_dataset import OrgDataset
+from org_recommender import OrgRecommender
+import user_profiles
+from user_profiles import JOURNAL_NAME, ProfileStore
+from vector_space import VectorSpace
+
+CORPUS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'orgs.pkl')
+
+
+@pytest.fixture(scope='module')
+def dataset():
+    return OrgDataset.load_instance(CORPUS)
+
+
+@pytest.fixture(scope='module', params=[None, 50], ids=['tfidf', 'lsa'])
+def snapshot(request, dataset):
+    vs = VectorSpace(dataset, n_components=request.param)
+    return SimpleNamespace(version='v1', vs=vs, dataset=dataset)
+
+
+def random_profiles(dataset, count, seed=0):
+    rng = np.random.RandomState(seed)
+    profiles = {}
+    for user in range(count):
+        orgs = rng.choice(dataset.ids, rng.randint(2, 12), replace=False)
+        split = rng.randint(1, len(orgs))
+        profiles['user{}'.format(user)] = AccountProfile(list(orgs[:split]),
+            list(orgs[split:]), [])
+    return profiles
+
+
+def build_with_events(store, profiles, seed=0):
+    """Seeds every user with an empty profile and reaches the
+    likes and dislikes of profiles through events, including moves
+    between the two sides and removals.
+    """
+    rng = np.random.RandomState(seed)
+    ids = store._dataset.ids
+    for user_id, profile in profiles.items():
+        store.seed(user_id, AccountProfile([], [], []))
+        for org_id in rng.choice(ids, 3, replace=False):
+            store.apply(user_id, org_id, 'dislike' if rng.rand() < 0.5 else 'like')
+            store.apply(user_id, org_id, 'remove')
+        for org_id in profile.disliked_orgs:
+            store.apply(user_id, org_id, 'like')
+        for org_id in profile.liked_orgs:
+            store.apply(user_id, org_id, 'like')
+        for org_id in profile.disliked_orgs:
+            store.apply(user_id, org_id, 'dislike')
+
+
+def dense(query):
+    return query.toarray().ravel() if hasattr(query, 'toarray') else np.ravel(query)
+
+
+def assert_same_queries(store, expected, version, user_ids):
+    for user_id in user_ids:
+        query, excluded = store.query(user_id, version)
+        expected_query, expected_excluded = expected.query(user_id, version)
+        # Dense search vectors are float32, summed in another order.
+        np.testing.assert_allclose(dense(query), dense(expected_query), rtol=1e-5, atol=1e-8)
+        assert sorted(excluded) == sorted(expected_excluded)
+
+
+def test_event_queries_match_recommend_for_profiles(snapshot):
+    profiles = random_profiles(snapshot.dataset, 100)
+    store = ProfileStore(snapshot, ttl=None)
+    build_with_events(store, profiles)
+    recommender = OrgRecommender(snapshot.dataset, snapshot.vs)
+    user_ids = list(profiles)
+    entries = [store.query(user_id, snapshot.version) for user_id in user_ids]
+    from_events = recommender.recommend_for_queries([entry[0] for entry in entries],
+        [entry[1] for entry in entries], 10)
+    from_profiles = recommender.recommend_for_profiles([profiles[u] for u in user_ids], 10)
+    for events_recs, profile_recs in zip(from_events, from_profiles):
+        assert list(events_recs) == list(profile_recs)
+
+
+def test_seeded_queries_match_recommend_for_profiles_with_repeated_orgs(snapshot):
+    ids = list(snapshot.dataset.ids)
+    profile = AccountProfile(ids[:4] + ids[:2] + ['unknown'], ids[3:6] + ids[5:6], [])
+    store = ProfileStore(snapshot, ttl=None)
+    store.seed('user', profile)
+    recommender = OrgRecommender(snapshot.dataset, snapshot.vs)
+    query, excluded = store.query('user', snapshot.version)
+    from_store = recommender.recommend_for_queries([query], [excluded], 10)[0]
+    from_profile = recommender.recommend_for_profiles([profile], 10)[0]
+    assert list(from_store) == list(from_profile)
+    assert snapshot.dataset.get_indices_by_id(['x', ids[2], ids[1], ids[2]]).tolist() == [2, 1]
+
+
+def test_save_load_round_trip(snapshot, tmp_path):
+    profiles = random_profiles(snapshot.dataset, 30)
+    store = ProfileStore.load(str(tmp_path), snapshot, ttl=None)
+    build_with_events(store, profiles)
+    store.save()
+    assert os.path.getsize(os.path.join(str(tmp_path), JOURNAL_NAME)) == 0
+    # Events after the save are only in the journal.
+    store.apply('user0', snapshot.dataset.ids[0], 'dislike')
+    store.close()
+    loaded = ProfileStore.load(str(tmp_path), snapshot, ttl=None)
+    assert loaded.model_version == snapshot.version
+    assert len(loaded) == len(store)
+    assert_same_queries(loaded, store, snapshot.version, profiles)
+    loaded.close()
+
+
+def test_load_replays_journal_of_unfinished_save(snapshot, tmp_path, monkeypatch):
+    store = ProfileStore.load(str(tmp_path), snapshot, ttl=None)
+    ids = snapshot.dataset.ids
+    store.seed('user', AccountProfile(list(ids[:2]), [], []))
+
+    def fail(state):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(store, '_write_snapshot', fail)
+    with pytest.raises(OSError):
+        store.save()
+    store.apply('user', ids[2], 'dislike')
+    loaded = ProfileStore.load(str(tmp_path), snapshot, ttl=None)
+    assert_same_queries(loaded, store, snapshot.version, ['user'])
+    loaded.close()
+
+
+def test_torn_journal_line_is_truncated(snapshot, tmp_path):
+    store = ProfileStore.load(str(tmp_path), snapshot, ttl=None)
+    ids = snapshot.dataset.ids
+    store.seed('user', AccountProfile(list(ids[:2]), [], []))
+    store.apply('user', ids[2], 'like')
+    # Not closed, which would save the store and empty the journal.
+    journal = os.path.join(str(tmp_path), JOURNAL_NAME)
+    valid_bytes = os.path.getsize(journal)
+    assert valid_bytes > 0
+    with open(journal, 'a') as f:
+        f.write('{"userId": "user", "orgId": "' + ids[3] + '", "act')
+    loaded = ProfileStore.load(str(tmp_path), snapshot, ttl=None)
+    assert os.path.getsize(journal) == valid_bytes
+    expected = ProfileStore(snapshot, ttl=None)
+    expected.seed('user', AccountProfile(list(ids[:3]), [], []))
+    assert_same_queries(loaded, expected, snapshot.version, ['user'])
+    # New events start on a fresh line.
+    loaded.apply('user', ids[4], 'dislike')
+    loaded.close()
+    reloaded = ProfileStore.load(str(tmp_path), snapshot, ttl=None)
+    expected.apply('user', ids[4], 'dislike')
+    assert_same_queries(reloaded, expected, snapshot.version, ['user'])
+    reloaded.close()
+
+
+def test_rebase_replays_events_applied_meanwhile(snapshot, dataset, monkeypatch):
+    profiles = random_profiles(dataset, 20)
+    store = ProfileStore(snapshot, ttl=None)
+    for user_id, profile in profiles.items():
+        store.seed(user_id, profile)
+    # A space of the other kind, so every sum changes type.
+    new_snapshot = SimpleNamespace(version='v2', dataset=dataset,
+        vs=VectorSpace(dataset, n_components=None if snapshot.vs.n_components else 20))
+    event = ('user0', dataset.ids[-1], 'like')
+    seed = ProfileStore._seed
+
+    def seed_and_apply(self, *args):
+        if self is not store and store._pending == []:
+            assert store.apply(*event)
+        seed(self, *args)
+
+    monkeypatch.setattr(ProfileStore, '_seed', seed_and_apply)
+    store.rebase(new_snapshot)
+    monkeypatch.setattr(ProfileStore, '_seed', seed)
+    assert store.model_version == 'v2'
+    assert store.query('user0', 'v1') is None
+    expected = ProfileStore(new_snapshot, ttl=None)
+    for user_id, profile in profiles.items():
+        expected.seed(user_id, profile)
+    expected.apply(*event)
+    assert_same_queries(store, expected, 'v2', profiles)
+
+
+def test_load_of_another_version_waits_for_rebase(snapshot, tmp_path):
+    profiles = random_profiles(snapshot.dataset, 10)
+    old_snapshot = SimpleNamespace(version='v0', vs=snapshot.vs, dataset=snapshot.dataset)
+    store = ProfileStore.load(str(tmp_path), old_snapshot, ttl=None)
+    for user_id, profile in profiles.items():
+        store.seed(user_id, profile)
+    store.close()
+    loaded = ProfileStore.load(str(tmp_path), snapshot, ttl=None)
+    assert loaded.model_version is None
+    assert loaded.query('user0', snapshot.version) is None
+    loaded.rebase(snapshot)
+    expected = ProfileStore(snapshot, ttl=None)
+    for user_id, profile in profiles.items():
+        expected.seed(user_id, profile)
+    assert_same_queries(loaded, expected, snapshot.version, profiles)
+    loaded.close()
+
+
+def test_profiles_expire_after_ttl(snapshot, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(user_profiles.time, 'time', lambda: now[0])
+    store = ProfileStore(snapshot, ttl=60)
+    ids = snapshot.dataset.ids
+    store.seed('user', AccountProfile(list(ids[:2]), [], []))
+    assert store.revision('user', snapshot.version) is not None
+    store.seed('user', AccountProfile(list(ids[2:4]), [], []))
+    assert sorted(store.query('user', snapshot.version)[1]) == [0, 1]
+    now[0] += 61
+    assert store.revision('user', snapshot.version) is None
+    store.seed('user', AccountProfile(list(ids[2:4]), [], []))
+    assert sorted(store.query('user', snapshot.version)[1]) == [2, 3]
@@ -0,0 +1,156 @@
+"""
+Precomputed top-k org lists for keyword recommendations.
+
+Initial recommendations score the orgs against a mean of cluster
+centroids, or against the centroid of all orgs when no keyword
+matches. There are only a few such centroids per model, so the build
+step ranks the orgs for each of them once and stores the best k as a
+list, along with the similarity of each listed org to every centroid.
+A request merges the lists of its clusters from those stored scores
+alone, without touching the org matrix.
+
+The result is exact. Every org missing from list j scores at most the
+last score of that list against centroid j, so the weighted sum of
+those last scores bounds the score of every org missing from all the
+merged lists. If the merged top orgs do not all beat that bound, merge
+returns None and the caller falls back to scoring every org.
+"""
+import numpy as np
+import artifact_utils
+import metrics
+
+TOP_LIST_SIZE = 1000
+# Margin of the bound check, covering rounding differences between
+# the ranking and the stored scores.
+SCORE_TOLERANCE = 1e-6
+
+
+class TopLists:
+    """The top orgs of a fixed set of query centroids.
+
+    Scores are dot products between the unnormalized centroids and
+    the normalized org vectors of the space the vector space
+    searches. A weighted sum of centroids therefore scores each org
+    with the same weighted sum of its scores, and ranks the orgs like
+    the cosine similarity to the mean of those centroids does.
+
+    Attributes:
+        indices (numpy array): shape (number of lists, k), the org
+            row indices of each list from most to least similar.
+            Lists of fewer than k orgs are padded with -1.
+        scores (numpy array): shape (number of lists, k, number of
+            lists), the score of each listed org against every list
+            centroid. Padding entries are 0.
+    """
+
+    def __init__(self, indices, scores):
+        self.indices = indices
+        self.scores = scores
+
+    @property
+    def k(self):
+        return self.indices.shape[1]
+
+    @staticmethod
+    def build(vs, centroids, k=TOP_LIST_SIZE):
+        """Ranks the orgs of vs for every centroid.
+
+        Args:
+            vs (VectorSpace): the vector space to search. It should
+                use exact search, i.e. have no search backend set.
+            centroids (array): one centroid per list, from the tfidf
+                space of vs.
+            k (int): the length of the lists.
+
+        Returns:
+            a TopLists instance.
+        """
+        centroids = np.atleast_2d(np.asarray(centroids, dtype=np.float64))
+        found, _ = vs.get_nearest_indices(centroids, k)
+        n_lists = len(centroids)
+        indices = np.full((n_lists, k), -1, dtype=np.int64)
+        indices[:, :found.shape[1]] = found
+        search_centroids = centroids
+        if vs.n_components is not None:
+            search_centroids = vs.project(centroids)
+        norms = np.sqrt((np.asarray(search_centroids, dtype=np.float64) ** 2).sum(axis=1))
+        sims = vs.get_similarities(centroids) * norms[:, np.newaxis]
+        scores = np.zeros((n_lists, k, n_lists))
+        for i in range(n_lists):
+            rows = indices[i][indices[i] >= 0]
+            scores[i, :len(rows)] = sims[:, rows].T
+        return TopLists(indices, scores)
+
+    @metrics.timed('top_lists')
+    def merge(self, list_ids, num_orgs):
+        """Finds the num_orgs orgs closest to the mean of the
+        centroids of list_ids, from the orgs in those lists only.
+
+        Args:
+            list_ids (list): the lists to merge. A list id given
+                several times weighs that centroid several times.
+            num_orgs (int): the number of orgs to return.
+
+        Returns:
+            an array of org row indices, from most to least similar,
+            or None if the lists cannot prove that they hold the
+            num_orgs closest orgs.
+        """
+        if num_orgs <= 0:
+            return np.arange(0, dtype=self.indices.dtype)
+        n_lists = len(self.indices)
+        weights = np.bincount(list_ids, minlength=n_lists).astype(np.float64)
+        used = np.flatnonzero(weights)
+        rows = self.indices[used].ravel()
+        listed = rows >= 0
+        rows = rows[listed]
+        totals = self.scores[used].reshape(-1, n_lists)[listed] @ weights
+        # An org is in at most len(used) of the lists, always with the
+        # same total, so the best num_orgs orgs are among the best
+        # num_orgs * len(used) entries.
+        need = min(num_orgs * len(used), len(rows))
+        if need <= 0:
+            return None
+        if need < len(rows):
+            top = np.argpartition(-totals, need - 1)[:need]
+        else:
+            top = np.arange(len(rows))
+        top = top[np.lexsort((rows[top], -totals[top]))]
+        _, first = np.unique(rows[top], return_index=True)
+        top = top[np.sort(first)[:num_orgs]]
+        if (self.indices[used, -1] < 0).any():
+            # One of the lists holds every org.
+            return rows[top]
+        bound = weights[used] @ self.scores[used, -1, used]
+        if len(top) < num_orgs or totals[top[-1]] < bound + SCORE_TOLERANCE:
+            return None
+        return rows[top]
+
+    def save_artifact(self, directory):
+        """Saves the lists to the model artifact in directory.
+
+        Args:
+            directory (str): the artifact directory.
+        """
+        artifact_utils.update_manifest(directory, 'top_lists',
+            {'list_count': len(self.indices), 'k': self.k})
+        artifact_utils.save_array(directory, 'top_list_indices', self.indices)
+        artifact_utils.save_array(directory, 'top_list_scores', self.scores)
+
+    @staticmethod
+    def load_artifact(directory, mmap=True):
+        """Loads the lists stored in the model artifact in
+        directory.
+
+        Args:
+            directory (str): the artifact directory.
+            mmap (bool): whether the arrays should be memory-mapped.
+
+        Returns:
+            a TopLists instance, or None if the artifact was built
+            without lists.
+        """
+        if 'top_lists' not in artifact_utils.read_manifest(directory):
+            return None
+        return TopLists(artifact_utils.load_array(directory, 'top_list_indices', mmap),
+            artifact_utils.load_array(directory, 'top_list_scores', mmap))
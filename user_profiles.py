@@ -0,0 +1,596 @@
+"""
+Incrementally maintained user profile vectors.
+
+A recommendation query is the mean of the search vectors (see
+VectorSpace.get_search_vectors) of a user's liked orgs minus the mean
+of those of the disliked orgs. ProfileStore keeps the sums and counts
+behind those means for every user it knows. A like, dislike or remove
+event updates them in time proportional to the number of non-zeros of
+one org vector, and the query is built from the sums directly
+instead of from every liked and disliked org vector. Only the list of
+orgs excluded from the results still grows with the user's history.
+
+Users are seeded from their Datastore profile the first time they
+are seen, and re-seeded once their entry is older than the store's
+ttl. Datastore stays the source of truth: events posted to other
+instances reach this one through the re-seed, so a stored profile is
+at most ttl seconds behind, like a profile cached by gcd_utils. The
+sums are only valid for the model snapshot they were
+computed with: the store records its version, and rebase recomputes
+every sum from the stored org ids when a new snapshot is served.
+
+With a directory, the store is persisted as a snapshot of every user
+(written by save) plus a journal of the events applied since
+(events.jsonl). save copies the profiles and moves the journal aside
+under the store lock, and writes the files without it. load reads the
+snapshot and replays the journal moved aside by an unfinished save,
+then the current one. Events are assignments, e.g. "org x is liked",
+so replaying an event that the snapshot already contains changes
+nothing.
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import numpy as np
+import scipy.sparse as sp
+import artifact_utils
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LIKE = 'like'
+DISLIKE = 'dislike'
+REMOVE = 'remove'
+ACTIONS = (LIKE, DISLIKE, REMOVE)
+# Seconds a lookup waits for the store, e.g. while it is being saved
+# or rebased, before the caller falls back to computing the profile.
+LOOKUP_TIMEOUT = 0.01
+# Seconds after which a user is re-seeded from Datastore.
+PROFILE_TTL = 60
+JOURNAL_NAME = 'events.jsonl'
+# The journal of the events in the snapshot being written by save.
+SAVING_JOURNAL_NAME = 'events.saving.jsonl'
+SNAPSHOT_NAME = 'snapshot'
+
+_SIDES = {LIKE: 0, DISLIKE: 1}
+
+
+class UserProfile:
+    """The stored interactions of one user. Index 0 of each list
+    attribute holds the liked orgs, index 1 the disliked orgs.
+
+    Attributes:
+        orgs (list): two dicts mapping org id to the org's row in
+            the store's snapshot, or -1 if the org is not in it.
+        sums (list): the sums of the search vectors of the orgs in
+            the snapshot, a float64 array in the reduced space and a
+            dict mapping column to value in the tfidf space.
+        counts (list): the number of orgs summed.
+        revision (int): changes whenever the profile does, so it
+            can be part of cache keys.
+        seeded_at (float): the time.time() at which the profile was
+            seeded from Datastore.
+    """
+    __slots__ = ['orgs', 'sums', 'counts', 'revision', 'seeded_at']
+
+    def __init__(self):
+        self.orgs = [{}, {}]
+        self.sums = [None, None]
+        self.counts = [0, 0]
+        self.revision = 0
+        self.seeded_at = 0.0
+
+
+class ProfileStore:
+    """A thread safe store of UserProfiles.
+
+    Attributes:
+        directory (str or None): where the store is persisted, or
+            None to keep it in memory only.
+        model_version (str or None): the version of the snapshot
+            the sums were computed with, or None for a store loaded
+            from a snapshot of another model version until it is
+            rebased.
+        ttl (float or None): seconds after which a profile expires
+            and must be seeded again, or None if profiles never
+            expire, which is only correct with a single instance.
+    """
+
+    def __init__(self, snapshot, directory=None, ttl=PROFILE_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        self.model_version = None
+        self._use(snapshot)
+        self._profiles = {}
+        self._revision = 0
+        self._lock = threading.Lock()
+        self._journal = None
+        self._saver = None
+        self._stop_saving = threading.Event()
+        self._save_lock = threading.Lock()
+        # While save reads the org ids and sums without the lock,
+        # they are replaced rather than updated in place.
+        self._saving = False
+        # While a rebase runs, the journal entries applied meanwhile,
+        # which it replays on the rebased profiles.
+        self._pending = None
+        self._rebase_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._profiles)
+
+    def revision(self, user_id, model_version):
+        """Returns the revision of the user's profile, or None if
+        the user is unknown, their profile expired or the store is not
+        on model_version.
+        """
+        profile = self._profiles.get(user_id)
+        if profile is None or model_version != self.model_version or self._expired(profile):
+            return None
+        return profile.revision
+
+    @metrics.timed('profile_query')
+    def query(self, user_id, model_version):
+        """Builds the recommendation query of a user.
+
+        Args:
+            user_id (str): the id of the user.
+            model_version (str): the version of the snapshot the
+                query will be scored with.
+
+        Returns:
+            a tuple (query, excluded), or None if the user is
+            unknown, their profile expired, the store is not on
+            model_version or it is busy. query is a search space vector, a 1d array in the
+            reduced space and a 1 row csr matrix otherwise, or None
+            if the user likes no org of the snapshot. excluded holds
+            the rows of every liked and disliked org.
+        """
+        if not self._lock.acquire(timeout=LOOKUP_TIMEOUT):
+            return None
+        try:
+            profile = self._profiles.get(user_id)
+            if profile is None or model_version != self.model_version \
+                    or self._expired(profile):
+                return None
+            excluded = np.fromiter((row for orgs in profile.orgs for row in orgs.values()
+                if row >= 0), dtype=np.intp)
+            if profile.counts[0] == 0:
+                return None, excluded
+            liked, disliked = (self._scaled(profile, side) for side in (0, 1))
+            if isinstance(liked, np.ndarray):
+                return liked - disliked, excluded
+            query = dict(liked)
+            for col, value in disliked.items():
+                query[col] = query.get(col, 0.0) - value
+            cols = np.fromiter(query.keys(), dtype=np.intp, count=len(query))
+            values = np.fromiter(query.values(), dtype=np.float64, count=len(query))
+            return sp.csr_matrix((values, (np.zeros(len(cols), dtype=np.intp), cols)),
+                shape=(1, self._dim)), excluded
+        finally:
+            self._lock.release()
+
+    def seed(self, user_id, account_profile):
+        """Adds a user to the store with the interactions of their
+        Datastore profile, which should be freshly fetched. This
+        costs one vector per org, so it is only done when a user is
+        first seen or their profile expired. Does nothing if the
+        user's profile has not expired, since its events are newer.
+
+        Args:
+            user_id (str): the id of the user.
+            account_profile (AccountProfile): the user's profile,
+                see gcd_utils.get_account_profile.
+        """
+        liked = list(dict.fromkeys(account_profile.liked_orgs))
+        disliked = [org_id for org_id in dict.fromkeys(account_profile.disliked_orgs)
+            if org_id not in set(liked)]
+        seeded_at = time.time()
+        with self._lock:
+            profile = self._profiles.get(user_id)
+            if profile is not None and not self._expired(profile):
+                return
+            self._seed(user_id, liked, disliked, seeded_at)
+            self._log({'userId': user_id, 'liked': liked, 'disliked': disliked,
+                'seededAt': seeded_at})
+
+    def apply(self, user_id, org_id, action):
+        """Applies a like, dislike or remove event to a user's
+        profile. Liking a disliked org moves it, and the other way
+        around.
+
+        Args:
+            user_id (str): the id of the user.
+            org_id (str): the id of the org.
+            action (str): one of ACTIONS.
+
+        Returns:
+            True if the event was applied, False if the user is not
+            in the store and must be seeded first.
+
+        Raises:
+            ValueError: if action is not one of ACTIONS.
+        """
+        if action not in ACTIONS:
+            raise ValueError('Unknown profile action {!r}, expected one of {}.'
+                .format(action, ', '.join(ACTIONS)))
+        with self._lock:
+            if user_id not in self._profiles:
+                return False
+            self._apply(user_id, org_id, action)
+            self._log({'userId': user_id, 'orgId': org_id, 'action': action})
+            return True
+
+    def rebase(self, snapshot):
+        """Recomputes every profile for a new model snapshot, e.g.
+        as a ModelRegistry listener. A snapshot of the same version
+        has the same rows, so only the references are swapped.
+
+        The profiles are recomputed without holding the store lock,
+        so events and lookups on the previous version go on
+        meanwhile. The events applied during the rebase are replayed
+        on the rebased profiles, which are then swapped in. Lookups
+        for the new version fall back to the caller until then.
+        """
+        with self._rebase_lock:
+            with self._lock:
+                if snapshot.version == self.model_version:
+                    self._use(snapshot)
+                    return
+                users = [(user_id, list(profile.orgs[0]), list(profile.orgs[1]),
+                    profile.seeded_at) for user_id, profile in self._profiles.items()]
+                self._pending = []
+                rebased = ProfileStore(snapshot)
+                rebased._revision = self._revision
+            try:
+                for user_id, liked, disliked, seeded_at in users:
+                    rebased._seed(user_id, liked, disliked, seeded_at)
+            except Exception:
+                with self._lock:
+                    self._pending = None
+                raise
+            with self._lock:
+                for entry in self._pending:
+                    rebased._replay_entry(entry)
+                self._pending = None
+                self._use(snapshot)
+                self._profiles = rebased._profiles
+                self._revision = max(self._revision, rebased._revision)
+            logger.info('Rebased %d user profiles on model %s.', len(users), snapshot.version)
+
+    def save(self):
+        """Writes every profile to directory and empties the
+        journal. Does nothing for an in memory store.
+
+        Only taking references to the org ids and sums holds the
+        store lock, so events and lookups go on while the sums
+        are serialized and the files are written. The journal is
+        moved aside at the same time and deleted once the snapshot is
+        in place.
+        """
+        if self.directory is None:
+            return
+        with self._save_lock:
+            with self._lock:
+                state = self._collect()
+                self._rotate_journal()
+                self._saving = True
+            try:
+                self._write_snapshot(self._flatten(state))
+            finally:
+                with self._lock:
+                    self._saving = False
+            os.remove(os.path.join(self.directory, SAVING_JOURNAL_NAME))
+
+    def start_saving(self, interval):
+        """Starts a background thread that saves the store every
+        interval seconds.
+        """
+        if self._saver is not None or self.directory is None:
+            return
+        self._stop_saving.clear()
+
+        def run():
+            while not self._stop_saving.wait(interval):
+                try:
+                    self.save()
+                except Exception:
+                    logger.exception('Saving the user profiles to %s failed.', self.directory)
+
+        self._saver = threading.Thread(target=run, name='profile-saver', daemon=True)
+        self._saver.start()
+
+    def close(self):
+        """Stops the background saving, saves the store and closes
+        the journal.
+        """
+        self._stop_saving.set()
+        self._saver = None
+        self.save()
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    @staticmethod
+    def load(directory, snapshot, ttl=PROFILE_TTL):
+        """Loads the store persisted in directory, or creates an
+        empty one there. Profiles saved for another model version
+        only keep their org ids, and the store has no model_version
+        until rebase(snapshot) recomputes their sums. That takes
+        about a millisecond per user, so callers should rebase in
+        the background; lookups fall back to the caller meanwhile.
+
+        Args:
+            directory (str): the store directory.
+            snapshot (ModelSnapshot): the snapshot being served.
+            ttl (float or None): see the class attributes.
+
+        Returns:
+            a ProfileStore.
+        """
+        os.makedirs(directory, exist_ok=True)
+        store = ProfileStore(snapshot, directory, ttl)
+        path = os.path.join(directory, SNAPSHOT_NAME)
+        if os.path.isdir(path):
+            store._read_snapshot(path)
+        for name in [SAVING_JOURNAL_NAME, JOURNAL_NAME]:
+            journal = os.path.join(directory, name)
+            if os.path.exists(journal):
+                store._replay(journal)
+        store._journal = open(os.path.join(directory, JOURNAL_NAME), 'a')
+        return store
+
+    def _use(self, snapshot):
+        # Only the vector space and dataset are kept, not the
+        # snapshot, which ModelRegistry waits on to be released.
+        self.model_version = snapshot.version
+        self._vs = snapshot.vs
+        self._dataset = snapshot.dataset
+        self._dim = snapshot.vs.n_components or len(snapshot.vs.data_centroid)
+
+    def _expired(self, profile):
+        return self.ttl is not None and time.time() - profile.seeded_at > self.ttl
+
+    def _scaled(self, profile, side):
+        total = profile.sums[side]
+        count = max(profile.counts[side], 1)
+        if isinstance(total, np.ndarray):
+            return total / count
+        return {col: value / count for col, value in total.items()}
+
+    def _empty_sum(self):
+        if self._vs.n_components is not None:
+            return np.zeros(self._vs.n_components)
+        return {}
+
+    def _add(self, profile, side, row, sign):
+        vector = self._vs.get_search_vectors([row])
+        total = profile.sums[side]
+        if isinstance(total, np.ndarray):
+            profile.sums[side] = total + sign * np.asarray(vector[0], dtype=np.float64)
+        else:
+            if self._saving:
+                total = profile.sums[side] = dict(total)
+            for col, value in zip(vector.indices.tolist(), vector.data.tolist()):
+                total[col] = total.get(col, 0.0) + sign * value
+        profile.counts[side] += sign
+        if profile.counts[side] == 0:
+            # Drops the rounding residue of adding and subtracting.
+            profile.sums[side] = self._empty_sum()
+
+    def _touch(self, profile):
+        self._revision += 1
+        profile.revision = self._revision
+
+    def _seed(self, user_id, liked, disliked, seeded_at):
+        profile = UserProfile()
+        profile.seeded_at = seeded_at
+        for side, org_ids in enumerate([liked, disliked]):
+            rows = [self._row(org_id) for org_id in org_ids]
+            profile.orgs[side] = dict(zip(org_ids, rows))
+            known = np.array([row for row in rows if row >= 0], dtype=np.intp)
+            profile.counts[side] = len(known)
+            profile.sums[side] = self._empty_sum()
+            if len(known) == 0:
+                continue
+            total = self._vs.get_search_vectors(known).sum(axis=0)
+            if isinstance(profile.sums[side], np.ndarray):
+                profile.sums[side] = np.asarray(total, dtype=np.float64).ravel()
+            else:
+                total = sp.csr_matrix(total)
+                profile.sums[side] = dict(zip(total.indices.tolist(), total.data.tolist()))
+        self._touch(profile)
+        self._profiles[user_id] = profile
+
+    def _apply(self, user_id, org_id, action):
+        profile = self._profiles[user_id]
+        target = _SIDES.get(action)
+        if target is not None and org_id in profile.orgs[target]:
+            return
+        if self._saving:
+            profile.orgs = [dict(orgs) for orgs in profile.orgs]
+        for side in (0, 1):
+            row = profile.orgs[side].pop(org_id, None)
+            if row is not None and row >= 0:
+                self._add(profile, side, row, -1)
+        if target is not None:
+            row = self._row(org_id)
+            profile.orgs[target][org_id] = row
+            if row >= 0:
+                self._add(profile, target, row, 1)
+        self._touch(profile)
+
+    def _row(self, org_id):
+        row = self._dataset.get_row(org_id)
+        return -1 if row is None else int(row)
+
+    def _log(self, entry):
+        if self._pending is not None:
+            self._pending.append(entry)
+        if self._journal is not None:
+            self._journal.write(json.dumps(entry) + '\n')
+            self._journal.flush()
+
+    def _replay(self, journal):
+        """Applies the events of the journal. A partially written
+        last line is truncated from the file.
+        """
+        valid_bytes = 0
+        with open(journal, 'rb') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+                self._replay_entry(entry)
+                valid_bytes += len(line)
+        with open(journal, 'r+b') as f:
+            f.truncate(valid_bytes)
+
+    def _replay_entry(self, entry):
+        if 'action' in entry:
+            if entry['userId'] in self._profiles:
+                self._apply(entry['userId'], entry['orgId'], entry['action'])
+        else:
+            self._seed(entry['userId'], entry['liked'], entry['disliked'],
+                entry.get('seededAt', 0.0))
+
+    def _collect(self):
+        """Takes references to the org ids and sums of every
+        profile, see _flatten. Must be called with the lock held.
+        """
+        user_ids = list(self._profiles)
+        profiles = [self._profiles[user_id] for user_id in user_ids]
+        return {
+            'model_version': self.model_version,
+            'dense': self._vs.n_components is not None,
+            'n_components': self._vs.n_components,
+            'users': user_ids,
+            'seeded_at': np.array([profile.seeded_at for profile in profiles],
+                dtype=np.float64),
+            'orgs': [[profile.orgs[side] for profile in profiles] for side in (0, 1)],
+            'sums': [[profile.sums[side] for profile in profiles] for side in (0, 1)],
+        }
+
+    def _flatten(self, state):
+        """Turns what _collect took into the arrays _write_snapshot
+        writes. The org ids and sums it references must not be
+        updated in place meanwhile, see _saving.
+        """
+        flat = {name: state[name] for name in ['model_version', 'dense', 'users', 'seeded_at']}
+        for side, name in enumerate(['liked', 'disliked']):
+            org_ids = [list(orgs) for orgs in state['orgs'][side]]
+            offsets = np.zeros(len(org_ids) + 1, dtype=np.int64)
+            np.cumsum([len(ids) for ids in org_ids], out=offsets[1:])
+            flat[name] = [o for ids in org_ids for o in ids]
+            flat[name + '_offsets'] = offsets
+            sums = state['sums'][side]
+            if state['dense']:
+                flat[name + '_sums'] = np.array(sums, dtype=np.float64).reshape(
+                    len(sums), state['n_components'])
+            else:
+                indptr = np.zeros(len(sums) + 1, dtype=np.int64)
+                np.cumsum([len(total) for total in sums], out=indptr[1:])
+                flat[name + '_sums_indices'] = np.array(
+                    [col for total in sums for col in total], dtype=np.int64)
+                flat[name + '_sums_data'] = np.array(
+                    [value for total in sums for value in total.values()], dtype=np.float64)
+                flat[name + '_sums_indptr'] = indptr
+        return flat
+
+    def _rotate_journal(self):
+        """Moves the journal aside for the snapshot being written
+        and starts a new one. The journal of a save that did not
+        finish is kept, with this one appended to it. Must be called
+        with the lock held.
+        """
+        journal = os.path.join(self.directory, JOURNAL_NAME)
+        saving = os.path.join(self.directory, SAVING_JOURNAL_NAME)
+        if self._journal is not None:
+            self._journal.close()
+        if not os.path.exists(journal):
+            open(saving, 'a').close()
+        elif os.path.exists(saving):
+            with open(saving, 'ab') as dst, open(journal, 'rb') as src:
+                shutil.copyfileobj(src, dst)
+            os.remove(journal)
+        else:
+            os.rename(journal, saving)
+        self._journal = open(journal, 'a')
+
+    def _write_snapshot(self, state):
+        """Writes the profiles flattened by _flatten next to the
+        current snapshot and swaps it in.
+        """
+        path = os.path.join(self.directory, SNAPSHOT_NAME)
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        artifact_utils.update_manifest(tmp_path, 'profiles', {
+            'model_version': state['model_version'],
+            'user_count': len(state['users']),
+            'dense': state['dense'],
+        })
+        for name in ['users', 'liked', 'disliked']:
+            artifact_utils.save_strings(tmp_path, name, state[name])
+        for name, value in state.items():
+            if isinstance(value, np.ndarray):
+                artifact_utils.save_array(tmp_path, name, value)
+        old_path = path + '.old'
+        if os.path.exists(path):
+            if os.path.exists(old_path):
+                shutil.rmtree(old_path)
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+
+    def _read_snapshot(self, path):
+        """Loads the profiles written by _write_snapshot. Sums saved for
+        another model version are not read, and the store is left
+        without a model_version, see load.
+        """
+        params = artifact_utils.read_manifest(path)['profiles']
+        user_ids = artifact_utils.load_strings(path, 'users', mmap=False)
+        seeded_at = artifact_utils.load_array(path, 'seeded_at', mmap=False).tolist()
+        sides = []
+        for name in ['liked', 'disliked']:
+            org_ids = artifact_utils.load_strings(path, name, mmap=False)
+            offsets = artifact_utils.load_array(path, name + '_offsets', mmap=False)
+            sides.append([list(org_ids[offsets[i]:offsets[i + 1]])
+                for i in range(len(user_ids))])
+        if params['model_version'] != self.model_version:
+            self.model_version = None
+            for user_id, liked, disliked, seeded in zip(user_ids, *sides, seeded_at):
+                profile = UserProfile()
+                profile.orgs = [dict.fromkeys(liked, -1), dict.fromkeys(disliked, -1)]
+                profile.sums = [self._empty_sum(), self._empty_sum()]
+                profile.seeded_at = seeded
+                self._touch(profile)
+                self._profiles[user_id] = profile
+            return
+        sums = []
+        for name in ['liked', 'disliked']:
+            if params['dense']:
+                matrix = artifact_utils.load_array(path, name + '_sums', mmap=False)
+                sums.append([np.array(row) for row in matrix])
+                continue
+            indices = artifact_utils.load_array(path, name + '_sums_indices', mmap=False)
+            data = artifact_utils.load_array(path, name + '_sums_data', mmap=False)
+            indptr = artifact_utils.load_array(path, name + '_sums_indptr', mmap=False)
+            sums.append([dict(zip(indices[start:end].tolist(), data[start:end].tolist()))
+                for start, end in zip(indptr[:-1], indptr[1:])])
+        for i, user_id in enumerate(user_ids):
+            profile = UserProfile()
+            for side in (0, 1):
+                rows = [self._row(org_id) for org_id in sides[side][i]]
+                profile.orgs[side] = dict(zip(sides[side][i], rows))
+                profile.counts[side] = sum(row >= 0 for row in rows)
+                profile.sums[side] = sums[side][i]
+            profile.seeded_at = seeded_at[i]
+            self._touch(profile)
+            self._profiles[user_id] = profile
@@ -9,22 +9,62 @@ Purpose: Define a class that contains vector space
     the functionality in this class will generalize to tasks
     outside of this domain.
 """
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from org_dataset import OrgDataset
+from fast_tfidf import FastTfidfTransformer, DEFAULT_TOKEN_PATTERN
+import artifact_utils
+import metrics
+import scipy.sparse as sp
 import numpy as np
 import pickle
+import sys
 
 class VectorSpace:
 
     """
     Attributes:
-        data_centroid (array): Centroid of all the vectorized
-            data. This can be used for default recommendations
-            if no data is provided.
+        data_centroid (array): 1d float64 centroid of all the
+            vectorized data. This can be used for default
+            recommendations if no data is provided.
+        _normalized_data (scipy csr matrix): L2 normalized copy
+            of the vectorized data. This is computed once, when
+            the instance is fit or loaded, so similarity searches
+            only need a single sparse dot product.
+        drift (dict): statistics about the orgs added, removed and
+            updated since the vectorizer was fit. See needs_refit.
+        n_components (int or None): the number of dimensions of the
+            reduced (LSA) search space, or None if orgs are searched
+            in the tfidf space. See project.
+        vectorizer (TfidfVectorizer): the fitted vectorizer. Instances
+            loaded with load_artifact rebuild it on first use, since
+            serving only needs _fast and should not import sklearn.
+        compacted (bool): whether compact was called, i.e. whether
+            the matrix is stored as float32 and the stop word list
+            was dropped.
+        _fast (FastTfidfTransformer or None): a faster equivalent of
+            the vectorizer's transform, or None if the vectorizer's
+            options are not supported by it.
+        _components (numpy array or None): the float32 TruncatedSVD
+            components, one row per dimension of the reduced space.
+        _dense_data (numpy array or None): the L2 normalized float32
+            projections of the org embeddings onto _components,
+            searched instead of _normalized_data when n_components
+            is set.
+        _embedding_norms (numpy array or None): the norms of the
+            projections, which _dense_data rows are scaled by to get
+            them back, see get_search_vectors. Being linear, means of
+            the projections equal projections of tfidf means.
     """
 
+    REFIT_CHANGE_RATIO = 0.2
+    REFIT_UNKNOWN_TOKEN_RATIO = 0.25
+    REFIT_MIN_TOKENS = 500
+    # The number of dense query entries a sparse similarity search
+    # materializes at once.
+    QUERY_BLOCK_ELEMENTS = 1 << 22
+
     def __init__(self, data, analyzer='word', stop_words='english',
-            ngram_range=(1,1), max_df=1.0, min_df=1, max_features=None):
+            ngram_range=(1,1), max_df=1.0, min_df=1, max_features=None,
+            n_components=None):
         """Initializes a VectorSpace instance. The vector space is fit on
         the data provided by 'data' argument.
 
@@ -58,6 +98,12 @@ class VectorSpace:
             max_features (int or None): If not None, build a vocabulary that only
                 considers the top max_features ordered by term frequency across
                 the corpus.
+            n_components (int or None): If not None, orgs are searched
+                in an LSA space of n_components dimensions, fit with
+                TruncatedSVD on the tfidf embeddings. Scoring then is a
+                small dense float32 matrix product instead of a sparse
+                product over the whole vocabulary. Must be smaller than
+                the vocabulary size.
 
             Returns:
                 A VectorSpace instance fitted on the data provided
@@ -70,20 +116,103 @@ class VectorSpace:
         self.max_df = max_df
         self.min_df = min_df
         self.max_features = max_features
-        self.vectorizer = TfidfVectorizer(analyzer=analyzer, stop_words=stop_words,
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        self._vectorizer = TfidfVectorizer(analyzer=analyzer, stop_words=stop_words,
             ngram_range=ngram_range, max_df=max_df, min_df=min_df, max_features=max_features)\
             .fit(self.data.get_org_descriptions())
-        self._transformed_data = self.vectorizer.transform(self.data.get_org_descriptions())
-        self.data_centroid = np.mean(self._transformed_data, axis=0)
+        self._fast = FastTfidfTransformer.from_vectorizer(self.vectorizer)
+        self._transformed_data = self._transform(self.data.get_org_descriptions())
+        self.data_centroid = _column_mean(self._transformed_data)
+        self.n_components = n_components
+        self._components = None
+        if n_components is not None:
+            from sklearn.decomposition import TruncatedSVD
+            svd = TruncatedSVD(n_components=n_components, random_state=0)
+            self._components = svd.fit(self._transformed_data).components_.astype(np.float32)
+        self._prepare_search()
+        self._reset_drift()
+        self._searcher = None
+        self.compacted = False
+
+    def __setstate__(self, state):
+        """Restores a pickled instance. Instances pickled before
+        the vectorizer was built lazily store it as 'vectorizer'.
+        """
+        if 'vectorizer' in state:
+            state['_vectorizer'] = state.pop('vectorizer')
+        self.__dict__.update(state)
+        if '_fast' not in state:
+            self._fast = FastTfidfTransformer.from_vectorizer(self._vectorizer)
+        if 'compacted' not in state:
+            self.compacted = False
+            self.data_centroid = np.asarray(self.data_centroid, dtype=np.float64).ravel()
+        if '_embedding' in state:
+            embedding = self.__dict__.pop('_embedding')
+            self._embedding_norms = None if embedding is None else _row_norms(embedding)
+
+    @property
+    def vectorizer(self):
+        if self._vectorizer is None:
+            self._vectorizer = self._build_vectorizer()
+        return self._vectorizer
+
+    def _build_vectorizer(self):
+        """Rebuilds the fitted vectorizer of an instance loaded
+        with load_artifact from its vocabulary and idf weights.
+        """
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        vocabulary, idf, stop_words = self._vectorizer_state
+        vectorizer = TfidfVectorizer(analyzer=self.analyzer, stop_words=self.stop_words,
+            ngram_range=self.ngram_range, max_df=self.max_df, min_df=self.min_df,
+            max_features=self.max_features, vocabulary=vocabulary)
+        vectorizer.idf_ = np.array(idf)
+        vectorizer.vocabulary_ = vocabulary
+        vectorizer.stop_words_ = None if self.compacted else set(stop_words)
+        return vectorizer
+
+    def _norm(self):
+        """Returns the row normalization of the tfidf vectors."""
+        if self._fast is not None:
+            return self._fast.norm
+        return self.vectorizer.norm
+
+    def _reset_drift(self):
+        self.drift = {
+            'fit_orgs': self.data.active_count(),
+            'added': 0,
+            'removed': 0,
+            'updated': 0,
+            'tokens': 0,
+            'unknown_tokens': 0,
+        }
+
+    def _prepare_search(self):
+        """Precomputes the L2 normalized org matrix used by
+        the similarity search functions. The tfidf vectorizer
+        already l2 normalizes its output, in which case the
+        transformed data is reused rather than copied. In the reduced
+        space, the projected and normalized dense org matrix is
+        computed as well, along with the norms of the projections.
+        """
+        if self._norm() == 'l2':
+            self._normalized_data = self._transformed_data.tocsr()
+        else:
+            self._normalized_data = normalize_rows(self._transformed_data)
+        self._dense_data = None
+        self._embedding_norms = None
+        if self._components is not None:
+            embedding = self.project(self._transformed_data)
+            self._embedding_norms = _row_norms(embedding)
+            self._dense_data = normalize_rows(embedding)
 
     def info(self):
         """Returns a string containing the information of
         of the VectorSpace instance.
         """
         s = 'analyzer: {}, stop_words: {}, ngram_range: {},'\
-            ' max_df: {}, min_df: {}, max_features: {}'\
+            ' max_df: {}, min_df: {}, max_features: {}, n_components: {}'\
             .format(self.analyzer, self.stop_words, self.ngram_range,
-                self.max_df, self.min_df, self.max_features)
+                self.max_df, self.min_df, self.max_features, self.n_components)
         return s
 
     def get_stop_words(self):
@@ -93,9 +222,11 @@ class VectorSpace:
         method, but rather the effective stopwords obtained
         based off of min and max df.
 
-        stop words are returned as a set.
+        stop words are returned as a set, or None once the
+        instance was compacted or if the vectorizer does not
+        record them.
         """
-        return self.vectorizer.stop_words_
+        return getattr(self.vectorizer, 'stop_words_', None)
 
     def get_vocabulary(self):
         """Returns a dictionary of mapping of terms
@@ -103,6 +234,7 @@ class VectorSpace:
         """
         return self.vectorizer.vocabulary_
 
+    @metrics.timed('tokenize')
     def transform(self, input, to_numpy=False):
         """Transforms input into tfidf embedded vectors.
         Vector embeddings of input are returned as a matrix.
@@ -120,12 +252,489 @@ class VectorSpace:
                 If to_numpy is True, document embeddings are returned
                 as a numpy matrix.
         """
-        embeddings = self.vectorizer.transform(input)
+        embeddings = self._transform(input)
         if to_numpy:
             return embeddings.todense()
         else:
             return embeddings
 
+    def _transform(self, documents):
+        if self._fast is not None:
+            return self._fast.transform(documents)
+        return self.vectorizer.transform(documents)
+
+    def get_org_vectors(self, indices=None):
+        """Returns the stored tfidf embeddings of the orgs at
+        the supplied row indices. The embeddings are read from
+        the precomputed matrix, no text is re-tokenized.
+
+        Args:
+            indices (list): an optional list of integers
+                representing rows of the org dataset. If no value
+                is provided, the whole matrix is returned without
+                being copied.
+
+        Returns:
+            a scipy csr matrix with one row per index.
+        """
+        if indices is None:
+            return self._transformed_data
+        return self._transformed_data[np.asarray(indices, dtype=np.intp)]
+
+    def get_search_vectors(self, indices=None):
+        """Returns the stored embeddings of the orgs at the
+        supplied row indices in the space the similarity searches
+        use: the reduced space if n_components is set, otherwise
+        the tfidf space (see get_org_vectors). Means of these rows
+        are valid queries and, in the reduced space, much cheaper
+        to compute than tfidf means.
+
+        Args:
+            indices (list): see get_org_vectors.
+
+        Returns:
+            a float32 numpy array in the reduced space, otherwise a
+            scipy csr matrix.
+        """
+        if self._dense_data is None:
+            return self.get_org_vectors(indices)
+        if indices is None:
+            return self._dense_data * self._embedding_norms[:, np.newaxis]
+        rows = np.asarray(indices, dtype=np.intp)
+        return self._dense_data[rows] * self._embedding_norms[rows, np.newaxis]
+
+    def weighted_search_vectors(self, weights):
+        """Returns weights @ get_search_vectors(), without
+        materializing the search vectors of every org in the reduced
+        space.
+
+        Args:
+            weights (scipy sparse matrix): one row of org weights
+                per result, with one column per org.
+
+        Returns:
+            a float32 numpy array in the reduced space, otherwise a
+            scipy csr matrix.
+        """
+        if self._dense_data is None:
+            return weights @ self.get_org_vectors()
+        weights = sp.csr_matrix(weights) @ sp.diags(self._embedding_norms)
+        return np.asarray(weights @ self._dense_data, dtype=np.float32)
+
+    def project(self, vectors):
+        """Projects tfidf vectors onto the reduced (LSA) space.
+        Only available when n_components is set.
+
+        Args:
+            vectors (scipy sparse matrix or array): one or more
+                vectors from the tfidf space.
+
+        Returns:
+            a 2d float32 numpy array with n_components columns.
+        """
+        if self._components is None:
+            raise ValueError('This VectorSpace has no reduced space.')
+        if not sp.issparse(vectors):
+            vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        return np.asarray(vectors @ self._components.T, dtype=np.float32)
+
+    def get_org_vectors_by_id(self, ids):
+        """Returns the stored tfidf embeddings of the orgs
+        with the supplied ids. Ids that are not in the dataset
+        are ignored.
+
+        Args:
+            ids (list): a list (or np array) of strings
+                where each entry is an organization id.
+
+        Returns:
+            a scipy csr matrix with one row per known id.
+        """
+        return self.get_org_vectors(self.data.get_indices_by_id(ids))
+
+    def add_orgs(self, orgs):
+        """Adds orgs to the vector space without refitting. The
+        new orgs are embedded with the current vocabulary and idf
+        weights and appended as new rows, so the cost depends only
+        on the number of new orgs. The orgs are also added to the
+        data attribute.
+
+        Args:
+            orgs (list): a list of Org objects.
+        """
+        self._add_rows([org.org_id for org in orgs], [org.org_name for org in orgs],
+            [org.org_purpose for org in orgs])
+        self.drift['added'] += len(orgs)
+
+    def remove_orgs(self, ids):
+        """Removes orgs from the vector space without refitting.
+        Their rows are retired in the data attribute, see
+        OrgDataset.remove_orgs, and are never returned by the
+        similarity searches.
+
+        Args:
+            ids (list): a list (or np array) of strings
+                where each entry is an organization id.
+
+        Returns:
+            the number of orgs removed.
+        """
+        rows = self.data.remove_orgs(ids)
+        if len(rows) > 0:
+            self._shift_centroid(self._transformed_data[rows], -len(rows))
+            self.drift['removed'] += len(rows)
+        return len(rows)
+
+    def update_org(self, org):
+        """Replaces the stored org that has the same id as org.
+        The old row is retired and the updated org is appended.
+        If no org has the id, org is simply added.
+
+        Args:
+            org (Org): the updated org.
+        """
+        if self.remove_orgs([org.org_id]) == 0:
+            self.add_orgs([org])
+            return
+        self.drift['removed'] -= 1
+        self._add_rows([org.org_id], [org.org_name], [org.org_purpose])
+        self.drift['updated'] += 1
+
+    def sync_orgs(self, dataset):
+        """Brings the vector space in line with a fresh copy of
+        all orgs, e.g. from gcd_utils.get_org_dataset. New orgs are
+        added, missing orgs removed and orgs whose description
+        changed are updated. Unchanged orgs cost only a dictionary
+        lookup.
+
+        Args:
+            dataset (OrgDataset): the current orgs.
+
+        Returns:
+            a tuple (added, removed, updated) of org counts.
+        """
+        new_rows = []
+        changed_rows = []
+        for row in np.flatnonzero(dataset.active):
+            current_row = self.data.get_row(dataset.ids[row])
+            if current_row is None:
+                new_rows.append(row)
+            elif self.data.purposes[current_row] != dataset.purposes[row]:
+                changed_rows.append(row)
+        removed = [org_id for org_id in self.data.ids[self.data.active]
+            if dataset.get_row(org_id) is None]
+        self.remove_orgs(removed)
+        self.remove_orgs(dataset.ids[changed_rows])
+        self.drift['removed'] -= len(changed_rows)
+        rows = np.array(changed_rows + new_rows, dtype=np.intp)
+        self._add_rows(dataset.ids[rows], dataset.names[rows], dataset.purposes[rows])
+        self.drift['updated'] += len(changed_rows)
+        self.drift['added'] += len(new_rows)
+        return len(new_rows), len(removed), len(changed_rows)
+
+    def _add_rows(self, ids, names, purposes):
+        if len(ids) == 0:
+            return
+        self._record_tokens(purposes)
+        new_vecs = self._transform(purposes).astype(self._transformed_data.dtype)
+        self.data.add_columns(ids, names, purposes)
+        self._shift_centroid(new_vecs, len(ids))
+        self._transformed_data = sp.vstack([self._transformed_data, new_vecs], format='csr')
+        if self._norm() == 'l2':
+            self._normalized_data = self._transformed_data
+        else:
+            self._normalized_data = sp.vstack([self._normalized_data,
+                normalize_rows(new_vecs)], format='csr')
+        if self._components is not None:
+            new_embedding = self.project(new_vecs)
+            self._embedding_norms = np.concatenate([self._embedding_norms,
+                _row_norms(new_embedding)])
+            self._dense_data = np.vstack([self._dense_data,
+                normalize_rows(new_embedding)])
+
+    def needs_refit(self, max_change_ratio=None, max_unknown_token_ratio=None):
+        """Checks whether the orgs changed enough since the
+        vectorizer was fit that a full refit is worthwhile, i.e.
+        whether too many orgs changed or too many tokens of the new
+        orgs are missing from the vocabulary.
+
+        Args:
+            max_change_ratio (float, optional): the largest allowed
+                ratio of added, removed and updated orgs to the orgs
+                the vectorizer was fit on. Defaults to
+                REFIT_CHANGE_RATIO.
+            max_unknown_token_ratio (float, optional): the largest
+                allowed ratio of out of vocabulary tokens in the
+                added and updated orgs. Defaults to
+                REFIT_UNKNOWN_TOKEN_RATIO. This check only applies
+                once REFIT_MIN_TOKENS tokens have been seen, so a
+                handful of new orgs can not trigger a refit.
+
+        Returns:
+            True if either threshold is crossed.
+        """
+        if max_change_ratio is None:
+            max_change_ratio = self.REFIT_CHANGE_RATIO
+        if max_unknown_token_ratio is None:
+            max_unknown_token_ratio = self.REFIT_UNKNOWN_TOKEN_RATIO
+        drift = self.drift
+        changed = drift['added'] + drift['removed'] + drift['updated']
+        if changed > max_change_ratio * max(drift['fit_orgs'], 1):
+            return True
+        if drift['tokens'] < self.REFIT_MIN_TOKENS:
+            return False
+        return drift['unknown_tokens'] > max_unknown_token_ratio * drift['tokens']
+
+    def _record_tokens(self, descs):
+        analyzer = self.vectorizer.build_analyzer()
+        vocabulary = self.get_vocabulary()
+        for desc in descs:
+            tokens = analyzer(desc)
+            self.drift['tokens'] += len(tokens)
+            self.drift['unknown_tokens'] += sum(1 for t in tokens if t not in vocabulary)
+
+    def _shift_centroid(self, vecs, count_change):
+        """Updates data_centroid, the mean of the active rows,
+        after count_change rows with embeddings vecs were added
+        (positive) or retired (negative).
+        """
+        new_count = self.data.active_count()
+        old_count = new_count - count_change
+        total = self.data_centroid * old_count \
+            + np.sign(count_change) * np.asarray(vecs.sum(axis=0), dtype=np.float64).ravel()
+        self.data_centroid = total / max(new_count, 1)
+
+    def compact(self):
+        """Shrinks the instance for serving. The tfidf matrix is
+        stored as float32 with int32 indices, which halves its size,
+        and the fitted vectorizer's stop word list, which is only
+        needed for training and can be large, is dropped.
+        Similarities are then computed in float32 precision, so
+        near ties may rank differently than before. Compacted
+        instances are saved and loaded as they are, and rows added
+        later are stored as float32 too.
+        """
+        matrix = self._transformed_data.tocsr()
+        index_dtype = np.int32 if matrix.nnz < np.iinfo(np.int32).max else np.int64
+        self._transformed_data = sp.csr_matrix((matrix.data.astype(np.float32),
+            matrix.indices.astype(index_dtype), matrix.indptr.astype(index_dtype)),
+            shape=matrix.shape)
+        if getattr(self._vectorizer, 'stop_words_', None) is not None:
+            self._vectorizer.stop_words_ = None
+        elif hasattr(self, '_vectorizer_state'):
+            vocabulary, idf, _ = self._vectorizer_state
+            self._vectorizer_state = (vocabulary, idf, [])
+        self.compacted = True
+        self._prepare_search()
+
+    def memory_report(self):
+        """Estimates the memory held by each component of the
+        instance. Objects shared between components, e.g. the
+        vocabulary of the vectorizer and of _fast, are counted once.
+
+        Returns:
+            a dictionary with the keys 'components', mapping each
+            component to its size in bytes, 'total', the sum of the
+            components, and 'mapped', the part of total held in
+            memory-mapped artifact arrays. Mapped pages are shared
+            between the worker processes and read from disk on
+            demand.
+        """
+        seen = set()
+        parts = [
+            ('matrix', self._transformed_data),
+            ('normalized_matrix', self._normalized_data),
+            ('svd_components', self._components),
+            ('dense_data', self._dense_data),
+            ('embedding_norms', self._embedding_norms),
+            ('data_centroid', self.data_centroid),
+            ('fast_transformer', vars(self._fast) if self._fast is not None else None),
+            ('vectorizer', vars(self._vectorizer) if self._vectorizer is not None
+                else getattr(self, '_vectorizer_state', None)),
+            ('dataset', vars(self.data)),
+            ('search_backend', vars(self._searcher) if self._searcher is not None else None),
+        ]
+        components = {}
+        total = mapped = 0
+        for name, obj in parts:
+            size, mapped_size = _sizeof(obj, seen)
+            components[name] = size
+            total += size
+            mapped += mapped_size
+        return {'components': components, 'total': total, 'mapped': mapped}
+
+    def _normalize_queries(self, input_vectors):
+        """L2 normalizes query vectors so that their dot product
+        with the normalized org matrix is the cosine similarity.
+
+        Args:
+            input_vectors (scipy sparse matrix or array): one or
+                more vectors from this vector space. A 1d array is
+                treated as a single query. In the reduced space,
+                vectors may come from either the tfidf space or the
+                reduced space.
+
+        Returns:
+            a normalized scipy csr matrix or a 2d numpy array,
+            depending on the type of input_vectors, with the dtype of
+            the searched matrix, so that the product does not upcast
+            the matrix. In the reduced space, always a 2d float32
+            numpy array.
+        """
+        if self._components is not None:
+            if sp.issparse(input_vectors) or np.shape(input_vectors)[-1] != self.n_components:
+                input_vectors = self.project(input_vectors)
+            vectors = np.atleast_2d(np.asarray(input_vectors, dtype=np.float32))
+            return normalize_rows(vectors)
+        dtype = self._normalized_data.dtype
+        if sp.issparse(input_vectors):
+            return normalize_rows(input_vectors).astype(dtype, copy=False)
+        vectors = np.atleast_2d(np.asarray(input_vectors, dtype=np.float64))
+        return normalize_rows(vectors).astype(dtype, copy=False)
+
+    @metrics.timed('similarity')
+    def get_similarities(self, input_vectors):
+        """Computes the cosine similarity between each of the
+        supplied vectors and every organization in the vector
+        space.
+
+        Args:
+            input_vectors (scipy sparse matrix or array): one or
+                more vectors from this vector space.
+
+        Returns:
+            a 2d numpy array of shape (number of queries, number
+            of orgs) containing cosine similarities.
+        """
+        queries = self._normalize_queries(input_vectors)
+        if self._dense_data is not None:
+            return queries @ self._dense_data.T
+        if sp.issparse(queries):
+            # Multiplying the corpus by dense query columns avoids
+            # converting the transposed corpus on every call. Queries
+            # are densified in blocks to bound the memory this takes.
+            step = max(1, self.QUERY_BLOCK_ELEMENTS // queries.shape[1])
+            return np.vstack([np.asarray(self._normalized_data
+                @ queries[start:start + step].T.toarray()).T
+                for start in range(0, max(queries.shape[0], 1), step)])
+        return np.asarray(self._normalized_data @ queries.T).T
+
+    def get_nearest_indices(self, input_vectors, k=1, exclude=None):
+        """Gets the row indices of the organizations closest
+        to each of the supplied vectors, ranked by cosine
+        similarity.
+
+        Args:
+            input_vectors (scipy sparse matrix or array): one or
+                more vectors from this vector space. Each row is
+                treated as a separate query.
+            k (int): The number of closest orgs to fetch for each
+                query. If k is larger than the number of orgs that
+                are not excluded, every remaining org is returned.
+            exclude (iterable or scipy sparse matrix, optional): orgs
+                that must not be returned. Either row indices of orgs
+                excluded from every query, or a sparse matrix of shape
+                (number of queries, number of orgs) whose non-zero
+                entries mark the orgs excluded from each query.
+                Excluded orgs are masked out before selection, so
+                exactly k orgs are returned whenever enough orgs
+                remain.
+
+        Returns:
+            A tuple (indices, scores) of 2d numpy arrays with one
+            row per query. Row i of indices holds the org row indices
+            for query i ordered from most to least similar, and row i
+            of scores holds the matching cosine similarities. When a
+            sparse exclude leaves some queries with fewer than k orgs,
+            their rows are padded with index -1 and score -inf.
+        """
+        if getattr(self, '_searcher', None) is not None:
+            return self._approximate_nearest(input_vectors, k, exclude)
+        return self._exact_nearest(input_vectors, k, exclude)
+
+    def _exact_nearest(self, input_vectors, k, exclude):
+        """get_nearest_indices scoring every org."""
+        sims = self.get_similarities(input_vectors)
+        available = sims.shape[1]
+        retired = self.data.retired_indices
+        if len(retired) > 0:
+            sims[:, retired] = -np.inf
+            available -= len(retired)
+        if sp.issparse(exclude):
+            mask = sp.csr_matrix(exclude, dtype=bool)
+            mask.eliminate_zeros()
+            rows, cols = mask.nonzero()
+            sims[rows, cols] = -np.inf
+            available -= mask.getnnz(axis=1).min(initial=0)
+        elif exclude is not None:
+            excluded = np.setdiff1d(np.asarray(list(exclude), dtype=np.intp), retired)
+            sims[:, excluded] = -np.inf
+            available -= len(excluded)
+        with metrics.stage('top_k'):
+            return _top_k(sims, min(k, available))
+
+    @metrics.timed('ann_search')
+    def _approximate_nearest(self, input_vectors, k, exclude):
+        """get_nearest_indices using the search backend. Only the
+        candidates chosen by the backend are scored. A query with
+        fewer than k candidates left after exclusions falls back to
+        exact search.
+        """
+        queries = self._normalize_queries(input_vectors)
+        n_rows = self._search_matrix().shape[0]
+        dropped = self.data.retired_indices
+        mask = None
+        if sp.issparse(exclude):
+            mask = sp.csr_matrix(exclude, dtype=bool)
+            mask.eliminate_zeros()
+        elif exclude is not None:
+            dropped = np.union1d(dropped, np.asarray(list(exclude), dtype=np.intp))
+        # Orgs added after the backend was built are always candidates.
+        unindexed = np.arange(self._searcher.size, n_rows)
+        indices = np.full((queries.shape[0], k), -1, dtype=np.intp)
+        scores = np.full((queries.shape[0], k), -np.inf)
+        for i in range(queries.shape[0]):
+            query = queries[i]
+            excluded = dropped
+            if mask is not None:
+                excluded = np.union1d(dropped, mask[i].indices)
+            candidates = np.concatenate([self._searcher.candidates(query), unindexed])
+            candidates = np.setdiff1d(candidates, excluded)
+            if len(candidates) < k:
+                row_exclude = mask[i] if mask is not None else exclude
+                row_indices, row_scores = self._exact_nearest(query, k, row_exclude)
+                indices[i, :row_indices.shape[1]] = row_indices[0]
+                scores[i, :row_scores.shape[1]] = row_scores[0]
+                continue
+            candidate_vecs = self._search_matrix()[candidates]
+            if sp.issparse(query):
+                sims = (candidate_vecs @ query.T).toarray().ravel()
+            else:
+                sims = candidate_vecs @ query
+            top, top_scores = _top_k(sims[np.newaxis, :], k)
+            indices[i] = candidates[top[0]]
+            scores[i] = top_scores[0]
+        filled = ~np.all(indices == -1, axis=0)
+        return indices[:, filled], scores[:, filled]
+
+    def _search_matrix(self):
+        """Returns the normalized org matrix searched by
+        get_nearest_indices.
+        """
+        if self._dense_data is not None:
+            return self._dense_data
+        return self._normalized_data
+
+    def set_search_backend(self, searcher):
+        """Selects how get_nearest_indices searches the orgs.
+
+        Args:
+            searcher: an approximate search backend from ann_index,
+                e.g. built with ann_index.make_searcher, or None for
+                exact search over every org.
+        """
+        self._searcher = searcher
+
     def get_nearest_orgs(self, input_vector, k=1):
         """Gets the nearest organizations stored in
         instance's data attribute. The keys containing
@@ -138,16 +747,17 @@ class VectorSpace:
             k (int): The number of closest orgs to fetch.
 
         Returns:
-            A pandas dataframe with three columns:
+            A pandas dataframe with four columns, ordered from
+            most to least similar:
                 'orgId'
                 'orgName'
                 'orgPurpose'
+                'score'
         """
-        sims = cosine_similarity(input_vector, self._transformed_data)[0]
-        indices = np.argpartition(sims, -(k))[-(k):]
-        input_index = np.argpartition(sims, -1)[-1:]
-        indices = list(indices)
-        return self.data.get_orgs_by_indices(indices)
+        indices, scores = self.get_nearest_indices(input_vector, k)
+        df = self.data.to_dataframe(indices[0])
+        df['score'] = scores[0]
+        return df
 
     def save_instance(self, destination):
         """Saves instance of VectorSpace to the specified
@@ -172,4 +782,209 @@ class VectorSpace:
             The VectorSpace instance located in location.
         """
         with open(location, 'rb') as f:
-            return pickle.load(f)
+            vs = pickle.load(f)
+        if not hasattr(vs, '_components'):
+            vs.n_components = None
+            vs._components = None
+            vs._prepare_search()
+        elif not hasattr(vs, '_normalized_data'):
+            vs._prepare_search()
+        if not hasattr(vs, 'drift'):
+            vs._reset_drift()
+        return vs
+
+    def save_artifact(self, directory):
+        """Saves the instance to the model artifact in directory.
+        The transformed data is stored as its raw csr components,
+        the fitted vectorizer as its vocabulary and idf weights, and
+        the org data through OrgDataset.save_artifact.
+
+        Args:
+            directory (str): the artifact directory. It is
+                created if it does not exist.
+        """
+        self.data.save_artifact(directory)
+        matrix = self._transformed_data.tocsr()
+        artifact_utils.update_manifest(directory, 'vector_space', {
+            'compacted': self.compacted,
+            'analyzer': self.analyzer,
+            'stop_words': self.stop_words,
+            'ngram_range': list(self.ngram_range),
+            'max_df': self.max_df,
+            'min_df': self.min_df,
+            'max_features': self.max_features,
+            'shape': list(matrix.shape),
+            'n_components': self.n_components,
+            'drift': self.drift,
+        })
+        vocabulary = self.get_vocabulary()
+        terms = sorted(vocabulary, key=vocabulary.get)
+        artifact_utils.save_strings(directory, 'vocabulary', terms)
+        artifact_utils.save_strings(directory, 'stop_words',
+            sorted(self.get_stop_words() or []))
+        artifact_utils.save_array(directory, 'idf', self.vectorizer.idf_)
+        artifact_utils.save_array(directory, 'matrix_data', matrix.data)
+        artifact_utils.save_array(directory, 'matrix_indices', matrix.indices)
+        artifact_utils.save_array(directory, 'matrix_indptr', matrix.indptr)
+        if self._components is not None:
+            artifact_utils.save_array(directory, 'svd_components', self._components)
+            artifact_utils.save_array(directory, 'dense_data', self._dense_data)
+            artifact_utils.save_array(directory, 'embedding_norms', self._embedding_norms)
+
+    @staticmethod
+    def load_artifact(directory, data=None, mmap=True):
+        """Loads a VectorSpace from the model artifact in
+        directory. Unlike load_instance, no pickle data is read.
+        When mmap is True the matrix arrays are memory-mapped read
+        only, so worker processes loading the same artifact share
+        their pages.
+
+        Args:
+            directory (str): the artifact directory.
+            data (OrgDataset, optional): the dataset the vector space
+                was fit on. If not provided it is loaded from the
+                same artifact. Passing the dataset the caller already
+                loaded avoids holding two copies of it.
+            mmap (bool): whether the arrays should be memory-mapped.
+
+        Returns:
+            the VectorSpace stored in the artifact.
+        """
+        params = artifact_utils.read_manifest(directory)['vector_space']
+        if data is None:
+            data = OrgDataset.load_artifact(directory, mmap)
+        vs = VectorSpace.__new__(VectorSpace)
+        vs.data = data
+        vs.analyzer = params['analyzer']
+        vs.stop_words = params['stop_words']
+        vs.ngram_range = tuple(params['ngram_range'])
+        vs.max_df = params['max_df']
+        vs.min_df = params['min_df']
+        vs.max_features = params['max_features']
+        vs.compacted = params.get('compacted', False)
+        terms = artifact_utils.load_strings(directory, 'vocabulary', mmap)
+        vocabulary = {term: i for i, term in enumerate(terms)}
+        idf = np.array(artifact_utils.load_array(directory, 'idf', mmap))
+        vs._vectorizer = None
+        vs._vectorizer_state = (vocabulary, idf,
+            artifact_utils.load_strings(directory, 'stop_words', mmap))
+        vs._fast = None
+        if vs.analyzer == 'word' and vs.ngram_range == (1, 1):
+            # Stop words never make it into a fitted vocabulary, so the
+            # transformer does not need the stop word list.
+            vs._fast = FastTfidfTransformer(vocabulary, idf, DEFAULT_TOKEN_PATTERN)
+        vs._transformed_data = sp.csr_matrix((
+            artifact_utils.load_array(directory, 'matrix_data', mmap),
+            artifact_utils.load_array(directory, 'matrix_indices', mmap),
+            artifact_utils.load_array(directory, 'matrix_indptr', mmap)),
+            shape=tuple(params['shape']), copy=False)
+        vs.data_centroid = _column_mean(vs._transformed_data[np.flatnonzero(data.active)])
+        vs.n_components = params.get('n_components')
+        vs._components = None
+        vs._prepare_search()
+        if vs.n_components is not None:
+            vs._components = artifact_utils.load_array(directory, 'svd_components', mmap)
+            vs._dense_data = artifact_utils.load_array(directory, 'dense_data', mmap)
+            vs._embedding_norms = artifact_utils.load_array(directory, 'embedding_norms', mmap)
+        vs._searcher = None
+        if 'drift' in params:
+            vs.drift = params['drift']
+        else:
+            vs._reset_drift()
+        return vs
+
+
+def normalize_rows(matrix):
+    """L2 normalizes the rows of a scipy sparse matrix or a 2d
+    numpy array, like sklearn.preprocessing.normalize, which is not
+    used here so serving does not import sklearn. Rows of zeros are
+    left as they are.
+
+    Returns:
+        a normalized copy, a csr matrix if matrix is sparse.
+    """
+    if sp.issparse(matrix):
+        matrix = sp.csr_matrix(matrix, dtype=np.result_type(matrix.dtype, np.float32),
+            copy=True)
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        matrix.data /= np.repeat(norms, np.diff(matrix.indptr))
+        return matrix
+    matrix = np.asarray(matrix)
+    if not np.issubdtype(matrix.dtype, np.floating):
+        matrix = matrix.astype(np.float64)
+    norms = np.sqrt(np.einsum('ij,ij->i', matrix, matrix))
+    norms[norms == 0] = 1
+    return matrix / norms[:, np.newaxis]
+
+
+def _row_norms(matrix):
+    """Returns the L2 norms of the rows of a 2d numpy array."""
+    return np.sqrt(np.einsum('ij,ij->i', matrix, matrix))
+
+
+def _column_mean(matrix):
+    """Returns the mean of the rows of a sparse matrix as a 1d
+    float64 array.
+    """
+    return np.asarray(matrix.mean(axis=0, dtype=np.float64)).ravel()
+
+
+def _sizeof(obj, seen):
+    """Estimates the bytes held by obj and the containers, arrays
+    and sparse matrices it holds, skipping objects whose id is in
+    seen and adding the others.
+
+    Returns:
+        a tuple (bytes, bytes of memory-mapped arrays).
+    """
+    if obj is None or id(obj) in seen:
+        return 0, 0
+    seen.add(id(obj))
+    if sp.issparse(obj):
+        parts = [obj.data, obj.indices, obj.indptr] if sp.isspmatrix_csr(obj) else [obj.tocsr()]
+    elif isinstance(obj, np.ndarray):
+        if obj.dtype == object:
+            parts = list(obj.ravel())
+        else:
+            base = obj
+            while base is not None and not isinstance(base, np.memmap):
+                base = base.base if isinstance(base.base, np.ndarray) else None
+            return obj.nbytes, obj.nbytes if base is not None else 0
+    elif isinstance(obj, artifact_utils.StringColumn):
+        parts = [obj.blob, obj.offsets]
+    elif isinstance(obj, dict):
+        parts = list(obj.keys()) + list(obj.values())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        parts = list(obj)
+    else:
+        return sys.getsizeof(obj), 0
+    size = 0 if sp.issparse(obj) else sys.getsizeof(obj)
+    mapped = 0
+    for part in parts:
+        part_size, part_mapped = _sizeof(part, seen)
+        size += part_size
+        mapped += part_mapped
+    return size, mapped
+
+
+def _top_k(sims, k):
+    """Selects the k highest scores of every row of sims.
+
+    Returns:
+        A tuple (indices, scores) ordered from highest to lowest
+        score. Entries with score -inf get index -1.
+    """
+    if k <= 0:
+        empty = np.empty((sims.shape[0], 0))
+        return empty.astype(np.intp), empty
+    if k < sims.shape[1]:
+        indices = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+    else:
+        indices = np.tile(np.arange(sims.shape[1]), (sims.shape[0], 1))
+    scores = np.take_along_axis(sims, indices, axis=1)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    indices = np.take_along_axis(indices, order, axis=1)
+    scores = np.take_along_axis(scores, order, axis=1)
+    indices[np.isneginf(scores)] = -1
+    return indices, scores
@@ -0,0 +1,71 @@
+"""
+Bounded worker pools for running blocking work from async code.
+
+The API endpoints are coroutines, so blocking Datastore calls and CPU
+bound scoring must not run on the event loop. A BoundedExecutor runs
+them on a thread pool and limits how much work may be queued; once the
+limit is reached, new work is rejected with PoolSaturatedError instead
+of piling up, so callers can shed load.
+"""
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PoolSaturatedError(RuntimeError):
+    """Raised when a BoundedExecutor has no free slot."""
+
+
+class BoundedExecutor:
+    """A thread pool that accepts at most max_workers running
+    plus max_pending queued tasks.
+
+    Attributes:
+        name (str): name of the pool, used for thread names and
+            error messages.
+        max_workers (int): the number of worker threads.
+        max_pending (int): the number of tasks that may wait for
+            a free worker.
+    """
+
+    def __init__(self, name, max_workers, max_pending):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+            thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedules fn(*args, **kwargs) on the pool. The caller's
+        context variables are visible to fn.
+
+        Returns:
+            a concurrent.futures.Future.
+
+        Raises:
+            PoolSaturatedError: if every worker is busy and the
+                queue is full.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise PoolSaturatedError('The {} pool is saturated.'.format(self.name))
+        context = contextvars.copy_context()
+        try:
+            future = self._executor.submit(context.run,
+                functools.partial(fn, *args, **kwargs))
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) on the pool and waits for the
+        result without blocking the event loop. See submit.
+        """
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)